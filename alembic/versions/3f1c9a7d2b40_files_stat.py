@@ -0,0 +1,30 @@
+"""files stat
+
+Revision ID: 3f1c9a7d2b40
+Revises: 6bd5b529ea78
+Create Date: 2026-10-18 10:15:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a7d2b40'
+down_revision = '6bd5b529ea78'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('files', sa.Column('size', sa.BigInteger(), nullable=True))
+    op.add_column('files', sa.Column('mtime_ns', sa.BigInteger(), nullable=True))
+    op.add_column('files', sa.Column('inode', sa.BigInteger(), nullable=True))
+    op.add_column('files', sa.Column('device', sa.BigInteger(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('files', 'device')
+    op.drop_column('files', 'inode')
+    op.drop_column('files', 'mtime_ns')
+    op.drop_column('files', 'size')
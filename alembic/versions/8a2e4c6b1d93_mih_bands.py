@@ -0,0 +1,86 @@
+"""mih bands
+
+Revision ID: 8a2e4c6b1d93
+Revises: 3f1c9a7d2b40
+Create Date: 2026-10-18 10:40:00.000000
+
+"""
+from base64 import b64decode
+from binascii import Error as DecodeError
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a2e4c6b1d93'
+down_revision = '3f1c9a7d2b40'
+branch_labels = None
+depends_on = None
+
+# Frozen as of this revision, whatever `src.models.mih` and
+# `src.werkzeug.hash_values` become
+BANDS = 8
+BAND_BITS = 16
+
+
+def to_bytes(hashtype: str, hashvalue: str) -> bytes:
+    '''Raw bytes of a perceptual hash stored as text: base64 for
+    `perception.*`, hex for `dhash.*`.'''
+    if hashtype.startswith('perception.'):
+        return b64decode(hashvalue)
+    return bytes.fromhex(hashvalue)
+
+
+def bands(hashtype: str, hashvalue: bytes):
+    '''`(value, width)` bands of a raw hash, most significant first, None if
+    it does not fit in `BANDS`.'''
+    nbits = len(hashvalue) * 8
+    if not 0 < nbits <= BANDS * BAND_BITS:
+        return None
+    value = int.from_bytes(hashvalue, 'big')
+    result = []
+    for start in range(0, nbits, BAND_BITS):
+        width = min(BAND_BITS, nbits - start)
+        result.append(((value >> (nbits - start - width)) & ((1 << width) - 1), width))
+    return result
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    tables = []
+    for k in range(BANDS):
+        if not sa.inspect(bind).has_table(f'mih_band_{k}'):  # create_all may have been first
+            op.create_table(f'mih_band_{k}',
+            sa.Column('hash_id', sa.Integer(), nullable=False),
+            sa.Column('hashtype', sa.String(), nullable=False),
+            sa.Column('value', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['hash_id'], ['hashes.id'], ),
+            sa.PrimaryKeyConstraint('hash_id')
+            )
+            op.create_index(f'ix_mih_band_{k}_hashtype_value', f'mih_band_{k}', ['hashtype', 'value'])
+        tables.append(sa.table(f'mih_band_{k}', sa.column('hash_id'), sa.column('hashtype'), sa.column('value')))
+
+    # Backfill the bands of hashes stored before the index existed
+    rows = bind.execute(sa.text(
+        "SELECT id, hashtype, hashvalue FROM hashes "
+        "WHERE hashtype LIKE 'dhash.%' OR hashtype LIKE 'perception.%'"
+    ))
+    while chunk := rows.fetchmany(10000):
+        params = [[] for _ in range(BANDS)]
+        for hash_id, hashtype, hashvalue in chunk:
+            try:  # Hashes are still stored as text at this revision
+                raw = to_bytes(hashtype, hashvalue)
+            except (DecodeError, ValueError):
+                continue
+            for k, (value, _) in enumerate(bands(hashtype, raw) or ()):
+                params[k].append({'hash_id': hash_id, 'hashtype': hashtype, 'value': value})
+        for table, values in zip(tables, params):
+            if values:
+                bind.execute(sa.insert(table).prefix_with('OR IGNORE'), values)
+
+
+def downgrade() -> None:
+    for k in reversed(range(BANDS)):
+        op.drop_index(f'ix_mih_band_{k}_hashtype_value', f'mih_band_{k}')
+        op.drop_table(f'mih_band_{k}')
@@ -0,0 +1,26 @@
+"""files size
+
+Stored files sharing a size with the files of `run --tiered` are looked up by
+`size`, see `Files.get_sized`.
+
+Revision ID: a7c9e1b3d5f6
+Revises: f4a6c8e0b2d5
+Create Date: 2026-10-18 17:40:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c9e1b3d5f6'
+down_revision = 'f4a6c8e0b2d5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_files_size', 'files', ['size'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_files_size', table_name='files')
@@ -0,0 +1,175 @@
+"""hash blobs
+
+Stores hash values as raw bytes, keeps a single `hashes` row per value and
+indexes `files.path` and `hashes(hashtype, hashvalue)`. Hashtypes stored JSON
+quoted by the first versions (e.g. `"hashlib.md5"`) lose their quotes first.
+
+Revision ID: c5d7e9f1a3b2
+Revises: 8a2e4c6b1d93
+Create Date: 2026-10-18 11:30:00.000000
+
+"""
+from base64 import b64decode, b64encode
+from binascii import Error as DecodeError
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d7e9f1a3b2'
+down_revision = '8a2e4c6b1d93'
+branch_labels = None
+depends_on = None
+
+CHUNK = 10000
+# Frozen as of this revision, whatever `src.models.mih` and
+# `src.werkzeug.hash_values` become
+BANDS = 8
+BAND_BITS = 16
+TIER_KEYS = ('size:', 'partial:')
+
+
+def _is_text(hashtype: str, hashvalue: str | bytes) -> bool:
+    if hashtype.startswith(('dhash.', 'perception.')):
+        return False
+    if hashtype.startswith('hashlib.'):
+        prefixes = TIER_KEYS if isinstance(hashvalue, str) else \
+            tuple(prefix.encode() for prefix in TIER_KEYS)
+        return hashvalue.startswith(prefixes)
+    return True
+
+
+def to_bytes(hashtype: str, hashvalue: str) -> bytes:
+    '''Raw bytes of a hash string: base64 for `perception.*`, hex for
+    `dhash.*` and `hashlib.*` digests, UTF-8 for the rest.'''
+    if _is_text(hashtype, hashvalue):
+        return hashvalue.encode('utf-8')
+    if hashtype.startswith('perception.'):
+        return b64decode(hashvalue)
+    return bytes.fromhex(hashvalue)
+
+
+def to_text(hashtype: str, hashvalue: bytes) -> str:
+    '''Inverse of `to_bytes`.'''
+    if _is_text(hashtype, hashvalue):
+        return hashvalue.decode('utf-8')
+    if hashtype.startswith('perception.'):
+        return b64encode(hashvalue).decode('ascii')
+    return hashvalue.hex()
+
+
+def bands(hashvalue: bytes):
+    '''`(value, width)` bands of a raw hash, most significant first, None if
+    it does not fit in `BANDS`.'''
+    nbits = len(hashvalue) * 8
+    if not 0 < nbits <= BANDS * BAND_BITS:
+        return None
+    value = int.from_bytes(hashvalue, 'big')
+    result = []
+    for start in range(0, nbits, BAND_BITS):
+        width = min(BAND_BITS, nbits - start)
+        result.append(((value >> (nbits - start - width)) & ((1 << width) - 1), width))
+    return result
+
+
+def convert(bind, function, stored_type) -> None:
+    '''Rewrites every `hashvalue` with `function`, by chunks of ids. Values
+    whose storage class already is `stored_type` are left alone.'''
+    last = -1
+    while rows := bind.execute(sa.text(
+        "SELECT id, hashtype, hashvalue FROM hashes "
+        "WHERE id > :last AND typeof(hashvalue) != :stored_type "
+        "ORDER BY id LIMIT :limit"
+    ), {'last': last, 'stored_type': stored_type, 'limit': CHUNK}).fetchall():
+        params = []
+        for hash_id, hashtype, hashvalue in rows:
+            try:
+                params.append({'id': hash_id, 'value': function(hashtype or '', hashvalue)})
+            except (DecodeError, ValueError, UnicodeDecodeError):
+                pass  # Not valid for its hashtype, kept as is
+        if params:
+            bind.execute(sa.text("UPDATE hashes SET hashvalue = :value WHERE id = :id"), params)
+        last = rows[-1][0]
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    # The first versions stored `hashlib.*` and `perception.*` names as JSON,
+    # their rows are merged with the unquoted ones below
+    bind.execute(sa.text(
+        "UPDATE hashes SET hashtype = trim(hashtype, '\"') WHERE hashtype LIKE '\"%\"'"
+    ))
+    convert(bind, to_bytes, 'blob')
+
+    # Every file row and hash row points to the first row with the same value
+    bind.execute(sa.text(
+        "CREATE TEMP TABLE hash_map AS "
+        "SELECT h.id AS old, k.keep AS new FROM hashes h "
+        "JOIN (SELECT hashtype, hashvalue, MIN(id) AS keep FROM hashes "
+        "GROUP BY hashtype, hashvalue) k "
+        "ON h.hashtype IS k.hashtype AND h.hashvalue = k.hashvalue "
+        "WHERE h.id != k.keep"
+    ))
+    bind.execute(sa.text(
+        "INSERT OR IGNORE INTO association_table (file_id, hash_id) "
+        "SELECT a.file_id, m.new FROM association_table a "
+        "JOIN hash_map m ON a.hash_id = m.old"
+    ))
+    bind.execute(sa.text("DELETE FROM association_table WHERE hash_id IN (SELECT old FROM hash_map)"))
+    for k in range(BANDS):  # Same value, same bands: the kept row has them already
+        bind.execute(sa.text(f"DELETE FROM mih_band_{k} WHERE hash_id IN (SELECT old FROM hash_map)"))
+    bind.execute(sa.text("DELETE FROM hashes WHERE id IN (SELECT old FROM hash_map)"))
+    bind.execute(sa.text("DROP TABLE hash_map"))
+
+    # Paths stored twice keep their latest row
+    bind.execute(sa.text(
+        "CREATE TEMP TABLE file_map AS "
+        "SELECT f.id AS old, k.keep AS new FROM files f "
+        "JOIN (SELECT path, MAX(id) AS keep FROM files GROUP BY path) k "
+        "ON f.path = k.path WHERE f.id != k.keep"
+    ))
+    bind.execute(sa.text(
+        "INSERT OR IGNORE INTO association_table (file_id, hash_id) "
+        "SELECT m.new, a.hash_id FROM association_table a "
+        "JOIN file_map m ON a.file_id = m.old"
+    ))
+    bind.execute(sa.text("DELETE FROM association_table WHERE file_id IN (SELECT old FROM file_map)"))
+    bind.execute(sa.text("DELETE FROM files WHERE id IN (SELECT old FROM file_map)"))
+    bind.execute(sa.text("DROP TABLE file_map"))
+
+    # Perceptual hashes that were quoted had no bands from 8a2e4c6b1d93
+    rows = bind.execute(sa.text(
+        "SELECT id, hashtype, hashvalue FROM hashes "
+        "WHERE (hashtype LIKE 'dhash.%' OR hashtype LIKE 'perception.%') "
+        "AND typeof(hashvalue) = 'blob' AND id NOT IN (SELECT hash_id FROM mih_band_0)"
+    )).fetchall()
+    for k in range(BANDS):
+        params = [
+            {'hash_id': hash_id, 'hashtype': hashtype, 'value': banded[k][0]}
+            for hash_id, hashtype, hashvalue in rows
+            if (banded := bands(hashvalue)) and k < len(banded)
+        ]
+        if params:
+            bind.execute(sa.text(
+                f"INSERT OR IGNORE INTO mih_band_{k} (hash_id, hashtype, value) "
+                "VALUES (:hash_id, :hashtype, :value)"
+            ), params)
+
+    with op.batch_alter_table('hashes') as batch_op:
+        batch_op.alter_column('hashvalue', type_=sa.LargeBinary(), existing_nullable=False)
+        batch_op.create_index('ix_hashes_hashtype_hashvalue', ['hashtype', 'hashvalue'], unique=True)
+    op.create_index('ix_files_path', 'files', ['path'], unique=True)
+
+    # The text values are gone, give their pages back to the filesystem
+    with op.get_context().autocommit_block():
+        bind.execute(sa.text("VACUUM"))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_files_path', 'files')
+    # Before the column changes type: batch mode copies the rows with a CAST
+    convert(op.get_bind(), to_text, 'text')
+    with op.batch_alter_table('hashes') as batch_op:
+        batch_op.drop_index('ix_hashes_hashtype_hashvalue')
+        batch_op.alter_column('hashvalue', type_=sa.String(), existing_nullable=False)
@@ -0,0 +1,38 @@
+"""scans
+
+Checkpoints of `run --resume`.
+
+Revision ID: e2b4d6f8a1c3
+Revises: c5d7e9f1a3b2
+Create Date: 2026-10-18 12:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b4d6f8a1c3'
+down_revision = 'c5d7e9f1a3b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('scans',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('settings', sa.String(), nullable=False),
+    sa.Column('finished', sa.Boolean(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('scan_directories',
+    sa.Column('scan_id', sa.Integer(), nullable=False),
+    sa.Column('path', sa.String(), nullable=False),
+    sa.ForeignKeyConstraint(['scan_id'], ['scans.id'], ),
+    sa.PrimaryKeyConstraint('scan_id', 'path')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('scan_directories')
+    op.drop_table('scans')
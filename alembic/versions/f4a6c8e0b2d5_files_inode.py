@@ -0,0 +1,25 @@
+"""files inode
+
+Renamed files are looked up by `(device, inode)`, see `Files.get_renamed`.
+
+Revision ID: f4a6c8e0b2d5
+Revises: e2b4d6f8a1c3
+Create Date: 2026-10-18 14:30:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a6c8e0b2d5'
+down_revision = 'e2b4d6f8a1c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_files_device_inode', 'files', ['device', 'inode'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_files_device_inode', table_name='files')
@@ -0,0 +1,152 @@
+"""
+Deterministic synthetic photo corpus for the benchmarks.
+
+Each original is a photo-like picture (gradient sky, shapes, grain) saved as
+JPEG, PNG or HEIC in turn, next to its variants: resized, recompressed,
+cropped and an exact copy. Like camera files, JPEG originals embed an EXIF
+thumbnail and HEIC ones a thumbnail item. A manifest maps every file to its
+original, which is the ground truth for duplicate recall.
+
+Usage:
+    python -m benchmarks.corpus DIRECTORY [-n 60] [--seed 0]
+"""
+import argparse
+import io
+import os
+import shutil
+import struct
+from typing import Dict, List
+
+import numpy as np
+from orjson import OPT_INDENT_2, dumps, loads
+from PIL import Image, ImageDraw, ImageFilter
+
+MANIFEST = "manifest.json"
+FORMATS = [("JPEG", ".jpg"), ("PNG", ".png"), ("HEIF", ".heic")]
+# x265 at its default preset takes seconds per picture
+PARAMS = {
+    "JPEG": {"quality": 92},
+    "PNG": {"compress_level": 1},
+    "HEIF": {"quality": 80, "enc_params": {"preset": "ultrafast"}},
+}
+SIZE = (1024, 768)
+EXIF_THUMBNAIL = 160
+HEIF_THUMBNAIL = 320
+
+
+def picture(rng: np.random.Generator, size=SIZE) -> Image.Image:
+    width, height = size
+    top, bottom = rng.integers(0, 256, 3), rng.integers(0, 256, 3)
+    ramp = np.linspace(0, 1, height)[:, None, None]
+    pixels = (top * (1 - ramp) + bottom * ramp) * np.ones((1, width, 1))
+    image = Image.fromarray(pixels.astype(np.uint8))
+
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.integers(6, 16)):
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        x1, y1 = x0 + rng.integers(40, width // 2), y0 + rng.integers(40, height // 2)
+        colour = tuple(int(c) for c in rng.integers(0, 256, 3))
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape((x0, y0, x1, y1), fill=colour)
+    image = image.filter(ImageFilter.GaussianBlur(2))
+
+    grain = rng.normal(0, 6, (height, width, 3))
+    return Image.fromarray(np.clip(np.asarray(image) + grain, 0, 255).astype(np.uint8))
+
+
+def exif(image: Image.Image, side: int = EXIF_THUMBNAIL) -> bytes:
+    '''Minimal EXIF block whose IFD1 holds a JPEG thumbnail of `image`.'''
+    thumbnail = image.copy()
+    thumbnail.thumbnail((side, side))
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, "JPEG", quality=85)
+    ifd0, ifd1 = 8, 8 + 2 + 4  # An empty IFD0 pointing to IFD1
+    data = ifd1 + 2 + 2 * 12 + 4
+    tiff = (
+        b"II*\x00" + struct.pack("<I", ifd0)
+        + struct.pack("<HI", 0, ifd1)
+        + struct.pack("<H", 2)
+        + struct.pack("<HHII", 0x0201, 4, 1, data)  # JPEGInterchangeFormat
+        + struct.pack("<HHII", 0x0202, 4, 1, buffer.tell())  # JPEGInterchangeFormatLength
+        + struct.pack("<I", 0)
+        + buffer.getvalue()
+    )
+    return b"Exif\x00\x00" + tiff
+
+
+def heif_available() -> bool:
+    try:
+        from pillow_heif import register_heif_opener
+    except ImportError:
+        return False
+    register_heif_opener()
+    return True
+
+
+def generate(root: str, originals: int = 60, seed: int = 0) -> Dict[str, int]:
+    '''Writes the corpus under `root` and returns `{path: original}`. A corpus
+    already generated with the same parameters is reused.'''
+    manifest_path = os.path.join(root, MANIFEST)
+    parameters = {
+        "originals": originals, "seed": seed, "size": list(SIZE),
+        "previews": [EXIF_THUMBNAIL, HEIF_THUMBNAIL],
+    }
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "rb") as file:
+            manifest = loads(file.read())
+        if manifest["parameters"] == parameters:
+            return manifest["files"]
+        shutil.rmtree(root)
+
+    formats = FORMATS if heif_available() else FORMATS[:2]
+    files: Dict[str, int] = {}
+    for i in range(originals):
+        rng = np.random.default_rng([seed, i])
+        image = picture(rng)
+        directory = os.path.join(root, f"album{i % 7}", f"{i // 7:03d}")
+        os.makedirs(directory, exist_ok=True)
+        fmt, extension = formats[i % len(formats)]
+
+        def save(name: str, variant: Image.Image, fmt: str = fmt, extension: str = extension, **params):
+            path = os.path.abspath(os.path.join(directory, name + extension))
+            variant.save(path, fmt, **(params or PARAMS[fmt]))
+            files[path] = i
+            return path
+
+        previews = {
+            "JPEG": {"exif": exif(image)},
+            "HEIF": {"thumbnails": [HEIF_THUMBNAIL]},
+        }
+        original = save(f"IMG_{i:04d}", image, **PARAMS[fmt], **previews.get(fmt, {}))
+        save(f"IMG_{i:04d}_resized", image.resize((SIZE[0] // 2, SIZE[1] // 2), Image.LANCZOS))
+        save(f"IMG_{i:04d}_recompressed", image, "JPEG", ".jpg", quality=55)
+        w, h = SIZE
+        save(f"IMG_{i:04d}_cropped", image.crop((w // 20, h // 20, w - w // 20, h - h // 20)))
+        copy = os.path.abspath(os.path.join(root, "copies", f"IMG_{i:04d}{extension}"))
+        os.makedirs(os.path.dirname(copy), exist_ok=True)
+        shutil.copyfile(original, copy)
+        files[copy] = i
+
+    with open(manifest_path, "wb") as file:
+        file.write(dumps({"parameters": parameters, "files": files}, option=OPT_INDENT_2))
+    return files
+
+
+def true_pairs(files: Dict[str, int]) -> set:
+    groups: Dict[int, List[str]] = {}
+    for path, original in files.items():
+        groups.setdefault(original, []).append(path)
+    return {
+        (a, b)
+        for members in groups.values()
+        for a in members for b in members if a < b
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("directory")
+    parser.add_argument("-n", type=int, default=60, help="number of originals")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(f"{len(generate(args.directory, args.n, args.seed))} files in {args.directory}")
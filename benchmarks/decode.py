@@ -0,0 +1,106 @@
+"""
+Benchmark of reduced-resolution decoding for perceptual hashers, full decode
+against `decode(..., resolution(...))` and against `decode_preview` (the EXIF
+or HEIF thumbnail), on camera sized synthetic pictures.
+
+Also reports the fraction of the bits of each hash that differ from the full
+image's, `tests/test_decode.py` asserts they stay within tolerance.
+
+Usage:
+    python -m benchmarks.decode [-n 3] [-f JPEG] [--size 4032x3024]
+"""
+import argparse
+import io
+import sys
+from time import perf_counter
+
+import numpy as np
+from orjson import dumps
+from PIL import Image
+
+from benchmarks.corpus import HEIF_THUMBNAIL, PARAMS, exif, heif_available, picture
+from src.hashers import decoded_hashers, enabled_hashers
+from src.hashers.decode import Decoded, decode, decode_preview, resolution
+from src.werkzeug.hash_values import to_bytes
+
+
+def encoded(n: int, size: tuple, formats: list) -> dict:
+    if "HEIF" in formats and not heif_available():
+        formats.remove("HEIF")
+    images = {fmt: [] for fmt in formats}
+    for i in range(n):
+        image = picture(np.random.default_rng([1, i]), size)
+        previews = {"JPEG": {"exif": exif(image)}, "HEIF": {"thumbnails": [HEIF_THUMBNAIL]}}
+        for fmt in formats:
+            buffer = io.BytesIO()
+            image.save(buffer, fmt, **PARAMS[fmt], **previews.get(fmt, {}))
+            images[fmt].append(buffer.getvalue())
+    return images
+
+
+def distance(hashtype: str, a: str, b: str) -> float:
+    '''Fraction of the bits that differ.'''
+    a, b = to_bytes(hashtype, a), to_bytes(hashtype, b)
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).bit_count() / (8 * len(a))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=3, help="pictures per format")
+    parser.add_argument("-f", "--format", action="append", choices=sorted(PARAMS),
+                        help="formats to encode the pictures in (default: JPEG)")
+    parser.add_argument("--size", default="4032x3024", help="picture size, WxH")
+    args = parser.parse_args()
+    size = tuple(int(side) for side in args.size.split("x"))
+
+    sample = Decoded(Image.new("RGB", (64, 64)))
+    hashtypes = []
+    for hashtype in sorted(decoded_hashers):
+        try:  # OpenCV hashers need opencv-contrib
+            enabled_hashers[hashtype](sample)
+        except Exception as exc:
+            print(f"Skipping {hashtype}: {exc}", file=sys.stderr)
+            continue
+        hashtypes.append(hashtype)
+
+    for fmt, images in encoded(args.n, size, args.format or ["JPEG"]).items():
+        for hashtype in hashtypes:
+            func, side = enabled_hashers[hashtype], resolution([hashtype])
+            full = reduced = previewed = 0.0
+            distances, preview_distances = [], []
+            for data in images:
+                start = perf_counter()
+                a = func(decode(data))[1]
+                full += perf_counter() - start
+                start = perf_counter()
+                b = func(decode(data, side))[1]
+                reduced += perf_counter() - start
+                distances.append(distance(hashtype, a, b))
+                if side is None:  # Hashes depend on the resolution, no preview
+                    continue
+                start = perf_counter()
+                preview = decode_preview(data, resolution([hashtype], margin=1))
+                if preview is not None:
+                    c = func(preview)[1]
+                    previewed += perf_counter() - start
+                    preview_distances.append(distance(hashtype, a, c))
+            result = {
+                "format": fmt,
+                "hashtype": hashtype,
+                "side": side,
+                "full": full / len(images),
+                "reduced": reduced / len(images),
+                "speedup": full / reduced,
+                "max_distance": max(distances),
+            }
+            if preview_distances:
+                result.update(
+                    previews=len(preview_distances),
+                    preview=previewed / len(preview_distances),
+                    preview_max_distance=max(preview_distances),
+                )
+            print(dumps(result).decode())
+
+
+if __name__ == "__main__":
+    main()
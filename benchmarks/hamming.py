@@ -0,0 +1,57 @@
+"""
+Benchmark of `hamming_pairs` (blocked, parallel) against the scalar
+`hamming_distance` called pair by pair from Python.
+
+Usage:
+    python -m benchmarks.hamming [-n 2000] [-w 1] [-t 10]
+"""
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from src.werkzeug.distances import hamming_distance, hamming_pairs
+
+
+def scalar_pairs(words: np.ndarray, threshold: int) -> set:
+    pairs = set()
+    for i in range(len(words)):
+        for j in range(i + 1, len(words)):
+            distance = sum(hamming_distance(x, y) for x, y in zip(words[i], words[j]))
+            if distance <= threshold:
+                pairs.add((i, j, distance))
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', type=int, default=2000, help='number of hashes')
+    parser.add_argument('-w', type=int, default=1, help='64 bits words per hash')
+    parser.add_argument('-t', type=int, default=10, help='threshold')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    words = rng.integers(0, 2**64, size=(args.n, args.w), dtype=np.uint64)
+    comparisons = args.n * (args.n - 1) // 2
+
+    # Compilation is left out of the timings
+    hamming_pairs(words[:2], threshold=args.t)
+    hamming_distance(words[0, 0], words[1, 0])
+
+    start = perf_counter()
+    batch = hamming_pairs(words, threshold=args.t)
+    batch_time = perf_counter() - start
+
+    start = perf_counter()
+    scalar = scalar_pairs(words, args.t)
+    scalar_time = perf_counter() - start
+
+    assert set(map(tuple, batch.tolist())) == scalar, "results differ"
+    print(f"{comparisons} comparisons, {len(batch)} pairs within {args.t} bits")
+    print(f"scalar: {scalar_time:.3f}s ({comparisons / scalar_time:,.0f} pairs/s)")
+    print(f"batch:  {batch_time:.3f}s ({comparisons / batch_time:,.0f} pairs/s)")
+    print(f"speedup: {scalar_time / batch_time:,.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Benchmark of the pending-work lookup of `run`, the temporary table anti-join
+of `Files.get_missing` a walk chunk at a time, against loading every stored
+`(path, hashtype)` into Python first, on synthetic records written to a
+scratch database.
+
+Every file is looked up as a walk would: one in `-s` was modified since (its
+mtime differs) and is pending, the others are done. Prints the time and the
+Python heap peak (tracemalloc) of each approach.
+
+Usage:
+    python -m benchmarks.pending [-n 100000] [-c 256] [-s 10]
+"""
+import argparse
+import os
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+from orjson import dumps
+
+from benchmarks.writer import records
+
+HASHTYPES = ("hashlib.md5", "dhash.dhash")
+
+
+def measure(name: str, function, *args):
+    tracemalloc.start()
+    start = perf_counter()
+    result = function(*args)
+    elapsed = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(dumps({"step": name, "seconds": elapsed, "heap_peak_mib": peak / 2**20}).decode())
+    return result
+
+
+def main(args):
+    from sqlalchemy import select
+
+    from src.models import Files, Hashes, Session, association_table, async_create_all, engine
+    from src.models.files import add_all
+    from src.werkzeug.async2sync import await_
+
+    await_(async_create_all(engine))
+    batch = list(records(args.n))
+    for start in range(0, args.n, 5000):
+        await_(add_all(batch[start:start + 5000]))
+    # `(path, size, mtime_ns, inode, device)` as stat finds them
+    stats = [
+        (r["path"], r["size"], r["mtime_ns"] + (i % args.s == 0), r["inode"], r["device"])
+        for i, r in enumerate(batch)
+    ]
+    del batch
+    wanted = [(h, h, False) for h in HASHTYPES]
+
+    def in_sql():
+        pending = 0
+        for start in range(0, len(stats), args.c):
+            pending += len(await_(Files.get_missing(stats[start:start + args.c], wanted)))
+        return pending
+
+    async def load_all():
+        async with Session.begin() as session:
+            query = select(Files.path, Files.size, Files.mtime_ns, Files.inode,
+                           Files.device, Hashes.hashtype)\
+                .outerjoin_from(Files, association_table)\
+                .outerjoin(Hashes)
+            items = {}
+            async for row in await session.stream(query):
+                stat = (row.size, row.mtime_ns, row.inode, row.device)
+                items.setdefault(row.path, (stat, set()))[1].add(row.hashtype)
+            return items
+
+    def in_python():
+        items = await_(load_all())
+        return sum(
+            1 for path, *stat in stats
+            if (item := items.get(path)) is None or item[0] != tuple(stat)
+            or not item[1].issuperset(HASHTYPES)
+        )
+
+    expected = -(-args.n // args.s)
+    assert measure("whole cache in Python", in_python) == expected, "pending files differ"
+    assert measure("anti-join by chunk", in_sql) == expected, "pending files differ"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', type=int, default=100000, help='stored files')
+    parser.add_argument('-c', type=int, default=256, help='files per lookup, as walk chunks')
+    parser.add_argument('-s', type=int, default=10, help='one file in S is modified')
+    args = parser.parse_args()
+    # The engine opens database.db in the working directory
+    os.chdir(tempfile.mkdtemp())
+    main(args)
@@ -0,0 +1,227 @@
+"""
+End-to-end benchmark: `run` and `cluster` on the synthetic corpus of
+`benchmarks.corpus`, each in a child process on a scratch database.
+
+Reports files/s of the first scan and of a rescan of the unchanged tree,
+per-hasher throughput (from `--metrics-json`), peak RSS of each command,
+database size, and the recall and precision of exact (byte-identical) and
+near-duplicate groups against the corpus manifest. Results are written as
+JSON; `--baseline` compares them with an earlier results file and exits with
+status 1 on a regression beyond `--tolerance`.
+
+Usage:
+    python -m benchmarks.pipeline [-n 60] [-w 0] [-p] [-o results.json]
+                                  [--baseline old.json] [--tolerance 0.1]
+"""
+import argparse
+import hashlib
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from itertools import combinations
+from time import perf_counter
+
+from orjson import OPT_INDENT_2, dumps, loads
+
+from benchmarks.corpus import generate, true_pairs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, "main.py")
+
+# Metric: whether higher is better
+COMPARED = {
+    ("scan", "files_per_second"): True,
+    ("rescan", "files_per_second"): True,
+    ("scan", "peak_rss_mib"): False,
+    ("cluster", "seconds"): False,
+    ("cluster", "peak_rss_mib"): False,
+    ("database", "bytes"): False,
+    ("exact", "recall"): True,
+    ("near", "recall"): True,
+    ("near", "precision"): True,
+}
+
+
+def execute(args: list, cwd: str) -> dict:
+    '''Runs the CLI in `cwd`, returns its wall time and peak RSS.'''
+    with open(os.path.join(cwd, "benchmark.log"), "ab") as log:
+        start = perf_counter()
+        process = subprocess.Popen([sys.executable, MAIN, *args], cwd=cwd, stdout=log, stderr=log)
+        # `wait4` gives the resource usage of this child alone
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, args)
+    return {"seconds": elapsed, "peak_rss_mib": usage.ru_maxrss / 1024}
+
+
+def scan(corpus: str, workdir: str, hashes: list, workers: int, files: int, name: str,
+         options: tuple = ()) -> dict:
+    metrics = os.path.join(workdir, f"{name}.json")
+    args = ["run", "-d", corpus, "-w", str(workers), "--metrics-json", metrics, *options]
+    for hashtype in hashes:
+        args += ["-h", hashtype]
+    result = execute(args, workdir)
+    result["files_per_second"] = files / result["seconds"]
+
+    with open(metrics, "rb") as file:
+        summary = loads(file.read())
+    result["hashers"] = {
+        stage.partition(":")[2]: {
+            "count": values["count"],
+            "seconds": values["seconds"],
+            "files_per_second": values["count"] / values["seconds"] if values["seconds"] else None,
+        }
+        for stage, values in summary["stages"].items()
+        if stage.startswith("hash:")
+    }
+    result["previews"] = summary["counters"].get("preview.hits", 0)
+    read = summary["stages"].get("read", {})
+    if read.get("seconds"):
+        result["read_mib_per_second"] = summary["counters"].get("read.bytes", 0) / read["seconds"] / 2**20
+    return result
+
+
+def score(found: set, truth: set) -> dict:
+    hits = len(found & truth)
+    return {
+        "pairs": len(truth),
+        "found": len(found),
+        "recall": hits / len(truth) if truth else 1.0,
+        "precision": hits / len(found) if found else 1.0,
+    }
+
+
+def exact_pairs(database: str, hashtype: str) -> set:
+    '''Pairs of files sharing their `hashtype` value in `database`.'''
+    query = """
+        SELECT f.path, a.hash_id FROM files f
+        JOIN association_table a ON a.file_id = f.id
+        JOIN hashes h ON h.id = a.hash_id
+        WHERE h.hashtype = ?
+    """
+    groups: dict = {}
+    with sqlite3.connect(database) as connection:
+        for path, hash_id in connection.execute(query, (hashtype,)):
+            groups.setdefault(hash_id, []).append(path)
+    return {tuple(sorted(pair)) for paths in groups.values() for pair in combinations(paths, 2)}
+
+
+def identical_pairs(files: dict) -> set:
+    digests: dict = {}
+    for path in files:
+        with open(path, "rb") as file:
+            digests.setdefault(hashlib.file_digest(file, "md5").digest(), []).append(path)
+    return {tuple(sorted(pair)) for paths in digests.values() for pair in combinations(paths, 2)}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    '''Prints every compared metric against `baseline`, returns the regressions.'''
+    regressions = []
+    for (section, key), higher in COMPARED.items():
+        new, old = results.get(section, {}).get(key), baseline.get(section, {}).get(key)
+        if not new or not old:
+            continue
+        change = new / old - 1
+        worse = -change if higher else change
+        flag = "REGRESSION" if worse > tolerance else ""
+        name = f"{section}.{key}"
+        print(f"{name:<24} {old:>12.4g} -> {new:>12.4g} {change:+8.1%} {flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0], add_help=False)
+    parser.add_argument("-n", type=int, default=60, help="number of originals in the corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "dup-photos-corpus"),
+                        help="corpus directory, reused across runs")
+    parser.add_argument("-w", "--workers", type=int, default=0, help="`run --workers`")
+    parser.add_argument("-p", "--preview", action="store_true", help="`run --preview`")
+    parser.add_argument("-h", "--hash", dest="hashes", action="append",
+                        help="hash algorithms for `run` (default: md5 and dhash)")
+    parser.add_argument("-c", "--cluster-hash", default="dhash.dhash", help="hash for `cluster`")
+    parser.add_argument("-r", "--radius", type=int, default=4, help="`cluster --radius`")
+    parser.add_argument("-o", "--output", default="results.json")
+    parser.add_argument("--baseline", help="earlier results file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed relative regression")
+    parser.add_argument("--help", action="help")
+    args = parser.parse_args()
+    hashes = args.hashes or ["hashlib.md5", "dhash.dhash"]
+    exact = next((h for h in hashes if h.startswith("hashlib.")), None)
+
+    start = perf_counter()
+    files = generate(args.corpus, args.n, args.seed)
+    corpus_seconds = perf_counter() - start
+
+    with tempfile.TemporaryDirectory(prefix="dup-photos-bench-") as workdir:
+        try:
+            options = ("--preview",) if args.preview else ()
+            results = {
+                name: scan(args.corpus, workdir, hashes, args.workers, len(files), name, options)
+                for name in ("scan", "rescan")
+            }
+            groups = os.path.join(workdir, "groups.jsonl")
+            results["cluster"] = execute(
+                ["cluster", "-h", args.cluster_hash, "-r", str(args.radius), "-o", groups], workdir
+            )
+        except subprocess.CalledProcessError:
+            with open(os.path.join(workdir, "benchmark.log"), errors="replace") as log:
+                sys.stderr.write(log.read()[-4000:])
+            raise
+
+        database = os.path.join(workdir, "database.db")
+        results["database"] = {
+            "bytes": sum(
+                os.path.getsize(database + suffix)
+                for suffix in ("", "-wal")
+                if os.path.exists(database + suffix)
+            )
+        }
+        if exact:
+            results["exact"] = {"hashtype": exact, **score(exact_pairs(database, exact), identical_pairs(files))}
+
+        found = set()
+        with open(groups, "rb") as lines:
+            for line in lines:
+                found.update(combinations(sorted(loads(line)["files"]), 2))
+        results["near"] = {"hashtype": args.cluster_hash, "radius": args.radius,
+                           **score(found, true_pairs(files))}
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    results = {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "corpus": {"originals": args.n, "seed": args.seed, "files": len(files), "seconds": corpus_seconds},
+        "hashes": hashes,
+        "workers": args.workers,
+        "preview": args.preview,
+        **results,
+    }
+    with open(args.output, "wb") as file:
+        file.write(dumps(results, option=OPT_INDENT_2))
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "rb") as file:
+            regressions = compare(results, loads(file.read()), args.tolerance)
+        if regressions:
+            sys.exit(f"Regressions: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
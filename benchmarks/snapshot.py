@@ -0,0 +1,80 @@
+"""
+Benchmark of the hash snapshots of `export-index` against reading the hashes
+from the database, on synthetic records written to a scratch database.
+
+Times a full export, an incremental refresh after `-a` more files, getting the
+hashes of `cluster` ready and a `query` lookup, with the Python heap peak
+(tracemalloc) of each: mapped pages are not on the heap.
+
+Usage:
+    python -m benchmarks.snapshot [-n 50000] [-a 500]
+"""
+import argparse
+import os
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+from orjson import dumps
+
+from benchmarks.writer import records
+
+HASHTYPE = "dhash.dhash"
+
+
+def measure(name: str, function, *args):
+    tracemalloc.start()
+    start = perf_counter()
+    result = function(*args)
+    elapsed = perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(dumps({"step": name, "seconds": elapsed, "heap_peak_mib": peak / 2**20}).decode())
+    return result
+
+
+def main(args):
+    from src.cmds.export_index import directory, refresh
+    from src.models import Files, async_create_all, engine
+    from src.models.files import add_all
+    from src.werkzeug import snapshot
+    from src.werkzeug.async2sync import await_
+    from src.werkzeug.hash_values import to_words
+
+    def fill(n: int, offset: int) -> None:
+        batch = list(records(n, offset))
+        for start in range(0, n, 5000):
+            await_(add_all(batch[start:start + 5000]))
+
+    await_(async_create_all(engine))
+    fill(args.n, 0)
+    measure("export", refresh, [HASHTYPE])
+    fill(args.a, args.n)
+    measure("refresh", refresh, None)
+
+    def from_database():
+        _, values = await_(Files.get_hashes(HASHTYPE))
+        return to_words(values)
+
+    def from_snapshot():
+        mapped = snapshot.load(directory(), HASHTYPE)
+        return mapped.words, mapped.nbits
+
+    words, _ = measure("cluster input, database", from_database)
+    mapped, _ = measure("cluster input, snapshot", from_snapshot)
+    assert sorted(map(tuple, words.tolist())) == list(map(tuple, mapped.tolist())), "results differ"
+
+    query = snapshot.load(directory(), HASHTYPE)
+    target = bytes(query.words[len(query) // 2].astype(">u8").tobytes())
+    rows, _ = measure("query, snapshot", query.within, target, 8)
+    assert len(rows) >= 1, "query missed its own hash"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', type=int, default=50000, help='files exported')
+    parser.add_argument('-a', type=int, default=500, help='files added before the refresh')
+    args = parser.parse_args()
+    # The engine opens database.db in the working directory
+    os.chdir(tempfile.mkdtemp())
+    main(args)
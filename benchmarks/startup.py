@@ -0,0 +1,106 @@
+"""
+Startup budget of the CLI: wall time of short invocations, each in a fresh
+interpreter, the way cron jobs and scripts call it.
+
+Every invocation runs `--repeat` times and its median is checked against its
+budget (seconds, scaled by `--scale` for slower machines). Heavy modules that
+`--help` must not import are checked too. The numba kernels of `cluster` are
+timed with an empty cache, then again once it is filled. Exits with status 1
+when a budget is exceeded.
+
+Usage:
+    python -m benchmarks.startup [--repeat 5] [--scale 1.0] [-o startup.json]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+from orjson import OPT_INDENT_2, dumps
+
+from benchmarks.pipeline import MAIN, ROOT
+
+# Invocation: budget in seconds
+BUDGETS = {
+    ("--help",): 0.5,
+    ("run", "--help"): 0.5,
+    ("cluster", "--help"): 0.5,
+    ("dropdb",): 1.0,
+}
+HEAVY = ("numba", "sqlalchemy", "perception", "cv2", "scipy", "PIL", "pillow_heif")
+NUMBA_BUDGET = 3.0  # Kernels loaded from the cache, interpreter included
+KERNELS = """
+import numpy as np
+from src.werkzeug.distances import hamming_pairs
+from src.werkzeug.union_find import cluster
+words = np.arange(8, dtype=np.uint64).reshape(4, 2)
+cluster(words, 128, 4)
+hamming_pairs(words, threshold=4)
+"""
+
+
+def timed(args: list, cwd: str, env: dict = None) -> float:
+    start = perf_counter()
+    subprocess.run(args, cwd=cwd, env=env, check=True, capture_output=True)
+    return perf_counter() - start
+
+
+def imported(args: tuple, cwd: str) -> set:
+    '''Top-level packages imported by an invocation, from `-X importtime`.'''
+    process = subprocess.run([sys.executable, "-X", "importtime", MAIN, *args],
+                             cwd=cwd, check=True, capture_output=True, text=True)
+    return {
+        line.rpartition("|")[2].strip().split(".")[0]
+        for line in process.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5, help="runs per invocation")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies every budget")
+    parser.add_argument("-o", "--output", default="startup.json")
+    args = parser.parse_args()
+
+    results, failures = {"invocations": {}}, []
+    with tempfile.TemporaryDirectory(prefix="dup-photos-startup-") as workdir:
+        for invocation, budget in BUDGETS.items():
+            times = [timed([sys.executable, MAIN, *invocation], workdir) for _ in range(args.repeat)]
+            name = " ".join(invocation)
+            median = statistics.median(times)
+            results["invocations"][name] = {"median": median, "min": min(times),
+                                            "budget": budget * args.scale}
+            print(f"{name:<16} {median:>8.3f}s  (budget {budget * args.scale:.2f}s)")
+            if median > budget * args.scale:
+                failures.append(name)
+
+        heavy = sorted(imported(("--help",), workdir).intersection(HEAVY))
+        results["help_imports"] = heavy
+        if heavy:
+            print(f"--help imports {', '.join(heavy)}")
+            failures.append("--help imports")
+
+        # A private cache directory, so the first run compiles whatever the
+        # state of the source tree's __pycache__
+        env = {**os.environ, "NUMBA_CACHE_DIR": os.path.join(workdir, "numba"),
+               "PYTHONPATH": os.pathsep.join(filter(None, (ROOT, os.environ.get("PYTHONPATH"))))}
+        command = [sys.executable, "-c", KERNELS]
+        cold = timed(command, workdir, env)
+        warm = statistics.median(timed(command, workdir, env) for _ in range(args.repeat))
+        results["numba"] = {"cold": cold, "warm": warm, "budget": NUMBA_BUDGET * args.scale}
+        print(f"{'numba kernels':<16} {warm:>8.3f}s  (cold {cold:.3f}s, budget {NUMBA_BUDGET * args.scale:.2f}s)")
+        if warm > NUMBA_BUDGET * args.scale:
+            failures.append("numba kernels")
+
+    with open(args.output, "wb") as file:
+        file.write(dumps(results, option=OPT_INDENT_2))
+    if failures:
+        sys.exit(f"Over budget: {', '.join(failures)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Benchmark of the group-commit writer of `run`, `AdaptiveBuffer` against
+`StaticBuffer`, on synthetic file records written to a scratch database.
+
+Usage:
+    python -m benchmarks.writer [-n 20000] [-b 200] [--rate 0]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+from time import perf_counter
+
+from orjson import dumps
+
+
+def records(n: int, offset: int = 0):
+    for i in range(offset, offset + n):
+        yield {
+            "path": f"/synthetic/{i}.jpg",
+            "filetype": "image/jpeg",
+            "size": i,
+            "mtime_ns": i,
+            "inode": i,
+            "device": 0,
+            "hashes": {
+                "fmt": b"image/jpeg",
+                "hashlib.md5": os.urandom(16),
+                "dhash.dhash": os.urandom(16),
+            },
+        }
+
+
+async def measure(buffer, n: int, offset: int, rate: float) -> dict:
+    from src.cmds.run import write
+
+    queue = asyncio.Queue(4096)
+    writer = asyncio.create_task(write(queue, buffer))
+    start = perf_counter()
+    for i, record in enumerate(records(n, offset)):
+        await queue.put(record)
+        if rate and i % 100 == 99:  # Hashing stage producing `rate` files/s
+            await asyncio.sleep(max(start + (i + 1) / rate - perf_counter(), 0))
+    await queue.put(None)
+    await writer
+    elapsed = perf_counter() - start
+    return {**buffer.summary(), "seconds": elapsed, "files_per_second": n / elapsed}
+
+
+async def main(args):
+    from src.models import async_create_all, engine
+    from src.werkzeug.dynamic_buffer import AdaptiveBuffer, StaticBuffer
+
+    await async_create_all(engine)
+    policies = [StaticBuffer(args.b), AdaptiveBuffer()]
+    for k, buffer in enumerate(policies):
+        result = await measure(buffer, args.n, k * args.n, args.rate)
+        print(dumps(result).decode())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-n', type=int, default=20000, help='files per policy')
+    parser.add_argument('-b', type=int, default=200, help='StaticBuffer size')
+    parser.add_argument('--rate', type=float, default=0, help='files/s fed to the writer, 0 = as fast as possible')
+    args = parser.parse_args()
+    # The engine opens database.db in the working directory
+    os.chdir(tempfile.mkdtemp())
+    asyncio.run(main(args))
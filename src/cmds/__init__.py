@@ -1,19 +1,45 @@
 import click
-from pillow_heif import register_heif_opener
 
-from src.hashers import enabled_hashers
+from src.hashers import decoded_hashers, enabled_hashers, video_hashtype
 
-from ..models import async_create_all, async_drop_all, engine
-from ..werkzeug.async2sync import await_
-from .run import cmd as run_cmd
+# Commands import their modules (SQLAlchemy, numba, image libraries) when they
+# run, so that `--help` and scripted calls of light commands start fast. See
+# `benchmarks/startup.py`.
 
-register_heif_opener()
+def shard_spec(ctx, param, value):
+    if value is None:
+        return None
+    index, _, count = value.partition('/')
+    if not (index.isdigit() and count.isdigit() and 1 <= int(index) <= int(count)):
+        raise click.BadParameter(f"{value!r}: expected i/N, 1 <= i <= N.")
+    return int(index), int(count)
+
+def use_database(shard=None):
+    '''Points the models at the `--database` file, or at its shard.'''
+    from .. import models
+
+    path = click.get_current_context().find_root().params['database']
+    models.use_database(models.shard_path(path, shard) if shard else path)
+    return models
+
+def io_limits(ctx, param, value):
+    from ..werkzeug.scheduler import parse
+
+    try:
+        return parse(value)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
 
 @click.group()
 @click.version_option()
 @click.option('-v', '--verbose',
               count=True,
               help='v = PROGRESS, vv = INFO, vvv = DEBUG',)
+@click.option('--database',
+              default='database.db',
+              help='SQLite database file',
+              type=click.Path(dir_okay=False),
+              show_default=True)
 def cli(*args, **kwargs):
     pass
 
@@ -35,22 +61,214 @@ def cli(*args, **kwargs):
               default=False,
               help='force reset database',
               show_default=True)
+@click.option('-t', '--tiered',
+              is_flag=True,
+              default=False,
+              help='only read in full the files whose size and head/tail digest collide',
+              show_default=True)
+@click.option('-p', '--preview',
+              is_flag=True,
+              default=False,
+              help='perceptual hashes from the embedded preview (EXIF/HEIF thumbnail) when it fits',
+              show_default=True)
+@click.option('--resume',
+              is_flag=True,
+              default=False,
+              help='continue the last interrupted scan, skipping its finished directories',
+              show_default=True)
+@click.option('--shard',
+              default=None,
+              help='only hash shard i of N of the files, into the database file '
+                   'DATABASE.i-of-N (see the merge command)',
+              callback=shard_spec,
+              metavar='i/N')
+@click.option('-w', '--workers',
+              default=0,
+              help='hash in N worker processes (0 = threads in this process)',
+              type=click.IntRange(min=0),
+              show_default=True)
+@click.option('--io',
+              multiple=True,
+              default=['auto'],
+              help='reads in flight per device, [PATH=]N or [PATH=]auto (tuned from '
+                   'read latency). PATH is any directory on the device, without it '
+                   'the limit applies to the other devices',
+              callback=io_limits,
+              show_default=True)
+@click.option('--cpu',
+              default=None,
+              help='hashes computed at once  [default: number of CPUs]',
+              type=click.IntRange(min=1))
+@click.option('-b', '--batch',
+              default=0,
+              help='files per commit (0 = adapt to the measured commit latency)',
+              type=click.IntRange(min=0),
+              show_default=True)
+@click.option('-l', '--max-latency',
+              default=2.0,
+              help='seconds a result may wait to be committed',
+              type=click.FloatRange(min=0),
+              show_default=True)
+@click.option('--metrics-json',
+              default=None,
+              help='write per-stage metrics to this JSON file',
+              type=click.Path(dir_okay=False, writable=True))
+@click.option('--metrics-prom',
+              default=None,
+              help='write per-stage metrics to this Prometheus textfile',
+              type=click.Path(dir_okay=False, writable=True))
+@click.option('--metrics-interval',
+              default=15.0,
+              help='seconds between metrics exports during the run',
+              type=click.FloatRange(min=1),
+              show_default=True)
 def run(**kwargs):
+    models = use_database(kwargs.get('shard'))
+    from ..werkzeug.async2sync import await_
+    from .run import cmd as run_cmd
+
     if kwargs.pop('reset', False):
-        await_(async_drop_all(engine))
+        from .export_index import remove
+
+        await_(models.async_drop_all(models.engine))
+        remove()
         click.echo('Dropped the database')
-    await_(async_create_all(engine))
+    await_(models.async_create_all(models.engine))
     run_cmd(**kwargs)
 
 @cli.command()
+@click.option('-d', '--directory',
+              multiple=True,
+              default=['.'],
+              help='directories to watch, with their subdirectories',
+              type=click.Path(exists=True, file_okay=False, readable=True,),
+              show_default=True)
+@click.option('-h', '--hash',
+              multiple=True,
+              default=['hashlib.md5', 'dhash.dhash'],
+              help='hash algorithms to use',
+              type=click.Choice(enabled_hashers.keys(), case_sensitive=False),
+              show_default=True)
+@click.option('-p', '--preview',
+              is_flag=True,
+              default=False,
+              help='perceptual hashes from the embedded preview (EXIF/HEIF thumbnail) when it fits',
+              show_default=True)
+@click.option('--debounce',
+              default=2.0,
+              help='seconds without events before a file is hashed',
+              type=click.FloatRange(min=0),
+              show_default=True)
+@click.option('--io',
+              multiple=True,
+              default=['auto'],
+              help='reads in flight per device, as for run',
+              callback=io_limits,
+              show_default=True)
+@click.option('--cpu',
+              default=None,
+              help='hashes computed at once  [default: number of CPUs]',
+              type=click.IntRange(min=1))
+@click.option('-l', '--max-latency',
+              default=1.0,
+              help='seconds a result may wait to be committed',
+              type=click.FloatRange(min=0),
+              show_default=True)
+def watch(**kwargs):
+    '''Hashes the files written or moved into the directories until
+    interrupted (Linux). Files already there are left to run.'''
+    models = use_database()
+    from ..werkzeug.async2sync import await_
+    from .watch import cmd as watch_cmd
+
+    await_(models.async_create_all(models.engine))
+    watch_cmd(**kwargs)
+
+@cli.command()
+@click.option('-h', '--hash',
+              default='dhash.dhash',
+              help='perceptual hash to compare, video.* for videos',
+              type=click.Choice(sorted(decoded_hashers | set(map(video_hashtype, decoded_hashers))),
+                                case_sensitive=False),
+              show_default=True)
+@click.option('-r', '--radius',
+              default=4,
+              help='maximum Hamming distance between duplicates (per frame for videos)',
+              type=click.IntRange(min=0),
+              show_default=True)
+@click.option('-o', '--output',
+              default='-',
+              help='JSON lines output, one duplicate group per line',
+              type=click.File('w'),
+              show_default=True)
 def cluster(**kwargs):
-    #cluster_cmd(**kwargs)
-    click.echo('Clustering')
+    use_database()
+    from .cluster import cmd as cluster_cmd
+
+    cluster_cmd(**kwargs)
+
+@cli.command()
+@click.argument('image',
+                type=click.Path(exists=True, dir_okay=False, readable=True))
+@click.option('-h', '--hash',
+              default='dhash.dhash',
+              help='perceptual hash to compare',
+              type=click.Choice(sorted(decoded_hashers), case_sensitive=False),
+              show_default=True)
+@click.option('-r', '--radius',
+              default=4,
+              help='maximum Hamming distance to IMAGE',
+              type=click.IntRange(min=0),
+              show_default=True)
+@click.option('-o', '--output',
+              default='-',
+              help='JSON lines output, one match per line',
+              type=click.File('w'),
+              show_default=True)
+def query(**kwargs):
+    use_database()
+    from .query import cmd as query_cmd
+
+    query_cmd(**kwargs)
 
 @cli.command()
 def dropdb(*args, **kwargs):
-    await_(async_drop_all(engine))
+    models = use_database()
+    from ..werkzeug.async2sync import await_
+    from .export_index import remove
+
+    await_(models.async_drop_all(models.engine))
+    remove()
     click.echo('Dropped the database')
 
+@cli.command('export-index')
+@click.option('-h', '--hash',
+              multiple=True,
+              help='hashtypes to snapshot  [default: every stored perceptual hash]',
+              type=click.Choice(sorted(decoded_hashers), case_sensitive=False))
+def export_index(**kwargs):
+    '''Snapshots the stored hashes for cluster and query, refreshed by run and merge.'''
+    use_database()
+    from .export_index import cmd as export_index_cmd
+
+    export_index_cmd(**kwargs)
+
+@cli.command()
+@click.argument('shards',
+                nargs=-1,
+                required=True,
+                type=click.Path(exists=True, dir_okay=False, readable=True))
+def merge(**kwargs):
+    '''Merges the database files SHARDS (e.g. of `run --shard`) into the database.'''
+    use_database()
+    from .merge import cmd as merge_cmd
+
+    merge_cmd(**kwargs)
+
 cli.add_command(run)
-cli.add_command(dropdb)
\ No newline at end of file
+cli.add_command(watch)
+cli.add_command(cluster)
+cli.add_command(query)
+cli.add_command(dropdb)
+cli.add_command(merge)
+cli.add_command(export_index)
\ No newline at end of file
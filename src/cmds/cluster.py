@@ -0,0 +1,61 @@
+"""
+Groups near-duplicate files out of the hashes stored by `run`, and writes one
+JSON line per group. Hashes are mapped from the snapshot of `export-index`
+when there is one, otherwise read from the database. Videos (`video.*`) are
+grouped by `src.werkzeug.sequences`, read from the database.
+"""
+
+from typing import IO, Iterator
+
+import numpy as np
+from orjson import dumps
+
+from src.cmds.export_index import directory
+from src.models import Files
+from src.werkzeug import sequences, snapshot
+from src.werkzeug.async2sync import await_
+from src.werkzeug.hash_values import to_words
+from src.werkzeug.union_find import cluster
+
+
+def groups(parent: np.ndarray) -> Iterator[np.ndarray]:
+    '''Yields the members of each group with more than one member, given the
+    compressed `parent` array returned by `cluster`.'''
+    order = np.argsort(parent, kind='stable')
+    bounds = np.flatnonzero(np.diff(parent[order])) + 1
+    start = 0
+    for stop in (*bounds, len(order)):
+        if stop - start > 1:
+            yield order[start:stop]
+        start = stop
+
+
+def cmd(*args, **kwargs):
+    hashtype = kwargs.get("hash", "dhash.dhash")
+    radius = kwargs.get("radius", 4)
+    output: IO = kwargs.get("output")
+
+    if hashtype.startswith("video."):
+        paths, values = await_(Files.get_hashes(hashtype))
+        shapes = dict(zip(*await_(Files.get_hashes("video"))))
+        durations, aspects, frames = zip(*(sequences.parse(shapes[path]) for path in paths)) \
+            if paths else ((), (), (0,))
+        parent = sequences.cluster_sequences(
+            values, np.array(durations, float), np.array(aspects, float), frames[0], radius)
+        members = groups(parent)
+    elif (mapped := snapshot.load(directory(), hashtype)) is not None:
+        parent = cluster(np.asarray(mapped.words), mapped.nbits, radius)
+        members = list(groups(parent))
+        # Only the paths of the grouped files are read
+        ids = mapped.files[np.concatenate(members)] if members else []
+        by_id = await_(Files.get_paths(np.unique(ids).tolist()))
+        paths = {i: by_id[int(mapped.files[i])] for group in members for i in group}
+    else:
+        paths, values = await_(Files.get_hashes(hashtype))
+        words, nbits = to_words(values)
+        parent = cluster(words, nbits, radius)
+        members = groups(parent)
+
+    for group in members:
+        line = {"hashtype": hashtype, "files": [paths[i] for i in group]}
+        output.write(dumps(line).decode("utf-8") + "\n")
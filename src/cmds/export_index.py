@@ -0,0 +1,66 @@
+"""
+Writes the hashes of each hashtype to a memory-mapped snapshot next to the
+database, and refreshes the existing snapshots after `run` and `merge`. See
+`src.werkzeug.snapshot`.
+"""
+import os
+import shutil
+from typing import Iterable, Optional
+
+import numpy as np
+from loguru import logger
+
+from src import models
+from src.hashers import decoded_hashers
+from src.models import Files, Hashes
+from src.werkzeug import snapshot
+from src.werkzeug.async2sync import await_
+
+
+def directory() -> str:
+    '''Snapshots directory of the current database, e.g. `database.index`.'''
+    return f"{os.path.splitext(models.engine.url.database)[0]}.index"
+
+
+def remove() -> None:
+    '''Removes the snapshots, once the database they were taken of is gone.'''
+    shutil.rmtree(directory(), ignore_errors=True)
+
+
+async def async_refresh(hashtypes: Optional[Iterable[str]] = None) -> None:
+    '''Brings the snapshots of `hashtypes` up to date with the database, the
+    existing ones if None. Only the values of links added since a snapshot
+    was written are read.'''
+    root = directory()
+    for hashtype in snapshot.stored(root) if hashtypes is None else hashtypes:
+        current = snapshot.load(root, hashtype) or snapshot.Snapshot.empty(hashtype)
+        links = np.array(await Files.get_links(hashtype), np.int64).reshape(-1, 2)
+        files, hashes = links[:, 0], links[:, 1]
+        added = current.missing(files, hashes)
+        removed = len(current) - (len(links) - int(added.sum()))
+        if not added.any() and not removed and os.path.exists(snapshot.path(root, hashtype)):
+            logger.info(f"Snapshot of {hashtype} is up to date, {len(current)} rows.")
+            continue
+
+        values = await Hashes.get_values(np.unique(hashes[added]).tolist())
+        updated = current.update(files, hashes, values)
+        os.makedirs(root, exist_ok=True)
+        updated.write(snapshot.path(root, hashtype))
+        logger.info(
+            f"Snapshot of {hashtype}: {len(updated)} rows, {int(added.sum())} added, "
+            f"{removed} removed."
+        )
+
+
+def refresh(hashtypes: Optional[Iterable[str]] = None) -> None:
+    '''Synchronous `async_refresh`.'''
+    await_(async_refresh(hashtypes))
+
+
+def cmd(*args, **kwargs):
+    logger.info("Initiating EXPORT-INDEX command")
+    hashtypes = kwargs.get("hash") or [
+        hashtype for hashtype in await_(Hashes.get_hashtypes())
+        if hashtype in decoded_hashers
+    ]
+    refresh(hashtypes)
@@ -0,0 +1,27 @@
+"""
+Merges databases written by `run --shard`, or by runs on other machines, into
+the database, see `src.models.merge`.
+"""
+import os
+
+from loguru import logger
+
+from src import models
+from src.cmds.export_index import refresh
+from src.models.merge import merge
+from src.werkzeug.async2sync import await_
+
+
+def cmd(*args, **kwargs):
+    logger.info("Initiating MERGE command")
+    shards = kwargs.get("shards", ())
+    # Read through the module, `use_database` rebinds it
+    target = os.path.abspath(models.engine.url.database)
+    if any(os.path.abspath(shard) == target for shard in shards):
+        raise SystemExit(f"Can't merge {target} into itself.")
+
+    await_(models.async_create_all(models.engine))
+    for shard in shards:
+        counts = await_(merge(shard))
+        logger.info(f"Merged {shard}: {counts}")
+    refresh()
@@ -0,0 +1,80 @@
+"""
+Looks up the stored files that are near-duplicates of an image, scanning the
+snapshot of `export-index` when there is one, otherwise probing the
+multi-index hashing tables instead of comparing against every stored hash.
+"""
+
+from typing import IO
+
+import numpy as np
+from orjson import dumps
+from sqlalchemy import select
+
+from src.cmds.export_index import directory
+from src.hashers import enabled_hashers
+from src.models import Files, Hashes, Session, association_table
+from src.models.mih import bands, mih_bands, neighbours
+from src.werkzeug import snapshot
+from src.werkzeug.async2sync import await_
+from src.werkzeug.hash_values import to_bytes
+
+
+async def lookup(hashtype: str, hashvalue: str, radius: int) -> list[tuple[int, str]]:
+    '''
+    Stored files whose `hashtype` hash is within `radius` bits of `hashvalue`.
+
+    Returns
+    -------
+        `(distance, path)` tuples, closest first.
+    '''
+    raw = to_bytes(hashtype, hashvalue)
+    query_bands = bands(hashtype, raw)
+    if query_bands is None:
+        raise ValueError(f"{hashtype} hashes are not indexed.")
+    target = int.from_bytes(raw, "big")
+    sub_radius = radius // len(query_bands)
+
+    matches = {}
+    async with Session.begin() as session:
+        for table, (value, width) in zip(mih_bands, query_bands):
+            query = select(Files.path, Hashes.hashvalue)\
+                .join_from(table, Hashes, table.c.hash_id == Hashes.id)\
+                .join(association_table)\
+                .join(Files)\
+                .filter(table.c.hashtype == hashtype)\
+                .filter(table.c.value.in_(list(neighbours(value, width, sub_radius))))
+            for row in await session.execute(query):
+                if row.path in matches:
+                    continue
+                stored = int.from_bytes(row.hashvalue, "big")
+                if (distance := (stored ^ target).bit_count()) <= radius:
+                    matches[row.path] = distance
+
+    return sorted((distance, path) for path, distance in matches.items())
+
+
+async def scan(
+    mapped: snapshot.Snapshot, hashvalue: str, radius: int
+) -> list[tuple[int, str]]:
+    '''`lookup` over a snapshot, every row compared.'''
+    rows, distances = mapped.within(to_bytes(mapped.hashtype, hashvalue), radius)
+    paths = await Files.get_paths(np.unique(mapped.files[rows]).tolist())
+    return sorted(
+        (int(distance), paths[int(mapped.files[row])])
+        for row, distance in zip(rows, distances)
+    )
+
+
+def cmd(*args, **kwargs):
+    hashtype = kwargs.get("hash", "dhash.dhash")
+    output: IO = kwargs.get("output")
+
+    _, hashvalue = enabled_hashers[hashtype](kwargs.get("image"))
+    radius = kwargs.get("radius", 4)
+    if (mapped := snapshot.load(directory(), hashtype)) is not None:
+        matches = await_(scan(mapped, hashvalue, radius))
+    else:
+        matches = await_(lookup(hashtype, hashvalue, radius))
+    for distance, path in matches:
+        line = {"path": path, "distance": distance}
+        output.write(dumps(line).decode("utf-8") + "\n")
@@ -3,53 +3,143 @@
 
 Sources:
 - https://loguru.readthedocs.io/en/stable/resources/recipes.html#interoperability-with-tqdm-iterations
-- https://github.com/uburuntu/throttler
 """
 
-import pathlib
-from asyncio import as_completed
+import multiprocessing
+import os
+import signal
+import stat
+import threading
+from asyncio import (FIRST_COMPLETED, Future, Queue, QueueFull, as_completed,
+                     create_task, current_task, gather, get_running_loop,
+                     new_event_loop, set_event_loop, sleep, wait)
+from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
 from functools import partial
-from typing import Callable, Dict, Iterable, Set, Tuple
+from itertools import chain
+from time import monotonic, perf_counter
+from typing import (AsyncIterable, Awaitable, Callable, Dict, Iterable, List,
+                    Optional, Set, Tuple)
 
 import aiofiles
 import aiofiles.os
 from loguru import logger
+from orjson import dumps
 from PIL import UnidentifiedImageError
-from throttler import throttle_simultaneous
 from tqdm.asyncio import tqdm
 
-from src.hashers import enabled_hashers
-from src.models import Files, Hashes
+from src.cmds.export_index import refresh
+from src.hashers import decoded_hashers, enabled_hashers, video_hashtype
+from src.hashers import hashlib as exact_hashers
+from src.hashers.decode import PREVIEW_HEAD, hash_decoded
+from src.models import Files, Scans
 from src.models.files import add_all
+from src.werkzeug import metrics
 from src.werkzeug.async2sync import async_, await_
-from src.werkzeug.dynamic_buffer import DynamicBuffer, StaticBuffer
+from src.werkzeug.checkpoint import Checkpoint
+from src.werkzeug.dynamic_buffer import AdaptiveBuffer, Buffer, StaticBuffer
 from src.werkzeug.filetype import filetype
+from src.werkzeug.hash_values import to_bytes
+from src.werkzeug.scheduler import Scheduler, device_name
+from src.werkzeug.walk import drain, scantree, walk
 
 logger.remove()
 logger.add(lambda msg: tqdm.write(msg, end=""), colorize=True)
 
+# Read and hashing limits of this process, set by `scan` or `_init_worker`
+_scheduler = Scheduler()
 
-@throttle_simultaneous(count=5)
-async def process(file: str, functions: tuple):
+
+def use_scheduler(scheduler: Optional[Scheduler] = None) -> Scheduler:
+    """Sets the limits `process` runs under, new defaults if None."""
+    global _scheduler
+    _scheduler = scheduler or Scheduler()
+    return _scheduler
+
+
+async def hashing(func: Callable, *args, **kwargs):
+    """Runs `func` in a thread once a hashing slot is free."""
+    async with _scheduler.hashing():
+        return await async_(func, *args, **kwargs)
+
+
+async def process(
+    file: str | os.DirEntry,
+    functions: tuple,
+    fmt: Optional[str] = None,
+    preview: bool = False,
+):
     """
     Returns fmt is supported or None and True if should count as file
 
     Args:
-        file (_type_): _description_
+        file (str | os.DirEntry): file path, or the entry yielded by `scantree`
+            whose cached stat spares an extra `stat` call
+        functions (tuple): `(algo, func)` pairs of the hashes to calculate
+        fmt (str, optional): filetype still known from the cache, not sniffed again
+        preview (bool): perceptual hashes from the embedded preview, if any. If
+            they are the only hashes, only the head of a JPEG is read
 
     Returns:
-        _type_: _description_
+        tuple: file path, its results and its `os.stat_result`. The `fmt`
+            result is None if the file type was not identified.
     """
     # Async check if is file
-    if not await aiofiles.os.path.isfile(file):
+    if isinstance(file, os.DirEntry):
+        st, file = await async_(file.stat), file.path
+    else:
+        st = await aiofiles.os.stat(file)
+    if not stat.S_ISREG(st.st_mode):
         raise RuntimeWarning(f"{file!s} skipped. Not a file.")
 
-    # Check if format is supported
-    result = {"fmt": await filetype.async_(file)}
-    is_supported = filetype.is_image(result.get("fmt", ""))
+    # Perceptual hashers share a single decode, digests a single pass over the
+    # content, the others (e.g. tiered stand-ins) run on their own
+    decoded = tuple(
+        (algo, func) for algo, func in functions if algo in decoded_hashers
+    )
+    digests = tuple(
+        name for _, func in functions if (name := exact_hashers.digested(func))
+    )
 
-    if is_supported:  # If supported, calculate hashes
-        subtasks = [async_(func, file) for _, func in functions]
+    # A single open: the header is sniffed and, for images to be decoded, read
+    # on. Digests alone stream the file from that same open file instead of
+    # holding it in memory.
+    head = PREVIEW_HEAD if preview and len(decoded) == len(functions) else 0
+    stream = partial(exact_hashers.digests, hashers=digests) if digests and not decoded else None
+    size = min(head or st.st_size, st.st_size) if decoded else st.st_size if stream else 0
+    async with _scheduler.read(st.st_dev, size):
+        fmt, data = await async_(filetype.read, file, st.st_size, fmt, bool(decoded), head, stream)
+    result = {"fmt": fmt}
+    if not fmt:
+        return str(file), result, st
+    if stream is not None:  # `data` holds the digests, if it is a media file
+        result.update(data or {})
+        data = None
+    is_supported = filetype.is_image(fmt)
+    is_video = filetype.is_video(fmt)  # Never read in memory, sampled by seeking
+    source = file if data is None else data
+    truncated = data is not None and len(data) < st.st_size
+
+    if is_supported or is_video:  # If supported, calculate hashes
+        subtasks = [
+            hashing(metrics.timed_call, f"hash:{algo}", func, source)
+            for algo, func in functions
+            if algo not in decoded_hashers and not exact_hashers.digested(func)
+        ]
+        if digests and decoded and data is None:  # Bound by the reads it streams
+            subtasks.append(streamed(st, exact_hashers.digests, source, digests))
+        elif digests and decoded:
+            subtasks.append(hashing(exact_hashers.digests, source, digests))
+        if decoded and is_video:
+            from src.hashers.video import hash_video  # OpenCV, once a video shows up
+
+            subtasks.append(decoding(st, hash_video, str(file), decoded))
+        elif decoded:
+            decode = partial(hash_decoded, source, decoded,
+                             preview=preview, fallback=str(file) if truncated else None)
+            # Images not in memory (or only their head) are read by the decoder
+            subtasks.append(decoding(st, decode) if data is None or truncated else hashing(decode))
 
         tqdm_subtasks = tqdm(
             total=len(subtasks),
@@ -58,34 +148,278 @@ async def process(file: str, functions: tuple):
             disable=len(subtasks) > 1,  # Disable tqdm if only one hash to be calculated
         )
         for t in as_completed(subtasks):
-            k, v = await t
-            result[k] = v
+            value = await t
+            result.update(value if isinstance(value, dict) else (value,))
             tqdm_subtasks.update()
         tqdm_subtasks.close()
 
-    return str(file), result
+    return str(file), result, st
+
+
+async def streamed(st: os.stat_result, func: Callable, *args):
+    """Runs `func`, reading the whole file of `st`, in a thread once a read
+    slot of its device is free."""
+    async with _scheduler.read(st.st_dev, st.st_size):
+        return await async_(func, *args)
+
+
+async def decoding(st: os.stat_result, func: Callable, *args, **kwargs):
+    """Runs `func`, which reads the file of `st` by its path while it decodes
+    it, in a thread once both a read slot of its device and a hashing slot are
+    free. The read is not timed, decoding would pass for a slow device."""
+    async with _scheduler.read(st.st_dev, st.st_size, timed=False):
+        async with _scheduler.hashing():
+            return await async_(func, *args, **kwargs)
+
+
+# Event loop owned by each pool worker, reused across chunks
+_worker_loop = None
+
+
+def _init_worker(scheduler: Scheduler) -> None:
+    global _worker_loop, _scheduler
+    metrics.REGISTRY.reset()
+    _scheduler = scheduler
+    # Ctrl-C stops the scan in the parent, which lets the chunks in flight end
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_loop = new_event_loop()
+    set_event_loop(_worker_loop)
+
+
+async def _process_many(chunk: list, preview: bool = False) -> list:
+    return await gather(
+        *(
+            process(
+                file,
+                tuple((algo, func or enabled_hashers[algo]) for algo, func in algos),
+                fmt,
+                preview,
+            )
+            for file, algos, fmt in chunk
+        ),
+        return_exceptions=True,
+    )
+
+
+def process_chunk(chunk: list, preview: bool = False) -> Tuple[list, dict]:
+    """
+    Pool worker entry point. Runs `process` over a chunk of files.
+
+    Hashers are looked up in the worker's own `enabled_hashers`, only the ones
+    replaced by the caller (e.g. tiered exact-match stand-ins) travel pickled.
+    `preview` is passed on to `process`.
+
+    Returns
+    -------
+        A list with `process` results or raised exceptions, in chunk order, and
+    the metrics recorded by the worker meanwhile.
+    """
+    results = _worker_loop.run_until_complete(_process_many(chunk, preview))
+    return results, metrics.REGISTRY.snapshot(reset=True)
+
+
+async def _chunk_result(future: Future, index: int):
+    result = (await future)[0][index]
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+
+def _pickable(functions: Set[Tuple[str, Callable]]) -> Tuple:
+    """Replaces hashers available in the workers' registry by `None`."""
+    return tuple(
+        (algo, None if func is enabled_hashers.get(algo) else func)
+        for algo, func in functions
+    )
+
+
+async def consume(
+    entries: Queue,
+    outcomes: Queue,
+    pending: Callable[[os.DirEntry], Awaitable[Tuple[Set[Tuple[str, Callable]], Optional[str]]]],
+    preview: bool = False,
+    checkpoint: Optional[Checkpoint] = None,
+    stop: Optional[threading.Event] = None,
+) -> None:
+    """
+    Consumer of the directory walk. Processes one entry at a time until a `None`
+    is read, or `stop` is set, and puts every finished task on `outcomes`,
+    ending with a `None`. Files with nothing to do, or that failed, are
+    finished in `checkpoint` here, the others once their record is committed.
+    """
+    try:
+        while not (stop and stop.is_set()) and (entry := await entries.get()) is not None:
+            functions, fmt = await pending(entry)
+            if functions:
+                task = create_task(process(entry, functions, fmt, preview))
+                await wait((task,))
+                await outcomes.put(task)
+                if not task.exception():
+                    continue
+            if checkpoint:
+                checkpoint.finish(entry.path)
+    finally:
+        # Tell drain() this consumer is done, unless the scan is being torn down
+        if not current_task().cancelling():
+            await outcomes.put(None)
+
+
+async def consume_pooled(
+    entries: Queue,
+    outcomes: Queue,
+    pending: Callable[[os.DirEntry], Awaitable[Tuple[Set[Tuple[str, Callable]], Optional[str]]]],
+    executor: Executor,
+    chunksize: int = 64,
+    preview: bool = False,
+    checkpoint: Optional[Checkpoint] = None,
+    stop: Optional[threading.Event] = None,
+) -> None:
+    """
+    Like `consume`, but submits chunks of `chunksize` entries to `executor`
+    (see `process_chunk`) and puts one awaitable per file once the chunk is done.
+    """
+    loop = get_running_loop()
+    finished = False
+    try:
+        while not finished:
+            chunk = []
+            while len(chunk) < chunksize:
+                if (stop and stop.is_set()) or (entry := await entries.get()) is None:
+                    finished = True
+                    break
+                functions, fmt = await pending(entry)
+                if functions:
+                    chunk.append((entry.path, _pickable(functions), fmt))
+                elif checkpoint:
+                    checkpoint.finish(entry.path)
+            if chunk:
+                future = loop.run_in_executor(executor, process_chunk, chunk, preview)
+                await wait((future,))
+                if not future.exception():
+                    metrics.REGISTRY.merge(future.result()[1])
+                for index, (path, _, _) in enumerate(chunk):
+                    await outcomes.put(_chunk_result(future, index))
+                    failed = future.exception() or isinstance(future.result()[0][index], BaseException)
+                    if checkpoint and failed:
+                        checkpoint.finish(path)
+    finally:
+        # Tell drain() this consumer is done, unless the scan is being torn down
+        if not current_task().cancelling():
+            await outcomes.put(None)
+
+
+async def write(
+    records: Queue,
+    buffer: Buffer,
+    progress: Optional[tqdm] = None,
+    checkpoint: Optional[Checkpoint] = None,
+) -> int:
+    '''
+    Group-commits the file records put on `records` until it gets a None.
+
+    A group is committed when it reaches `buffer.next()` records, or when its
+    first record waited `buffer.interval` seconds. Records already waiting are
+    always taken, up to the flush size. The commit latency, group size and
+    queue depth are reported back to `buffer`, which picks the next flush size.
+
+    The directories `checkpoint` found done are committed with the group, or
+    on their own after `buffer.interval` seconds when no record comes. Files
+    of a committed group are finished in `checkpoint`.
+
+    Parameters
+    ----------
+    records : Queue
+        bounded queue of records, as described in `src.models.files.upsert`. A
+    full queue blocks `gather_and_save`, and through it the hashing stage.
+    buffer : Buffer
+        the flush policy.
+    progress : tqdm, optional
+        progress bar of the saved files.
+    checkpoint : Checkpoint, optional
+        done directories of the scan.
+
+    Returns
+    -------
+        the number of records committed.
+    '''
+    saved = 0
+    getter = None
+    finished = False
+    try:
+        while not finished:
+            batch, deadline = [], None
+            while len(batch) < buffer.next():
+                if getter is None:
+                    getter = create_task(records.get())
+                if deadline is None and checkpoint and checkpoint.completed:
+                    deadline = monotonic() + buffer.interval
+                # The getter survives timeouts, so no record is lost in between
+                timeout = None if deadline is None else max(deadline - monotonic(), 0)
+                done, _ = await wait({getter}, timeout=timeout)
+                if not done:
+                    break
+                record, getter = getter.result(), None
+                if record is None:
+                    finished = True
+                    break
+                batch.append(record)
+                if deadline is None:
+                    deadline = monotonic() + buffer.interval
+            directories = checkpoint.flush() if checkpoint else []
+            if directories and not batch:
+                await add_all([], (checkpoint.scan, directories))
+            if not batch:
+                continue
+
+            depth = records.qsize()
+            start = perf_counter()
+            await add_all(batch, (checkpoint.scan, directories) if checkpoint else None)
+            latency = perf_counter() - start
+            if checkpoint:
+                for record in batch:
+                    checkpoint.finish(record["path"])
+            buffer.update(len(batch), latency, depth)
+            metrics.observe("commit", latency)
+            metrics.count("commit.rows", len(batch))
+            metrics.gauge("queue.records", depth)
+            logger.debug(f"{len(batch)} files saved to db.")
+            saved += len(batch)
+            if progress is not None:
+                progress.update(len(batch))
+        # Directories the last group completed
+        if checkpoint and (directories := checkpoint.flush()):
+            await add_all([], (checkpoint.scan, directories))
+    finally:
+        if getter is not None:
+            getter.cancel()
+    return saved
 
 
 async def gather_and_save(
-    tasks: list,
-    maximum_buffer: int = 200,
-    enable_dynamic_buffer: bool = True,
+    tasks: AsyncIterable[Awaitable],
+    batch: int = 0,
+    max_latency: float = 2.0,
+    maxsize: int = 4096,
+    checkpoint: Optional[Checkpoint] = None,
 ) -> Tuple[int, int, int, int]:
     '''
-    This function takes a list of tasks, processes them asynchronously, and saves
-    the results to a database with a buffer to speed up interactions.
+    This function takes a stream of tasks, awaits them as they arrive, and hands
+    the results to a background `write` task that saves them to the database.
 
     Parameters
     ----------
-    tasks : list
-        A list of coroutines (async functions) that will be executed concurrently using
-    asyncio.as_completed().
-    maximum_buffer : int, optional
-        The maximum number of files to buffer before writing them to the database.
-    enable_dynamic_buffer : bool, optional
-        A boolean flag that determines whether to use a dynamic buffer or a static
-    buffer to speed up database interactions. If set to True, a DynamicBuffer object
-    will be used, otherwise a StaticBuffer object will be used.
+    tasks : AsyncIterable[Awaitable]
+        An asynchronous iterable of finished (or about to finish) awaitables, each
+    resolving to what `process` returns, as produced by the consumers of `scan`.
+    batch : int, optional
+        Number of files per commit. If 0, an `AdaptiveBuffer` fits it to the
+    measured commit latency, otherwise a `StaticBuffer` is used.
+    max_latency : float, optional
+        Maximum number of seconds a result waits for its group to be committed.
+    maxsize : int, optional
+        Number of results waiting for the writer before hashing is held back.
+    checkpoint : Checkpoint, optional
+        Done directories of the scan, committed by the writer.
 
     Returns
     -------
@@ -93,115 +427,521 @@ async def gather_and_save(
 
     '''
 
+    ok_files = 0
     n_unsupported = 0
     n_errors = 0
     n_directories = 0
 
-    # Buffer to speed up db interactions
+    # Flush policy of the writer
     buffer = (
-        DynamicBuffer(maximum_buffer)
-        if enable_dynamic_buffer
-        else StaticBuffer(maximum_buffer)
+        StaticBuffer(batch, max_latency)
+        if batch
+        else AdaptiveBuffer(max_latency=max_latency, maximum=maxsize)
     )
 
-    sql_add_buffer = []
-
     # total_cache = await Files.total_cached()
     # initial= total_cache,
     tqdm_ = partial(tqdm, leave=False)
-    tqdm_tasks = tqdm_(desc="Files", total=len(tasks),)
-    tqdm_buffer = tqdm_(desc="Buffer", total=buffer.next())
+    tqdm_tasks = tqdm_(desc="Files")
+    tqdm_saved = tqdm_(desc="Saved")
 
-    for coro in as_completed(tasks):
-        logger.info(
-            f"Processing file {tqdm_buffer.n+1} out of {tqdm_buffer.total} files on buffer."
-        )
+    records = Queue(maxsize)
+    writer = create_task(write(records, buffer, tqdm_saved, checkpoint))
+    stalled = 0.0
+
+    async def put(record):
+        nonlocal stalled
         try:
-            file, results = await coro
-        except UnidentifiedImageError as exc:
-            n_unsupported += 1
-            logger.warning(f"Format not supported. {str(exc)}")
-        except OSError as exc:
-            n_errors += 1
-            logger.warning(f"Error reading file. {str(exc)}")
-        except RuntimeWarning as exc:
-            n_directories += 1
-            logger.warning(f"Not a file. Skipping. {str(exc)}")
-        else:
-            hashes = [
-                Hashes(hashtype=algo, hashvalue=value)
-                for algo, value in results.items()
-            ]
-            if fmt := results.get("fmt", None):
-                sql_add_buffer.append(Files(path=file, filetype=fmt, hashes=hashes))
+            records.put_nowait(record)
+            return
+        except QueueFull:
+            pass
+        # Backpressure: wait for the writer, unless it failed
+        start = perf_counter()
+        putter = create_task(records.put(record))
+        await wait({putter, writer}, return_when=FIRST_COMPLETED)
+        stalled += perf_counter() - start
+        if not putter.done():
+            putter.cancel()
+            writer.result()
+
+    try:
+        async for coro in tasks:
+            try:
+                file, results, st = await coro
+            except UnidentifiedImageError as exc:
+                n_unsupported += 1
+                metrics.count("files.unsupported")
+                logger.warning(f"Format not supported. {str(exc)}")
+            except OSError as exc:
+                n_errors += 1
+                metrics.count("files.errors")
+                logger.warning(f"Error reading file. {str(exc)}")
+            except RuntimeWarning as exc:
+                n_directories += 1
+                metrics.count("files.skipped")
+                logger.warning(f"Not a file. Skipping. {str(exc)}")
             else:
-                await Files.update_hashes(file, hashes)
-            tqdm_buffer.update()
-            tqdm_tasks.update()
+                # A None value drops the stored hash, e.g. the `preview` source
+                record = {
+                    "path": file,
+                    "hashes": {
+                        algo: None if value is None else to_bytes(algo, value)
+                        for algo, value in results.items()
+                    },
+                }
+                # Without a format the file is stored already, only hashes are added
+                if "fmt" in results:
+                    record.update(
+                        filetype=results["fmt"],
+                        size=st.st_size,
+                        mtime_ns=st.st_mtime_ns,
+                        inode=st.st_ino,
+                        device=st.st_dev,
+                    )
+                await put(record)
+                if "fmt" in results and results["fmt"] is None:
+                    # Stored without hashes all the same, so it is not sniffed again
+                    n_unsupported += 1
+                    metrics.count("files.unsupported")
+                    logger.warning(f"Format not supported. {file!s} format not identified.")
+                    continue
+                ok_files += 1
+                metrics.count("files.ok")
+                tqdm_tasks.update()
+
+        await put(None)
+        await writer
+    finally:
+        writer.cancel()
+        tqdm_saved.close()
+        tqdm_tasks.close()
+
+    summary = buffer.summary()
+    summary["backpressure_seconds"] = stalled
+    logger.info(f"Writer: {summary}")
+    for decision in buffer.history:
+        logger.debug(f"Writer decision: {decision}")
 
-        # Persist results
-        if tqdm_buffer.n >= tqdm_buffer.total:
-            await add_all(sql_add_buffer)
-            logger.debug(f"{tqdm_buffer.total} files saved to db.")
-            tqdm_buffer.reset(buffer.next())
+    return ok_files, n_unsupported, n_directories, n_errors
 
-    tqdm_buffer.close()
-    tqdm_tasks.close()
 
-    ok_files = len(tasks) - n_unsupported - n_directories - n_errors
-
-    return ok_files, n_unsupported, n_directories, n_errors
+# Work left for the files being walked: `{path: ({hashtype, ...}, filetype,
+# {hashtype stored as a tier key, ...})}`, filled a chunk at a time by `lookup`
+# and emptied by `plan`
+Plans = Dict[str, Tuple[Set[str], Optional[str], Set[str]]]
 
 
 def filter_cached(
-    files_iter: Iterable,
+    file: str,
+    missing: Set[str],
     enabled_hash: Dict[str, Callable],
-    cached_items: Set[Tuple[str, str]],
+    unique: Optional[Dict[str, str]] = None,
     **kwargs,
-) -> Dict[str, Tuple[str, Callable]]:
+) -> Set[Tuple[str, Callable]]:
     """
-    The function filters a list of files based on their hash values and returns a
-    dictionary of files with their corresponding hash algorithms and functions.
+    The function filters the hash algorithms still to be calculated for a file
+    and returns them along with their functions.
 
     Parameters
     ----------
-    files_iter : Iterable
-        an iterable of file paths
+    file : str
+        a file path
+    missing : Set[str]
+        Hashtypes missing or stale for `file`, as found by `lookup`.
     enabled_hash : Dict[str, Callable]
         A dictionary containing the names of hash algorithms as keys and their
     corresponding hash functions as values. These hash functions are used to
     calculate the hash of a file.
-    cached_items : Set[Tuple[str, str]]
-        A set of tuples representing cached items. Each tuple contains a filename and a
-    hash algorithm used to generate the hash value for the file.
+    unique : Dict[str, str], optional
+        Tier keys from `resolve_unique`. Files found there get `hashlib.*`
+    functions replaced by a stand-in returning the key.
 
     Returns
     -------
-        The function `filter_cached` returns a dictionary where the keys are the files
-    in the `files_iter` iterable and the values are tuples of the hash algorithm and
-    hash function for each enabled hash algorithm that has not been cached for that
-    file (i.e. the `(file, algo)` tuple is not in the `cached_items` set). The
-    `kwargs` argument is used to filter out any arguments
+        The function `filter_cached` returns a set of tuples of the hash algorithm
+    and hash function for each enabled hash algorithm in `missing`. An empty set
+    means there is nothing left to do for `file`.
 
     """
     # # Remove kwargs unrelated to hash function
     # TODO: store kwargs related to hash function
     # TODO: register hash functions arguments on cli
-    # kw = {
-    #     k: v
-    #     for k, v in kwargs.items()
-    #     if k not in ('directory', 'hash')
-    # }
+    key = unique.get(file) if unique else None
     return {
-        file: {
-            (algo, func)
-            for algo, func in enabled_hash.items()
-            if (file, algo) not in cached_items
-        }
-        for file in files_iter
+        (algo, partial(exact_hashers.resolved, hasher=algo.split(".", 1)[1], value=key))
+        if key and algo.startswith("hashlib.")
+        else (algo, func)
+        for algo, func in enabled_hash.items()
+        if algo in missing
     }
 
 
+async def lookup(
+    entries: List[os.DirEntry],
+    hashtypes: Iterable[str],
+    plans: Plans,
+    preview: bool = False,
+) -> None:
+    """
+    Stats `entries` and asks the database what is left to do for each of them,
+    into `plans`. Stored hashes are only trusted while the stored stat matches
+    the current one, so files do not need to be opened, and a trusted file
+    keeps its stored filetype, so `process` does not sniff it again.
+
+    A file renamed since the last run (same inode, size and mtime stored under
+    a path that no longer exists) is moved in the database first, so its hashes
+    follow it and are not recalculated.
+
+    Parameters
+    ----------
+    entries : List[os.DirEntry]
+        a chunk of the walk, see `walk`.
+    hashtypes : Iterable[str]
+        enabled hash algorithms.
+    plans : Plans
+        filled with the entries' work, read by `plan`.
+    preview : bool, optional
+        Whether perceptual hashes taken from embedded previews will do. If not,
+    they are calculated again from the image.
+    """
+    def stat_all():
+        stats = {}
+        for entry in entries:
+            try:
+                stats[entry.path] = metrics.timed_call("stat", entry.stat)
+            except OSError:
+                stats[entry.path] = None  # process() will report it
+        return stats
+
+    stats = await async_(stat_all)
+    known = [
+        (path, st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+        for path, st in stats.items() if st is not None
+    ]
+    moved = set()
+    for path, old in await Files.get_renamed(known):
+        if old not in moved and not await aiofiles.os.path.exists(old):
+            await Files.move(old, path)
+            moved.add(old)
+            logger.info(f"{old} moved to {path}.")
+
+    hashtypes = list(hashtypes)
+    missing = await Files.get_missing(known, [
+        (algo, video_hashtype(algo), algo in decoded_hashers and not preview)
+        for algo in hashtypes
+    ])
+    for path, st in stats.items():
+        plans[path] = missing.get(path, (set(), None, set())) if st else \
+            (set(hashtypes), None, set())
+
+
+async def plan(
+    entry: os.DirEntry,
+    enabled_hash: Dict[str, Callable],
+    plans: Plans,
+    unique: Optional[Dict[str, str]] = None,
+    preview: bool = False,
+) -> Tuple[Set[Tuple[str, Callable]], Optional[str]]:
+    """
+    Returns what `filter_cached` says is left to do for `entry`, along with its
+    filetype when the database still knows it. Entries not looked up in a chunk
+    by the walk are looked up alone.
+
+    A digest stored as a tier key (see `resolve_unique`) is only kept while the
+    file is still proven unique by `unique`: once a file of the same size shows
+    up, or on a run that is not tiered, the file is digested in full.
+    """
+    if entry.path not in plans:
+        await lookup([entry], enabled_hash, plans, preview)
+    missing, fmt, keyed = plans.pop(entry.path)
+    if unique and entry.path in unique:
+        missing = missing - keyed
+    return filter_cached(entry.path, missing, enabled_hash, unique), fmt
+
+
+async def resolve_unique(
+    files: Iterable[os.DirEntry],
+    hasher: str = "md5",
+    block: int = 65536,
+) -> Tuple[Dict[str, str], Dict[str, Tuple[Tuple[int, int, int, int], Set[str]]]]:
+    """
+    Tiered exact-match pre-pass. Files are bucketed by `st_size`, size
+    collisions get a cheap head/tail digest and only files still colliding
+    after that are left for the full `hashlib` digest. A size shared with a
+    stored file outside `files` is a collision too, left for the full digest.
+
+    Parameters
+    ----------
+    files : Iterable[os.DirEntry]
+        entries waiting for at least one `hashlib.*` hash.
+    hasher : str, optional
+        `hashlib` algorithm used for the partial digest.
+    block : int, optional
+        bytes read from each end of a file for the partial digest.
+
+    Returns
+    -------
+        A dictionary mapping every file proven to have no exact duplicate in
+    `files` or in the database to its tier key (`size:<bytes>` or
+    `partial:<bytes>:<digest>`). Files absent from the dictionary still need
+    the full digest, and so do files whose stored digest is a tier key, see
+    `plan`. Then the stored files outside `files` that share a size with one of
+    them but only store a tier key, with their stored stat and the `hashlib.*`
+    hashtypes to digest, see `digest_stored`.
+
+    """
+    by_size = defaultdict(list)
+    stats = []
+    for entry in files:
+        try:
+            st = await async_(entry.stat)
+        except OSError:
+            continue  # process() will report it
+        if stat.S_ISREG(st.st_mode):
+            by_size[st.st_size].append(entry.path)
+            stats.append((entry.path, st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev))
+
+    shared = set()
+    keyed = {}
+    for path, stored_stat, hashtype in await Files.get_sized(stats):
+        shared.add(stored_stat[0])
+        if hashtype is not None:
+            keyed.setdefault(path, (stored_stat, set()))[1].add(hashtype)
+
+    unique = {}
+    collisions = []
+    for size, group in by_size.items():
+        if size in shared:  # The stored file is not read, digested in full
+            continue
+        if len(group) == 1:
+            unique[group[0]] = f"size:{size}"
+        elif size > 2 * block:  # Smaller files cost the same to read in full
+            collisions.extend((size, file) for file in group)
+    logger.info(
+        f"{len(unique)} files with unique size, "
+        f"{len(collisions)} need a partial digest, "
+        f"{len(keyed)} stored files need a full one."
+    )
+
+    digests = await gather(
+        *(
+            async_(exact_hashers.partial_digest, file, size, hasher, block)
+            for size, file in collisions
+        ),
+        return_exceptions=True,
+    )
+    by_partial = defaultdict(list)
+    for (size, file), digest in zip(collisions, digests):
+        if not isinstance(digest, BaseException):
+            by_partial[(size, digest)].append(file)
+
+    for (size, digest), group in by_partial.items():
+        if len(group) == 1:
+            unique[group[0]] = f"partial:{size}:{digest}"
+
+    return unique, keyed
+
+
+async def digest_stored(keyed: Dict[str, Tuple[Tuple[int, int, int, int], Set[str]]]) -> None:
+    """
+    Replaces the tier keys of stored files by their full digests, once a file
+    of the same size shows up in a tiered run that does not walk them (see
+    `resolve_unique`). Files modified or gone since they were stored are left
+    to the run that walks them.
+    """
+    for path, (stored_stat, hashtypes) in keyed.items():
+        try:
+            st = await aiofiles.os.stat(path)
+        except OSError:
+            continue
+        if (st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev) != stored_stat:
+            continue
+        names = [hashtype.split(".", 1)[1] for hashtype in hashtypes]
+        try:
+            digests = await streamed(st, exact_hashers.digests, path, names)
+        except (OSError, ValueError) as exc:  # ValueError: not a hashlib algorithm here
+            logger.warning(f"Error reading file. {str(exc)}")
+            continue
+        await Files.update_hashes(path, {
+            hashtype: to_bytes(hashtype, value) for hashtype, value in digests.items()
+        })
+
+
+async def scan(
+    directories: Iterable[str],
+    enabled_hash: Dict[str, Callable],
+    tiered: bool = False,
+    preview: bool = False,
+    scheduler: Optional[Scheduler] = None,
+    checkpoint: Optional[Checkpoint] = None,
+    shard: Optional[Tuple[int, int]] = None,
+    stop: Optional[threading.Event] = None,
+    executor: Optional[Executor] = None,
+    consumers: Optional[int] = None,
+    chunksize: int = 64,
+    metrics_json: Optional[str] = None,
+    metrics_prom: Optional[str] = None,
+    metrics_interval: float = 15.0,
+    **kwargs,
+) -> Tuple[int, int, int, int]:
+    """
+    Walks `directories` and streams their files through a bounded queue to a
+    fixed pool of `consumers`, whose results are saved by `gather_and_save`.
+    Memory is proportional to the number of consumers, not to the tree size.
+
+    Directories on the same device share a walk, a queue and consumers, those
+    on other devices get their own, so a slow device never holds back the
+    files of a fast one. Reads and hashing are limited by `scheduler`.
+
+    SIGINT and SIGTERM set `stop`: files in progress are finished and every
+    result is committed, but no other file is started. A second signal has
+    its default effect.
+
+    Parameters
+    ----------
+    enabled_hash : Dict[str, Callable]
+        Hash algorithms, only those missing for a file are calculated, see
+    `lookup`.
+    tiered : bool, optional
+        Run `resolve_unique` first. Size buckets need the whole tree, so this
+    mode lists it upfront.
+    preview : bool, optional
+        Perceptual hashes from embedded previews, see `src.hashers.decode`.
+    scheduler : Scheduler, optional
+        Read limits by device and hashing limit of this process. Pool workers
+    get theirs from `_init_worker`.
+    checkpoint : Checkpoint, optional
+        Done directories of the scan. Those of a resumed scan are not listed.
+    shard : Tuple[int, int], optional
+        `(i, n)`, only hash the files of shard `i` of `n`, see `in_shard`.
+    stop : threading.Event, optional
+        Set to stop the scan early, as the signals do.
+    executor : Executor, optional
+        Process pool for `consume_pooled`, hashing happens in-process if None.
+    consumers : int, optional
+        Number of consumers per device. By default as many as the reads the
+    device may have in flight.
+    chunksize : int, optional
+        Files per chunk submitted to `executor`.
+    metrics_json, metrics_prom : str, optional
+        Files the metrics are written to, as JSON and as a Prometheus textfile,
+    every `metrics_interval` seconds and at the end.
+    **kwargs
+        `batch` and `max_latency`, passed to `gather_and_save`.
+
+    Returns
+    -------
+        The same tuple as `gather_and_save`.
+    """
+    scheduler = use_scheduler(scheduler)
+
+    roots = defaultdict(list)
+    for directory in directories:
+        roots[(await aiofiles.os.stat(directory)).st_dev].append(directory)
+    sources = {
+        dev: chain.from_iterable(scantree(d, checkpoint, shard) for d in group)
+        for dev, group in roots.items()
+    }
+
+    # Skip full reads of files that cannot have an exact duplicate
+    unique = {}
+    if tiered:
+        # Cached files are bucketed too, a new file may share their size
+        sources = {dev: await async_(list, source) for dev, source in sources.items()}
+        listed = chain.from_iterable(sources.values())
+        # And so are those of done directories and other shards
+        if (checkpoint and checkpoint.done) or shard:
+            listed = await async_(list, chain.from_iterable(scantree(d) for d in directories))
+        unique, keyed = await resolve_unique(listed)
+        # Stored files out of the walk that a file of this run may duplicate
+        await digest_stored(keyed)
+
+    # Looked up in the database a walk chunk at a time
+    plans = {}
+    prepare = partial(lookup, hashtypes=enabled_hash, plans=plans, preview=preview)
+    pending = partial(
+        plan,
+        enabled_hash=enabled_hash,
+        plans=plans,
+        unique=unique,
+        preview=preview,
+    )
+    stop = stop or threading.Event()
+    if executor:
+        consumer = partial(consume_pooled, executor=executor, chunksize=chunksize,
+                           preview=preview, checkpoint=checkpoint, stop=stop)
+        per_consumer = chunksize
+    else:
+        consumer = partial(consume, preview=preview, checkpoint=checkpoint, stop=stop)
+        per_consumer = 2
+    counts = {dev: consumers or scheduler.reads(dev) for dev in sources}
+    total = sum(counts.values())
+    # Threads for every consumer's blocking call and every hashing slot
+    get_running_loop().set_default_executor(
+        ThreadPoolExecutor(total + scheduler.cpu.limit, thread_name_prefix="scan")
+    )
+
+    outcomes = Queue(total * per_consumer)
+    queues = {"outcomes": outcomes}
+    tasks = []
+    for dev, source in sources.items():
+        entries = queues[f"entries.{device_name(dev)}"] = Queue(counts[dev] * per_consumer)
+        tasks.append(create_task(walk(source, entries, sentinels=counts[dev], stop=stop,
+                                      prepare=prepare)))
+        tasks.extend(
+            create_task(consumer(entries, outcomes, pending)) for _ in range(counts[dev])
+        )
+    tasks.append(create_task(report(
+        queues, metrics_json, metrics_prom, metrics_interval,
+    )))
+
+    loop = get_running_loop()
+    signals = (signal.SIGINT, signal.SIGTERM)
+
+    def interrupt():
+        logger.warning("Stopping: finishing the files in progress, signal again to abort.")
+        stop.set()
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+
+    for signum in signals:
+        loop.add_signal_handler(signum, interrupt)
+    try:
+        return await gather_and_save(drain(outcomes, total), checkpoint=checkpoint, **kwargs)
+    finally:
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+        for task in tasks:
+            task.cancel()
+        await gather(*tasks, return_exceptions=True)
+        await async_(metrics.REGISTRY.export, metrics_json, metrics_prom)
+        if scheduler.devices:  # Pool workers hold their own
+            logger.info(f"Scheduler: {scheduler.summary()}")
+        for device in scheduler.devices.values():
+            for decision in device.history:
+                logger.debug(f"Read limit decision: {decision}")
+
+
+async def report(
+    queues: Dict[str, Queue],
+    json_path: Optional[str] = None,
+    prom_path: Optional[str] = None,
+    interval: float = 15.0,
+    sample: float = 1.0,
+) -> None:
+    """Samples the depth of `queues` every `sample` seconds and exports the
+    metrics every `interval` seconds, until cancelled."""
+    exported = monotonic()
+    while True:
+        await sleep(sample)
+        for name, queue in queues.items():
+            metrics.gauge(f"queue.{name}", queue.qsize())
+        if (json_path or prom_path) and monotonic() - exported >= interval:
+            await async_(metrics.REGISTRY.export, json_path, prom_path)
+            exported = monotonic()
+
+
 def cmd(*args, **kwargs):
     logger.info("Initiating RUN command")
     logger.info(f"{args}\n{kwargs}")
@@ -209,18 +949,64 @@ def cmd(*args, **kwargs):
     # Prepare functions to run hashes
     enabled_hash = {v: enabled_hashers[v] for v in kwargs.get("hash", ())}
 
-    # Prepare list of files to process
-    directories = kwargs.get("directory", ())
-    files_iter = (str(p) for v in directories for p in pathlib.Path(v).iterdir())
-
-    # Remove already processed files/hashes
-    cached_items = await_(Files.get_cached_items())
-    pending_files = filter_cached(files_iter, enabled_hash, cached_items, **kwargs)
-
-    # Creating tasks to be awaited
-    tasks = [process(file, algos) for file, algos in pending_files.items()]
+    # A scan is resumable with the same directories and hashes
+    settings = dumps({
+        "directories": sorted(os.path.abspath(d) for d in kwargs.get("directory", ())),
+        "hashes": sorted(enabled_hash),
+        "preview": bool(kwargs.get("preview")),
+        "shard": kwargs.get("shard"),
+    }).decode()
+    try:
+        scan_id, done, resumed = await_(Scans.start(settings, kwargs.get("resume", False)))
+    except ValueError as exc:
+        raise SystemExit(f"Can't resume. {exc}")
+    if resumed:
+        logger.info(f"Resuming scan {scan_id}, {len(done)} directories done.")
+    elif kwargs.get("resume"):
+        logger.info("No interrupted scan to resume, starting over.")
+    checkpoint, stop = Checkpoint(scan_id, done), threading.Event()
+
+    default, devices = kwargs.get("io") or (None, {})
+    scheduler = Scheduler(default, devices, cpu=kwargs.get("cpu"))
+
+    workers = kwargs.get("workers", 0)
+    # Workers start from a fresh server process: forked from this one, which
+    # already runs the walk, writer and SQLite threads, they could inherit a
+    # lock held at fork time
+    executor = (
+        ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_init_worker, initargs=(scheduler.split(workers),)
+        )
+        if workers
+        else nullcontext()
+    )
+    with executor:
+        ok_files, n_unsupported, n_directories, n_errors = await_(
+            scan(
+                kwargs.get("directory", ()),
+                enabled_hash,
+                tiered=kwargs.get("tiered", False),
+                preview=kwargs.get("preview", False),
+                scheduler=scheduler,
+                checkpoint=checkpoint,
+                shard=kwargs.get("shard"),
+                stop=stop,
+                executor=executor if workers else None,
+                consumers=2 * workers if workers else None,
+                batch=kwargs.get("batch", 0),
+                max_latency=kwargs.get("max_latency", 2.0),
+                metrics_json=kwargs.get("metrics_json"),
+                metrics_prom=kwargs.get("metrics_prom"),
+                metrics_interval=kwargs.get("metrics_interval", 15.0),
+            )
+        )
 
-    ok_files, n_unsupported, n_directories, n_errors = await_(gather_and_save(tasks))
+    if stop.is_set() and not all(map(checkpoint.skip, kwargs.get("directory", ()))):
+        logger.warning("Scan stopped. Run it again with --resume to continue.")
+    else:
+        await_(Scans.finish(scan_id))
+    refresh()  # Snapshots taken by export-index
 
     logger.info(
         f"{ok_files} unique files processed (\
@@ -228,3 +1014,10 @@ def cmd(*args, **kwargs):
           {n_directories} diretories skipped, \
           {n_errors} file access failed)"
     )
+    stages = metrics.REGISTRY.summary()["stages"]
+    logger.info(
+        "Stages: " + ", ".join(
+            f"{stage} {v['count']}x {1000 * v['mean']:.2f}ms (p99 {1000 * v['p99']:.2f}ms)"
+            for stage, v in stages.items()
+        )
+    )
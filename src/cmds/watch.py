@@ -0,0 +1,257 @@
+"""
+Keeps the database up to date with directories as files land in them, from
+inotify events instead of walks (Linux only).
+
+The events of a file are debounced: it is hashed once no event came for it for
+`debounce` seconds, so a file written in several steps, or written under a
+temporary name and renamed by a sync tool, is hashed once, at its final path.
+The ready files of a directory are picked from one `os.scandir` of it and go
+through the lookup, the consumers and the writer of `run` (see
+`src.cmds.run.scan`): cached files are skipped, renamed ones moved in the
+database, results are group-committed within `max_latency` seconds, which is
+shorter than `debounce`, so a file hashed then moved is found by its inode.
+
+New directories are watched in turn, and their files queued. If the kernel
+queue overflows, events were lost and every directory is listed again, the
+only time the tree is walked.
+"""
+import os
+import signal
+from asyncio import (Event, Queue, TimeoutError, create_task, gather, get_running_loop, sleep,
+                     wait_for)
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from loguru import logger
+
+from src.cmds.export_index import async_refresh, directory
+from src.cmds.run import consume, gather_and_save, lookup, plan, use_scheduler
+from src.hashers import enabled_hashers
+from src.werkzeug import metrics, snapshot
+from src.werkzeug.async2sync import async_, await_
+from src.werkzeug.inotify import (IN_CLOSE_WRITE, IN_CREATE, IN_DELETE_SELF, IN_MOVED_FROM,
+                                  IN_MOVED_TO, IN_Q_OVERFLOW, Event as Change, Inotify,
+                                  watch_tree)
+from src.werkzeug.scheduler import Scheduler
+from src.werkzeug.walk import drain
+
+
+class Watcher:
+    """
+    Watches of the `roots` trees and the files waiting out `debounce`.
+
+    Parameters
+    ----------
+    roots : Iterable[str]
+        directories watched with everything under them.
+    debounce : float, optional
+        seconds without events before a file is ready.
+    """
+
+    def __init__(self, roots: Iterable[str], debounce: float = 2.0) -> None:
+        self.roots = list(roots)
+        self.debounce = debounce
+        self.inotify = Inotify()
+        self.pending: Dict[str, float] = {}
+
+    def start(self) -> None:
+        '''Watches the roots. Files already there are left to `run`.'''
+        for root in self.roots:
+            watch_tree(self.inotify, root)
+        logger.info(f"Watching {len(self.inotify.watches)} directories.")
+
+    def handle(self, changes: List[Change]) -> None:
+        now = monotonic()
+        for change in changes:
+            if change.mask & IN_Q_OVERFLOW:
+                logger.warning("Events were lost, listing every directory again.")
+                for root in self.roots:
+                    self.touch(watch_tree(self.inotify, root), now)
+            elif change.mask & IN_DELETE_SELF:
+                if change.path in self.roots:
+                    logger.warning(f"{change.path} was removed, it is no longer watched.")
+            elif change.is_dir:
+                if change.mask & IN_MOVED_FROM:  # Out of the tree, or back in below
+                    self.inotify.remove(change.path)
+                elif change.mask & (IN_CREATE | IN_MOVED_TO):
+                    self.touch(watch_tree(self.inotify, change.path), now)
+            elif change.mask & IN_MOVED_FROM:
+                self.pending.pop(change.path, None)
+            elif change.mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.touch([change.path], now)
+
+    def touch(self, paths: Iterable[str], now: float) -> None:
+        for path in paths:
+            self.pending[path] = now
+
+    def ready(self, everything: bool = False) -> Dict[str, List[str]]:
+        '''Takes the files past their debounce (or all of them), by directory.'''
+        deadline = monotonic() - self.debounce
+        ready = defaultdict(list)
+        for path, last in list(self.pending.items()):
+            if everything or last <= deadline:
+                del self.pending[path]
+                ready[os.path.dirname(path)].append(os.path.basename(path))
+        return ready
+
+
+def pick(directory: str, names: List[str]) -> List[os.DirEntry]:
+    '''Entries of the files `names` still in `directory`.'''
+    names = set(names)
+    try:
+        with os.scandir(directory) as it:
+            return [
+                entry for entry in it
+                if entry.name in names and not entry.is_dir(follow_symlinks=False)
+            ]
+    except OSError:
+        return []  # Gone since, with its files
+
+
+async def feed(
+    watcher: Watcher,
+    entries: Queue,
+    consumers: int,
+    stop: Event,
+    prepare: Optional[Callable[[List[os.DirEntry]], Awaitable[None]]] = None,
+) -> None:
+    '''Reads the events, queues the ready files until `stop` is set, then
+    every pending file and a `None` per consumer. The ready files of a
+    directory are passed to `prepare` first, as `walk` does.'''
+    loop = get_running_loop()
+    changed = Event()
+    loop.add_reader(watcher.inotify.fileno(), changed.set)
+    try:
+        while True:
+            try:
+                await wait_for(changed.wait(), max(watcher.debounce / 4, 0.05))
+            except TimeoutError:
+                pass
+            changed.clear()
+            while changes := watcher.inotify.read():
+                await async_(watcher.handle, changes)
+            for parent, names in watcher.ready(stop.is_set()).items():
+                picked = await async_(pick, parent, names)
+                if prepare and picked:
+                    await prepare(picked)
+                for entry in picked:
+                    await entries.put(entry)
+            if stop.is_set():
+                break
+    finally:
+        loop.remove_reader(watcher.inotify.fileno())
+        watcher.inotify.close()
+        for _ in range(consumers):
+            await entries.put(None)
+
+
+async def refresh_snapshots(interval: float) -> None:
+    '''Refreshes the snapshots of `export-index` every `interval` seconds,
+    when files were committed meanwhile, until cancelled.'''
+    committed = 0
+    while True:
+        await sleep(interval)
+        rows = metrics.REGISTRY.counters.get("commit.rows", 0)
+        if rows != committed and snapshot.stored(directory()):
+            await async_refresh()
+        committed = rows
+
+
+async def watch(
+    directories: Iterable[str],
+    enabled_hash: Dict[str, Callable],
+    preview: bool = False,
+    debounce: float = 2.0,
+    scheduler: Optional[Scheduler] = None,
+    snapshot_interval: float = 10.0,
+    **kwargs,
+) -> tuple:
+    """
+    Hashes the files that land in `directories` until SIGINT or SIGTERM. The
+    pending files are then hashed and committed, a second signal has its
+    default effect.
+
+    Parameters
+    ----------
+    enabled_hash : Dict[str, Callable]
+        Hash algorithms, only those missing for a file are calculated, see
+    `lookup`.
+    debounce : float, optional
+        Seconds without events before a file is hashed.
+    scheduler : Scheduler, optional
+        Read limits by device and hashing limit.
+    snapshot_interval : float, optional
+        Seconds between refreshes of the snapshots, if any.
+    **kwargs
+        `batch` and `max_latency`, passed to `gather_and_save`.
+
+    Returns
+    -------
+        The same tuple as `gather_and_save`.
+    """
+    scheduler = use_scheduler(scheduler)
+    watcher = Watcher(directories, debounce)
+    await async_(watcher.start)
+
+    devices = {os.stat(d).st_dev for d in watcher.roots}
+    consumers = max(scheduler.reads(dev) for dev in devices)
+    get_running_loop().set_default_executor(
+        ThreadPoolExecutor(consumers + scheduler.cpu.limit + 2, thread_name_prefix="watch")
+    )
+
+    plans = {}
+    prepare = partial(lookup, hashtypes=enabled_hash, plans=plans, preview=preview)
+    pending = partial(plan, enabled_hash=enabled_hash, plans=plans, preview=preview)
+    entries, outcomes, stop = Queue(2 * consumers), Queue(2 * consumers), Event()
+    tasks = [create_task(feed(watcher, entries, consumers, stop, prepare))]
+    tasks.extend(
+        create_task(consume(entries, outcomes, pending, preview)) for _ in range(consumers)
+    )
+    refresher = create_task(refresh_snapshots(snapshot_interval))
+
+    loop = get_running_loop()
+    signals = (signal.SIGINT, signal.SIGTERM)
+
+    def interrupt():
+        logger.warning("Stopping: hashing the pending files, signal again to abort.")
+        stop.set()
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+
+    for signum in signals:
+        loop.add_signal_handler(signum, interrupt)
+    try:
+        return await gather_and_save(drain(outcomes, consumers), **kwargs)
+    finally:
+        for signum in signals:
+            loop.remove_signal_handler(signum)
+        refresher.cancel()
+        for task in tasks:
+            task.cancel()
+        await gather(refresher, *tasks, return_exceptions=True)
+
+
+def cmd(*args, **kwargs):
+    logger.info("Initiating WATCH command")
+    enabled_hash = {v: enabled_hashers[v] for v in kwargs.get("hash", ())}
+    default, devices = kwargs.get("io") or (None, {})
+
+    ok_files, n_unsupported, n_directories, n_errors = await_(
+        watch(
+            [os.path.normpath(d) for d in kwargs.get("directory", ())],
+            enabled_hash,
+            preview=kwargs.get("preview", False),
+            debounce=kwargs.get("debounce", 2.0),
+            scheduler=Scheduler(default, devices, cpu=kwargs.get("cpu")),
+            batch=kwargs.get("batch", 0),
+            max_latency=kwargs.get("max_latency", 1.0),
+        )
+    )
+    await_(async_refresh())
+    logger.info(
+        f"{ok_files} files processed ({n_unsupported} unsupported files, "
+        f"{n_directories} skipped, {n_errors} file access failed)"
+    )
@@ -1,15 +1,58 @@
 # type: ignore
-import src.hashers.hashlib as hashlib
-import src.hashers.dhash as dhash
-import src.hashers.perception as perception
-
-enabled_hashers = {
-    'dhash.dhash': dhash.dhash,
-    'perception.AverageHash': perception.AverageHash,
-    'perception.PHash': perception.PHash,
-    'perception.WaveletHash': perception.WaveletHash,
-    'perception.MarrHildreth': perception.MarrHildreth,
-    'perception.BlockMean': perception.BlockMean,
-    'perception.DHash': perception.DHash,
-    'hashlib.md5': hashlib.md5,
-}
\ No newline at end of file
+"""
+Hash algorithms by name.
+
+`enabled_hashers` resolves a hasher on first lookup: the module behind it,
+and OpenCV, SciPy or numba behind that, is only imported once a command
+actually hashes with it. Listing the names (e.g. for `--help`) imports none.
+"""
+from importlib import import_module
+from typing import Callable, Dict, Iterator, Mapping, Tuple
+
+
+class Hashers(Mapping):
+    '''Read-only mapping of hasher names to functions, given as
+    `(module, attribute)` pairs and imported on first lookup.'''
+
+    def __init__(self, locations: Dict[str, Tuple[str, str]]) -> None:
+        self.locations = locations
+        self.loaded: Dict[str, Callable] = {}
+
+    def __getitem__(self, name: str) -> Callable:
+        if (func := self.loaded.get(name)) is None:
+            module, attribute = self.locations[name]
+            func = self.loaded[name] = getattr(import_module(module), attribute)
+        return func
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.locations)
+
+    def __len__(self) -> int:
+        return len(self.locations)
+
+
+enabled_hashers = Hashers({
+    'dhash.dhash': ('src.hashers.dhash', 'dhash'),
+    'perception.AverageHash': ('src.hashers.perception', 'AverageHash'),
+    'perception.PHash': ('src.hashers.perception', 'PHash'),
+    'perception.WaveletHash': ('src.hashers.perception', 'WaveletHash'),
+    'perception.MarrHildreth': ('src.hashers.perception', 'MarrHildreth'),
+    'perception.BlockMean': ('src.hashers.perception', 'BlockMean'),
+    'perception.DHash': ('src.hashers.perception', 'DHash'),
+    'hashlib.md5': ('src.hashers.hashlib', 'md5'),
+    'hashlib.sha1': ('src.hashers.hashlib', 'sha1'),
+    'hashlib.sha256': ('src.hashers.hashlib', 'sha256'),
+    'hashlib.blake2b': ('src.hashers.hashlib', 'blake2b'),
+})
+
+# Hashers fed by the shared decode stage in `src.hashers.decode`
+decoded_hashers = {
+    k for k in enabled_hashers
+    if k.startswith(('dhash.', 'perception.'))
+}
+
+
+def video_hashtype(hashtype: str) -> str:
+    '''Hashtype a video is stored under for `hashtype`: perceptual hashes of
+    videos are sequences of frame hashes, see `src.hashers.video`.'''
+    return f'video.{hashtype}' if hashtype in decoded_hashers else hashtype
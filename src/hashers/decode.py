@@ -0,0 +1,220 @@
+"""
+Shared decode stage for perceptual hashers.
+
+Every perceptual hasher used to open and decode the image by itself. Here the
+file is decoded once per size the hashers need and each hasher receives a
+`Decoded` image, taking from it only the representation it needs.
+
+Hashers only look at a thumbnail (dhash at 9x8, PHash at 32x32), so JPEG
+images are decoded at reduced resolution, through the DCT scaling of
+`Image.draft`, down to no less than `MARGIN` times the working resolution of
+each hasher. Their output stays the same within a few bits, see
+`benchmarks/decode.py`. The resolution is the hasher's own, never the largest
+of the hashers run along, so a hash does not depend on the `-h` options of the
+run that stored it. Hashers whose resolutions come to the same DCT scale share
+a decode. Reducing other formats after a full decode (e.g. `Image.reduce`)
+saves little and moves the hashes further, so they are not, and their hashers
+all share the full decode.
+
+With `preview`, hashers run on the preview embedded by cameras and phones
+(EXIF thumbnail of a JPEG, thumbnail item of a HEIF) when it is big enough for
+each of them and has the aspect ratio of the image, a letterboxed thumbnail
+does not. Otherwise the image is decoded as usual. The source of the hashes is
+returned as the `preview` pseudo hash. A JPEG thumbnail lives in its first
+segments, so the first `PREVIEW_HEAD` bytes of the file are enough to find it.
+
+Sources:
+- [Image.draft](https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.draft)
+- [EXIF 2.32](https://www.cipa.jp/std/documents/e/DC-008-Translation-2019-E.pdf):
+    IFD1 and its JPEGInterchangeFormat tags.
+"""
+from functools import cached_property
+from io import BytesIO
+from typing import Any, Callable, Iterable, Optional
+
+import numpy as np
+from PIL import ExifTags
+from PIL.Image import Image
+from PIL.Image import \
+    open  # PIL chosen due to vast image format support and lazy-loading.
+from pillow_heif import register_heif_opener
+
+from src.werkzeug import metrics
+
+# HEIF files open through PIL like any other format
+register_heif_opener()
+
+# Side, in pixels, of the image each hasher resizes its input to. None for the
+# hashers whose output depends on the input resolution (WaveletHash scale)
+RESOLUTION = {
+    'dhash.dhash': 9,
+    'perception.AverageHash': 8,
+    'perception.DHash': 9,
+    'perception.PHash': 32,
+    'perception.BlockMean': 256,
+    'perception.MarrHildreth': 512,
+    'perception.WaveletHash': None,
+}
+MARGIN = 4
+
+PREVIEW = 'preview'
+PREVIEW_HEAD = 256 * 1024
+# Relative difference of aspect ratio tolerated between a preview and its image
+ASPECT = 0.02
+# IFD1 offset and length of the EXIF thumbnail
+JPEG_OFFSET, JPEG_LENGTH = 0x0201, 0x0202
+
+
+class Decoded:
+    '''A decoded image and the derived representations hashers ask for. Each
+    representation is computed on first use and then shared.'''
+
+    def __init__(self, image: Image, source: Optional[str] = None) -> None:
+        self.image = image
+        self.source = source  # Embedded preview decoded instead of the image
+
+    @cached_property
+    def rgb(self) -> Image:
+        return self.image if self.image.mode == 'RGB' else self.image.convert('RGB')
+
+    @cached_property
+    def gray(self) -> Image:
+        return self.image if self.image.mode == 'L' else self.rgb.convert('L')
+
+    @cached_property
+    def array(self) -> np.ndarray:
+        '''RGB `uint8` array, the input format expected by `perception`.'''
+        return np.asarray(self.rgb)
+
+
+def resolution(hashtypes: Iterable[str], margin: int = MARGIN) -> Optional[int]:
+    '''Shorter side an image may be decoded at for all of `hashtypes`, None
+    for full resolution.'''
+    sides = [RESOLUTION.get(hashtype) for hashtype in hashtypes]
+    if not sides or None in sides:
+        return None
+    return margin * max(sides)
+
+
+def _draft(filepath: str | bytes, size: Optional[int] = None) -> Image:
+    im = open(filepath if isinstance(filepath, str) else BytesIO(filepath))
+    if size and im.format == 'JPEG':
+        im.draft('RGB', (size, size))  # Sets the size it will be decoded at
+    return im
+
+
+def _load(im: Image) -> Decoded:
+    im.load()  # Single read and decode, the file is released afterwards
+    return Decoded(im if im.mode in ('RGB', 'L') else im.convert('RGB'))
+
+
+def decode(filepath: str | bytes, size: Optional[int] = None) -> Decoded:
+    '''Decodes `filepath`, a JPEG with its shorter side scaled down to no less
+    than `size` pixels if given.'''
+    return _load(_draft(filepath, size))
+
+
+def decode_each(filepath: str | bytes, hashtypes: Iterable[str]) -> dict[str, Decoded]:
+    '''Decodes `filepath` for each of `hashtypes` at its own `resolution`, once
+    per distinct size the image comes to.'''
+    images: dict[tuple, Decoded] = {}
+    decoded = {}
+    for hashtype in hashtypes:
+        im = _draft(filepath, resolution([hashtype]))
+        key = (im.size, im.mode)
+        if key in images:
+            im.close()
+        else:
+            images[key] = _load(im)
+        decoded[hashtype] = images[key]
+    return decoded
+
+
+def _exif_thumbnail(im: Image) -> Optional[Image]:
+    ifd = im.getexif().get_ifd(ExifTags.IFD.IFD1)
+    offset, length = ifd.get(JPEG_OFFSET), ifd.get(JPEG_LENGTH)
+    exif = im.info.get('exif', b'')
+    if not offset or not length:
+        return None
+    # Offsets count from the TIFF header, after the APP1 `Exif` identifier
+    start = offset + (6 if exif.startswith(b'Exif\x00\x00') else 0)
+    if start + length > len(exif):
+        return None
+    return open(BytesIO(exif[start:start + length]))
+
+
+def decode_preview(filepath: str | bytes, size: int) -> Optional[Decoded]:
+    '''Decodes the embedded preview of `filepath`, if it has one with its
+    shorter side no less than `size` pixels and the aspect ratio of the image.'''
+    try:
+        im = open(filepath if isinstance(filepath, str) else BytesIO(filepath))
+        width, height = im.size
+        if im.format == 'JPEG':
+            thumbnail, source = _exif_thumbnail(im), 'exif'
+        elif im.format == 'HEIF':
+            # pillow-heif picks the smallest thumbnail item scaled from the image
+            thumbnail, source = (im if im.draft('RGB', (size, size)) else None), 'heif'
+        else:
+            return None
+        if thumbnail is None or min(thumbnail.size) < size:
+            return None
+        t_width, t_height = thumbnail.size
+        if abs(t_width * height - t_height * width) > ASPECT * t_height * width:
+            return None
+        thumbnail.load()
+    except (OSError, SyntaxError, ValueError, EOFError):
+        return None
+    if thumbnail.mode not in ('RGB', 'L'):
+        thumbnail = thumbnail.convert('RGB')
+    return Decoded(thumbnail, source)
+
+
+def hash_decoded(
+    filepath: str | bytes,
+    functions: Iterable[tuple[str, Callable]],
+    *args: list[Any],
+    preview: bool = False,
+    fallback: Optional[str] = None,
+    **kwargs: dict[Any, Any]
+) -> dict[str, Optional[str]]:
+    '''Decodes `filepath`, once per size its hashers need (see `decode_each`),
+    and runs every perceptual hasher on it.
+
+    Parameters
+    ----------
+    filepath : str | bytes
+        path of the image to be hashed, or its content.
+    functions : Iterable[tuple[str, Callable]]
+        `(algo, func)` pairs, as in `enabled_hashers`, accepting a `Decoded`.
+    preview : bool, optional
+        hash the embedded preview, if there is a suitable one.
+    fallback : str, optional
+        path of the image when `filepath` is only its first bytes, decoded when
+    there is no preview.
+
+    Returns
+    -------
+        a dictionary of hash type to hash value, with the source of the hashes
+    under `PREVIEW` (None if no hasher ran on a preview).
+    '''
+    functions = tuple(functions)
+    with metrics.timed("decode"):
+        images = {}
+        if preview:
+            previews: dict[int, Optional[Decoded]] = {}
+            for algo, _ in functions:
+                if (size := resolution([algo], margin=1)) is None:
+                    continue
+                if size not in previews:
+                    previews[size] = decode_preview(filepath, size)
+                if previews[size] is not None:
+                    images[algo] = previews[size]
+            metrics.count("preview.hits" if images else "preview.misses")
+        if rest := [algo for algo, _ in functions if algo not in images]:
+            images.update(decode_each(fallback or filepath, rest))
+    results = dict(
+        metrics.timed_call(f"hash:{algo}", func, images[algo], *args, **kwargs)
+        for algo, func in functions
+    )
+    results[PREVIEW] = next((image.source for image in images.values() if image.source), None)
+    return results
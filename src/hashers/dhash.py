@@ -1,25 +1,25 @@
 from typing import Any
 
 from dhash import dhash_row_col, format_hex
-from PIL.Image import \
-    open  # PIL chosen due to vast image format support and lazy-loading.
 
+from src.hashers.decode import Decoded, decode, resolution
 from src.werkzeug.return_functions import function_call_to_str
 
 
 def dhash(
-    filepath: str,
+    image: str | bytes | Decoded,
     *args: list,
     **kwargs: dict
 ) -> tuple[bytes | str, str]:
-    '''The function takes a file path, generates a hash value using dhash algorithm,
-    and returns the hash value along with function name, file path, and arguments as
+    '''The function takes a file path or a decoded image, generates a hash value
+    using dhash algorithm, and returns the hash value along with function name, file path, and arguments as
     a JSON string.
 
     Parameters
     ----------
-    filepath : str
-        A string representing the file path of the image to be processed.
+    image : str | bytes | Decoded
+        The file path of the image to be processed, its content, or the image
+    already decoded by `src.hashers.decode`.
     *args : list[Any]
         - `filepath`: a string representing the path to an image file
     **kwargs : dict[Any, Any]
@@ -40,8 +40,9 @@ def dhash(
         for k in (dhash_kwargs.keys() & kwargs.keys())
     }
 
-    with open(filepath) as im:
-        row, col = dhash_row_col(im, **intersect_kwargs)
-        hash_value = format_hex(row, col, **intersect_kwargs)
+    if not isinstance(image, Decoded):
+        image = decode(image, resolution(['dhash.dhash']))
+    row, col = dhash_row_col(image.gray, **intersect_kwargs)
+    hash_value = format_hex(row, col, **intersect_kwargs)
 
-        return f'dhash.dhash', hash_value
\ No newline at end of file
+    return f'dhash.dhash', hash_value
\ No newline at end of file
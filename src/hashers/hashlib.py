@@ -1,27 +1,137 @@
 import sys
 from functools import partial
-from hashlib import algorithms_available, file_digest
-from typing import Any
+from hashlib import algorithms_available, new
+from time import perf_counter
+from typing import Any, BinaryIO, Callable, Iterable, Optional
 
-from orjson import dumps
+from src.werkzeug import metrics
+from src.werkzeug.filetype import DONTNEED, SEQUENTIAL, advise
+
+BLOCK = 1024 * 1024
+
+
+def digests(
+    filepath: str | bytes | BinaryIO,
+    hashers: Iterable[str],
+    block: int = BLOCK,
+) -> dict[str, str]:
+    '''Digests of a file by several `hashlib` algorithms, in a single pass.
+
+    Each block is fed to every digest while it is still in the CPU caches, and
+    the file is read once whatever the number of algorithms.
+
+    Parameters
+    ----------
+    filepath : str | bytes | BinaryIO
+        path of the file to be digested, its content already read, or the file
+        already open (e.g. by `filetype.read`), read on from where it is.
+    hashers : Iterable[str]
+        `hashlib` algorithm names.
+    block : int, optional
+        bytes fed to the digests at a time.
+
+    Returns
+    -------
+        a dictionary of hash type (`hashlib.<name>`) to hexdigest.
+    '''
+    objects = {hasher: new(hasher) for hasher in hashers}
+    elapsed = dict.fromkeys(objects, 0.0)
+
+    def update(chunk: memoryview) -> None:
+        for hasher, digest in objects.items():
+            start = perf_counter()
+            digest.update(chunk)
+            elapsed[hasher] += perf_counter() - start
+
+    def feed(file: BinaryIO) -> None:
+        view = memoryview(bytearray(block))
+        while n := file.readinto(view):
+            update(view[:n])
+
+    if isinstance(filepath, str):
+        with open(filepath, 'rb', buffering=0) as file:
+            advise(file, SEQUENTIAL)
+            feed(file)
+            advise(file, DONTNEED)
+    elif isinstance(filepath, (bytes, bytearray, memoryview)):
+        view = memoryview(filepath)
+        for offset in range(0, len(view), block):
+            update(view[offset:offset + block])
+    else:
+        feed(filepath)
+    for hasher, seconds in elapsed.items():
+        metrics.observe(f'hash:hashlib.{hasher}', seconds)
+    return {f'hashlib.{hasher}': digest.hexdigest() for hasher, digest in objects.items()}
 
 
 def wrapper(
+    filepath: str | bytes,
+    hasher: str,
+    block: int = BLOCK,
+    *args: list[Any],
+    **kwargs: dict[Any, Any]
+) -> tuple[str, str]:
+    return next(iter(digests(filepath, (hasher,), block).items()))
+
+
+def digested(func: Callable) -> Optional[str]:
+    '''Algorithm name of `func` if it is one of the `wrapper`s of this module,
+    which `digests` can run together.'''
+    if isinstance(func, partial) and func.func is wrapper:
+        return func.keywords.get('hasher')
+    return None
+
+
+def partial_digest(
+    filepath: str,
+    size: int,
+    hasher: str = 'md5',
+    block: int = 65536,
+) -> str:
+    '''Cheap digest over the first and last `block` bytes of a file.
+
+    Used by the tiered exact-match mode to split size collisions before paying
+    for a full read. Files no bigger than two blocks are not worth the split and
+    should go straight to `wrapper`.
+
+    Parameters
+    ----------
+    filepath : str
+        path of the file to be digested.
+    size : int
+        file size in bytes, as already known from `stat`.
+    hasher : str, optional
+        `hashlib` algorithm name.
+    block : int, optional
+        number of bytes read from each end of the file.
+
+    Returns
+    -------
+        hexdigest of head and tail blocks.
+    '''
+    digest = new(hasher)
+    with open(filepath, 'rb', buffering=0) as file:
+        digest.update(file.read(block))
+        file.seek(size - block)
+        digest.update(file.read(block))
+    return digest.hexdigest()
+
+
+def resolved(
     filepath: str,
     hasher: str,
-    buffering: int = 65536,
+    value: str,
     *args: list[Any],
     **kwargs: dict[Any, Any]
 ) -> tuple[str, str]:
-    with open(filepath, 'rb', buffering=buffering) as file:
-        hash_value = file_digest(file, hasher).hexdigest()
-    func_hash = f'hashlib.{hasher}'
-    str_func_hash = dumps(func_hash).decode('utf-8')
-    return str_func_hash, hash_value
+    '''Stand-in for `wrapper` when the tiered pre-pass already proved the file
+    has no exact duplicate. `value` is the tier key (`size:...` or
+    `partial:...`), never a real digest, so it cannot collide with one.'''
+    return f'hashlib.{hasher}', value
 
 # This code block is dynamically creating new functions based on the functions
 # defined in the `hashers` module.
 thismodule = sys.modules[__name__]
 for fn in algorithms_available:
     new_function = partial(wrapper, hasher = fn)
-    setattr(thismodule, fn, new_function)
\ No newline at end of file
+    setattr(thismodule, fn, new_function)
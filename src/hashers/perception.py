@@ -3,19 +3,21 @@ from functools import partial
 from typing import Any
 
 import perception.hashers
-from orjson import dumps
+
+from src.hashers.decode import Decoded, decode, resolution
 
 
 def wrapper(
-    filepath: str,
-    hasher: perception.hashers.Hasher,
+    image: str | bytes | Decoded,
+    hasher: type[perception.hashers.ImageHasher],
     *args: list[Any],
     **kwargs: dict[Any, Any]
 ) -> tuple[str, str]:
-    hash_value = hasher.compute(filepath)
-    func_hash  = f'perception.{hasher.__name__}'
-    str_func_hash = dumps(func_hash).decode('utf-8')
-    return str_func_hash, hash_value
+    hashtype = f'perception.{hasher.__name__}'
+    if not isinstance(image, Decoded):
+        image = decode(image, resolution([hashtype]))
+    hash_value = hasher().compute(image.array)
+    return hashtype, hash_value
 
 # This code block is dynamically creating new functions based on the functions
 # defined in the `hashers` module.
@@ -23,4 +25,4 @@ thismodule = sys.modules[__name__]
 for fn in perception.hashers.__all__:
     old_function = getattr(perception.hashers, fn)
     new_function = partial(wrapper, hasher = old_function)
-    setattr(thismodule, fn, new_function)
\ No newline at end of file
+    setattr(thismodule, fn, new_function)
@@ -0,0 +1,123 @@
+"""
+Perceptual hashes of videos, from a few frames sampled by seeking.
+
+A video is never decoded as a whole: OpenCV seeks to `FRAMES` evenly spaced
+timestamps, the middles of equal slices of its duration, and decodes the frame
+there, starting from the keyframe before it. Each frame goes through the image
+hashers as a `Decoded` image, scaled down to the `resolution` of each hasher
+like a JPEG would be, and the hashes of a hasher are stored in timestamp
+order, as one value, under `video_hashtype(hashtype)`. The duration, frame
+size and number of frames are stored under the `VIDEO` pseudo hash, so
+`cluster` only compares videos of about the same duration and shape.
+
+Sources:
+- [VideoCapture](https://docs.opencv.org/4.x/d8/dfe/classcv_1_1VideoCapture.html)
+"""
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import cv2
+from PIL import Image, UnidentifiedImageError
+
+from src.hashers import video_hashtype
+from src.hashers.decode import Decoded, resolution
+from src.werkzeug import metrics
+from src.werkzeug.hash_values import to_bytes
+
+FRAMES = 8
+VIDEO = 'video'
+
+
+def sample(
+    filepath: str,
+    frames: int = FRAMES,
+    sizes: Iterable[Optional[int]] = (None,),
+) -> Tuple[float, Tuple[int, int], Dict[Optional[int], List[Decoded]]]:
+    '''Seeks to `frames` evenly spaced timestamps of the video `filepath` and
+    decodes a frame at each. A frame that can't be decoded is replaced by the
+    nearest one that could, so there are always `frames` of them.
+
+    Parameters
+    ----------
+    filepath : str
+        path of the video.
+    frames : int, optional
+        number of frames sampled.
+    sizes : Iterable[Optional[int]], optional
+        shorter sides the frames are scaled down to, if larger, None for the
+    frames as decoded.
+
+    Returns
+    -------
+        the duration in seconds, the `(width, height)` of the frames and the
+    frames at each of `sizes`.
+
+    Raises
+    ------
+    UnidentifiedImageError
+        when the video can't be opened or no frame can be decoded.
+    '''
+    capture = cv2.VideoCapture(filepath)
+    try:
+        if not capture.isOpened():
+            raise UnidentifiedImageError(f"{filepath} can't be opened as a video.")
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        count = capture.get(cv2.CAP_PROP_FRAME_COUNT)
+        duration = count / fps if fps > 0 and count > 0 else 0.0
+        sampled: List[Optional[Any]] = []
+        for k in range(frames):
+            capture.set(cv2.CAP_PROP_POS_MSEC, 1000 * duration * (k + 0.5) / frames)
+            ok, frame = capture.read()
+            sampled.append(frame if ok else None)
+    finally:
+        capture.release()
+
+    decoded = [k for k, frame in enumerate(sampled) if frame is not None]
+    if not decoded:
+        raise UnidentifiedImageError(f"{filepath}: no frame could be decoded.")
+    height, width = sampled[decoded[0]].shape[:2]
+    images: Dict[Optional[int], List[Decoded]] = {size: [] for size in sizes}
+    for k in range(frames):
+        frame = sampled[min(decoded, key=lambda d: abs(d - k))]
+        for size, scaled in images.items():
+            resized = frame
+            if size and min(width, height) > size:
+                scale = size / min(width, height)
+                resized = cv2.resize(frame, (round(width * scale), round(height * scale)),
+                                     interpolation=cv2.INTER_AREA)
+            scaled.append(Decoded(Image.fromarray(cv2.cvtColor(resized, cv2.COLOR_BGR2RGB))))
+    return duration, (width, height), images
+
+
+def hash_video(
+    filepath: str,
+    functions: Iterable[tuple[str, Callable]],
+    frames: int = FRAMES,
+) -> dict[str, str]:
+    '''Samples the video `filepath` once and runs every perceptual hasher on
+    each of its frames.
+
+    Parameters
+    ----------
+    filepath : str
+        path of the video.
+    functions : Iterable[tuple[str, Callable]]
+        `(algo, func)` pairs, as in `enabled_hashers`, accepting a `Decoded`.
+    frames : int, optional
+        number of frames sampled, see `sample`.
+
+    Returns
+    -------
+        a dictionary of video hash type to the hex of the frame hashes put end
+    to end, and the `VIDEO` pseudo hash: `duration:WIDTHxHEIGHT:frames`.
+    '''
+    functions = tuple(functions)
+    with metrics.timed("decode"):  # Each hasher at its own resolution, as images
+        duration, (width, height), images = sample(
+            filepath, frames, {resolution([algo]) for algo, _ in functions})
+    results = {}
+    for algo, func in functions:
+        with metrics.timed(f"hash:{algo}"):
+            raw = b''.join(to_bytes(algo, func(image)[1]) for image in images[resolution([algo])])
+        results[video_hashtype(algo)] = raw.hex()
+    results[VIDEO] = f"{duration:.3f}:{width}x{height}:{len(images)}"
+    return results
@@ -1,13 +1,50 @@
+import os
+
+from sqlalchemy import event
 from sqlalchemy.orm import DeclarativeBase, sessionmaker
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, AsyncSession
+
+DATABASE = "database.db"
+
+# WAL lets readers run alongside the writer and makes commits a single append,
+# so fsync on checkpoints only (synchronous=NORMAL) is still crash safe.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64 * 1024,  # KiB
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+def set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
 
-engine = create_async_engine("sqlite+aiosqlite:///database.db")
+def create_engine(path: str = DATABASE) -> AsyncEngine:
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    event.listen(engine.sync_engine, "connect", set_pragmas)
+    return engine
+
+def shard_path(path: str, shard: tuple[int, int]) -> str:
+    """Database file of shard `i` of `n` next to `path`, e.g. `database.2-of-4.db`."""
+    root, extension = os.path.splitext(path)
+    return f"{root}.{shard[0]}-of-{shard[1]}{extension}"
+
+engine = create_engine()
 
 class Base(DeclarativeBase):
     pass
 
 Session = sessionmaker(engine, autoflush=True, class_=AsyncSession)
 
+def use_database(path: str) -> None:
+    """Points `engine` and `Session` at the database file `path`."""
+    global engine
+    engine = create_engine(path)
+    Session.configure(bind=engine)
+
 async def async_create_all(engine):
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
@@ -17,4 +54,6 @@ async def async_drop_all(engine):
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
 
-from .files import Files, Hashes, association_table
\ No newline at end of file
+from .files import Files, Hashes, association_table
+from .mih import mih_bands
+from .scans import Scans, scan_directories
\ No newline at end of file
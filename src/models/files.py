@@ -5,12 +5,18 @@ Sources:
 - [stackoverflow.com/../database-on-the-fly-with-scripting-languages](https://stackoverflow.com/a/2580543):
     On how to work with sqlalchemy.Table to dinamically create Columns.
 """
-from typing import Any, Optional
+from typing import Any, Iterator, Optional
 
-from sqlalchemy import Column, ForeignKey, String, Table, func, select
+from sqlalchemy import (BigInteger, Column, ForeignKey, Index, LargeBinary,
+                        String, Table, bindparam, delete, func, select,
+                        update)
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from src.models import Base, Session
+from src.models.mih import index_hashes
+from src.werkzeug.hash_values import TIER_KEYS
 
 association_table = Table(
     "association_table",
@@ -22,14 +28,32 @@ association_table = Table(
 class Files(Base):
     __tablename__ = "files"
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    path: Mapped[str] = mapped_column(String)
+    path: Mapped[str] = mapped_column(String, index=True, unique=True)
     filetype: Mapped[Optional[str]]
+    # Stat of the file when hashed, tells whether stored hashes are still valid
+    size: Mapped[Optional[int]] = mapped_column(BigInteger)
+    mtime_ns: Mapped[Optional[int]] = mapped_column(BigInteger)
+    inode: Mapped[Optional[int]] = mapped_column(BigInteger)
+    device: Mapped[Optional[int]] = mapped_column(BigInteger)
     hashes: Mapped[list["Hashes"]] = relationship(secondary=association_table,
                                                  back_populates="files",)
 
+    # Renamed files are found by inode, see `get_renamed`, files of the same
+    # size by size, see `get_sized`
+    __table_args__ = (
+        Index("ix_files_device_inode", "device", "inode"),
+        Index("ix_files_size", "size"),
+    )
+
     def __repr__(self) -> str:
         return f"Files(path={self.path!r}, filetype={self.filetype!r}, hashes={len(self.hashes)})"
 
+    @property
+    def stat(self) -> Optional[tuple[int, int, int, int]]:
+        if self.size is None:
+            return None
+        return self.size, self.mtime_ns, self.inode, self.device
+
     @classmethod
     async def get_one(cls, path):
         async with Session.begin() as session:
@@ -38,17 +62,97 @@ class Files(Base):
             return item
 
     @classmethod
-    async def get_cached_items(cls):
+    async def get_missing(
+        cls,
+        stats: list[tuple[str, int, int, int, int]],
+        hashtypes: list[tuple[str, str, bool]],
+    ) -> dict[str, tuple[set[str], Optional[str], set[str]]]:
+        """Returns `{path: ({hashtype, ...}, filetype, {keyed hashtype, ...})}` of
+        the hashtypes still to be calculated for the files `stats` (`(path,
+        *Files.stat)`), see `MISSING`. Files with nothing left to do are not
+        returned, `filetype` is None unless the stored file is still valid. Keyed
+        hashtypes are the missing ones stored as a tier key.
+
+        `hashtypes` are `(hashtype, stored as for videos, redone if previewed)`."""
+        async with Session.begin() as session:
+            connection = await session.connection()
+            await _load_pending(connection, stats)
+            await connection.exec_driver_sql(f"DELETE FROM temp.{PENDING_HASHTYPES}")
+            if hashtypes:
+                await connection.exec_driver_sql(
+                    f"INSERT INTO temp.{PENDING_HASHTYPES} VALUES (?, ?, ?)", hashtypes)
+            missing = {}
+            for path, hashtype, filetype, keyed in await connection.exec_driver_sql(MISSING):
+                hashtypes, _, keys = missing.setdefault(path, (set(), filetype, set()))
+                hashtypes.add(hashtype)
+                if keyed:
+                    keys.add(hashtype)
+            return missing
+
+    @classmethod
+    async def get_renamed(
+        cls,
+        stats: list[tuple[str, int, int, int, int]],
+    ) -> list[tuple[str, str]]:
+        """Returns `(path, stored path)` of the files `stats` (`(path,
+        *Files.stat)`) that are not stored, but whose inode, size and mtime are,
+        under another path."""
+        async with Session.begin() as session:
+            connection = await session.connection()
+            await _load_pending(connection, stats)
+            return [tuple(row) for row in await connection.exec_driver_sql(RENAMED)]
+
+    @classmethod
+    async def get_sized(
+        cls,
+        stats: list[tuple[str, int, int, int, int]],
+    ) -> list[tuple[str, tuple[int, int, int, int], Optional[str]]]:
+        """Returns `(path, stat, keyed hashtype)` of the stored files not in
+        `stats` (`(path, *Files.stat)`) whose size one of `stats` has, see
+        `SIZED`. A file has a row with None, and one per `hashlib.*` hashtype
+        it stores as a tier key."""
+        async with Session.begin() as session:
+            connection = await session.connection()
+            await _load_pending(connection, stats)
+            return [
+                (path, tuple(stat), keyed)
+                for path, *stat, keyed in await connection.exec_driver_sql(SIZED)
+            ]
+
+    @classmethod
+    async def get_hashes(cls, hashtype: str) -> tuple[list[str], list[str]]:
+        """Returns paths and hash values of every file hashed with `hashtype`."""
         async with Session.begin() as session:
-            query = select(cls.path, Hashes.hashtype)\
+            query = select(cls.path, Hashes.hashvalue)\
                 .join_from(Files, association_table)\
-                .join(Hashes)
+                .join(Hashes)\
+                .filter(Hashes.hashtype == hashtype)
             result = await session.stream(query)
-            return {(row.path, row.hashtype) async for row in result}
+            paths, values = [], []
+            async for row in result:
+                paths.append(row.path)
+                values.append(row.hashvalue)
+            return paths, values
 
     @classmethod
-    async def is_it_cached(cls):
-        raise NotImplementedError()
+    async def get_links(cls, hashtype: str) -> list[tuple[int, int]]:
+        """Returns `(file_id, hash_id)` of every file hashed with `hashtype`, ids
+        only, see `src.werkzeug.snapshot`."""
+        async with Session.begin() as session:
+            query = select(association_table.c.file_id, association_table.c.hash_id)\
+                .join(Hashes)\
+                .filter(Hashes.hashtype == hashtype)
+            return [tuple(row) for row in await session.execute(query)]
+
+    @classmethod
+    async def get_paths(cls, ids: list[int]) -> dict[int, str]:
+        """Returns `{id: path}` of the files `ids`."""
+        async with Session.begin() as session:
+            paths = {}
+            for chunk in chunks(ids):
+                query = select(cls.id, cls.path).filter(cls.id.in_(chunk))
+                paths.update((row.id, row.path) for row in await session.execute(query))
+            return paths
 
     @classmethod
     async def total_cached(cls) -> int:
@@ -59,25 +163,240 @@ class Files(Base):
         # return sum(1 for f in cached_files.values() for _ in f.keys())
 
     @classmethod
-    async def update_hashes(cls, file, hashes: list["Hashes"]) -> None:
+    async def update_hashes(cls, file: str, hashes: dict[str, bytes]) -> None:
+        """Adds `hashes` (`{hashtype: value}`) to a stored file, keeping its stat."""
+        async with Session.begin() as session:
+            await upsert(session, [{"path": file, "hashes": hashes}])
+
+    @classmethod
+    async def move(cls, old: str, new: str) -> None:
+        """Renames a file, keeping its hashes."""
         async with Session.begin() as session:
-            query = select(cls).filter_by(path = file)
-            item = (await session.execute(query)).scalar_one()
-            item.hashes.update(hashes)
+            await session.execute(update(cls).filter_by(path = old).values(path = new))
 
 class Hashes(Base):
     __tablename__ = "hashes"
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     hashtype: Mapped[str] = mapped_column(String)
-    hashvalue: Mapped[str] = mapped_column(String)
+    # Raw hash bytes, see `src.werkzeug.hash_values.to_bytes`
+    hashvalue: Mapped[bytes] = mapped_column(LargeBinary)
     files: Mapped[list["Files"]] = relationship(secondary=association_table,
                                                back_populates="hashes",)
 
+    # One row per distinct value, shared by every file that has it
+    __table_args__ = (
+        Index("ix_hashes_hashtype_hashvalue", "hashtype", "hashvalue", unique=True),
+    )
+
     def __repr__(self) -> str:
         return f"Hashes(id={self.id!r}, file={self.file.path!r}, )"
 
-async def add_all(buffer: list[Any]):
+    @classmethod
+    async def get_hashtypes(cls) -> list[str]:
+        """Returns every stored hashtype."""
+        async with Session.begin() as session:
+            query = select(cls.hashtype).distinct().order_by(cls.hashtype)
+            return list((await session.execute(query)).scalars())
+
+    @classmethod
+    async def get_values(cls, ids: list[int]) -> dict[int, bytes]:
+        """Returns `{id: hashvalue}` of the hashes `ids`."""
+        async with Session.begin() as session:
+            values = {}
+            for chunk in chunks(ids):
+                query = select(cls.id, cls.hashvalue).filter(cls.id.in_(chunk))
+                values.update((row.id, row.hashvalue) for row in await session.execute(query))
+            return values
+
+STAT = ("size", "mtime_ns", "inode", "device")
+CHUNK = 500  # Rows per statement, under SQLite's limit of bound parameters
+
+# Pending work is computed in SQLite: the files of a walk are loaded a chunk at
+# a time into a temporary table and anti-joined with the stored hashes, so only
+# the missing `(path, hashtype)` pairs come back and memory does not grow with
+# the database.
+PENDING_FILES = "pending_files"
+PENDING_HASHTYPES = "pending_hashtypes"
+PENDING_TABLES = (
+    f"""
+    CREATE TEMP TABLE IF NOT EXISTS {PENDING_FILES} (
+        path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, device INTEGER
+    )
+    """,
+    f"""
+    CREATE TEMP TABLE IF NOT EXISTS {PENDING_HASHTYPES} (
+        hashtype TEXT PRIMARY KEY, stored_video TEXT NOT NULL, redo_previewed INTEGER NOT NULL
+    )
+    """,
+)
+# A file whose stored stat differs (or was never stored) misses every hashtype.
+# One still valid misses nothing unless it is an image or a video, which miss
+# the hashtypes they are not linked to (perceptual hashes of videos are frame
+# sequences, stored under `video.<hashtype>`), and the perceptual hashtypes
+# taken from an embedded preview when those won't do. A `hashlib.*` tier key
+# of `run --tiered` only proved the file had no exact duplicate when it was
+# stored, it misses its digest too, `keyed` tells those apart.
+TIER_KEY = " OR ".join(
+    f"substr({{0}}, 1, {len(prefix)}) = CAST('{prefix}' AS BLOB)" for prefix in TIER_KEYS
+)
+MISSING = f"""
+SELECT path, hashtype, filetype, keyed FROM (
+    SELECT *, hashtype LIKE 'hashlib.%' AND ({TIER_KEY.format("stored")}) AS keyed FROM (
+        SELECT p.path, w.hashtype, w.redo_previewed, f.id AS stored_id, f.filetype, (
+            SELECT h.hashvalue FROM main.association_table a
+            JOIN main.hashes h ON h.id = a.hash_id
+            WHERE a.file_id = f.id AND h.hashtype =
+                CASE WHEN f.filetype LIKE 'video/%' THEN w.stored_video ELSE w.hashtype END
+        ) AS stored
+        FROM temp.{PENDING_FILES} p
+        CROSS JOIN temp.{PENDING_HASHTYPES} w
+        LEFT JOIN main.files f ON f.path = p.path
+            AND (f.size, f.mtime_ns, f.inode, f.device) = (p.size, p.mtime_ns, p.inode, p.device)
+    )
+)
+WHERE stored_id IS NULL OR (filetype LIKE 'image/%' OR filetype LIKE 'video/%') AND (
+    stored IS NULL OR keyed
+    OR redo_previewed AND EXISTS (
+        SELECT 1 FROM main.association_table a JOIN main.hashes h ON h.id = a.hash_id
+        WHERE a.file_id = stored_id AND h.hashtype = 'preview'
+    )
+)
+"""
+# Files of the same size as one of a walk, by the index on `size`, and the
+# digests they only store as a tier key
+SIZED = f"""
+WITH sized AS (
+    SELECT id, path, size, mtime_ns, inode, device FROM main.files f
+    WHERE size IN (SELECT size FROM temp.{PENDING_FILES})
+        AND NOT EXISTS (SELECT 1 FROM temp.{PENDING_FILES} p WHERE p.path = f.path)
+)
+SELECT path, size, mtime_ns, inode, device, NULL FROM sized
+UNION ALL
+SELECT s.path, s.size, s.mtime_ns, s.inode, s.device, h.hashtype FROM sized s
+JOIN main.association_table a ON a.file_id = s.id
+JOIN main.hashes h ON h.id = a.hash_id
+WHERE h.hashtype LIKE 'hashlib.%' AND ({TIER_KEY.format("h.hashvalue")})
+"""
+RENAMED = f"""
+SELECT p.path, o.path FROM temp.{PENDING_FILES} p
+JOIN main.files o ON (o.device, o.inode) = (p.device, p.inode)
+    AND (o.size, o.mtime_ns) = (p.size, p.mtime_ns)
+WHERE NOT EXISTS (SELECT 1 FROM main.files f WHERE f.path = p.path)
+"""
+
+def chunks(items: list, size: int = CHUNK) -> Iterator[list]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+async def _load_pending(connection: Any, stats: list[tuple]) -> None:
+    """Replaces the rows of the `PENDING_FILES` temporary table by `stats`."""
+    for statement in PENDING_TABLES:
+        await connection.exec_driver_sql(statement)
+    await connection.exec_driver_sql(f"DELETE FROM temp.{PENDING_FILES}")
+    if stats:
+        await connection.exec_driver_sql(
+            f"INSERT OR REPLACE INTO temp.{PENDING_FILES} VALUES (?, ?, ?, ?, ?)", stats)
+
+async def upsert(session: Any, records: list[dict]) -> None:
+    """
+    Writes `records` with bulk Core statements, a few per `CHUNK` rows instead
+    of a few per object.
+
+    A record is a dict with a `path` and its `hashes` (`{hashtype: value}`).
+    Records that also carry a `filetype` and a stat (`size`, `mtime_ns`,
+    `inode`, `device`) insert or update their `files` row; the others must
+    already be stored. A file whose stat changed was modified and loses every
+    hash it had; otherwise only hashes of the same hashtypes are replaced. A
+    hash of value None is only removed.
+    """
+    files, hashes = Files.__table__, Hashes.__table__
+
+    stored = {}
+    for chunk in chunks([record["path"] for record in records]):
+        query = select(files.c.id, files.c.path, *(files.c[c] for c in STAT))\
+            .where(files.c.path.in_(chunk))
+        stored.update((row.path, row) for row in await session.execute(query))
+
+    stale, replaced = [], []
+    for record in records:
+        if (row := stored.get(record["path"])) is None:
+            continue
+        if "size" in record and tuple(row[2:]) != tuple(record[c] for c in STAT):
+            stale.append({"file_id": row.id})
+        else:
+            replaced.extend(
+                {"file_id": row.id, "hashtype": hashtype} for hashtype in record["hashes"]
+            )
+    if stale:
+        await session.execute(
+            delete(association_table)
+            .where(association_table.c.file_id == bindparam("file_id")), stale)
+    if replaced:
+        known = select(association_table.c.hash_id)\
+            .join(hashes, hashes.c.id == association_table.c.hash_id)\
+            .where(association_table.c.file_id == bindparam("file_id"))\
+            .where(hashes.c.hashtype == bindparam("hashtype"))
+        await session.execute(
+            delete(association_table)
+            .where(association_table.c.file_id == bindparam("file_id"))
+            .where(association_table.c.hash_id.in_(known.scalar_subquery())), replaced)
+
+    # Ids of new and existing rows alike, the no-op update makes RETURNING see both
+    ids = {row.path: row.id for row in stored.values()}
+    params = [
+        {"path": record["path"], "filetype": record["filetype"], **{c: record[c] for c in STAT}}
+        for record in records if "size" in record
+    ]
+    for chunk in chunks(params):
+        query = insert(files)
+        query = query.on_conflict_do_update(
+            index_elements=[files.c.path],
+            set_={c: query.excluded[c] for c in ("filetype", *STAT)},
+        ).returning(files.c.id, files.c.path)
+        ids.update((row.path, row.id) for row in await session.execute(query, chunk))
+
+    keys = list({
+        (hashtype, value)
+        for record in records for hashtype, value in record["hashes"].items()
+        if value is not None
+    })
+    hash_ids, indexed = {}, []
+    for chunk in chunks(keys):
+        query = insert(hashes)
+        query = query.on_conflict_do_update(
+            index_elements=[hashes.c.hashtype, hashes.c.hashvalue],
+            set_={"hashtype": query.excluded.hashtype},
+        ).returning(hashes.c.id, hashes.c.hashtype, hashes.c.hashvalue)
+        rows = (await session.execute(
+            query, [{"hashtype": hashtype, "hashvalue": value} for hashtype, value in chunk]
+        )).all()
+        hash_ids.update(((row.hashtype, row.hashvalue), row.id) for row in rows)
+        indexed.extend(rows)
+
+    links = []
+    for record in records:
+        if (file_id := ids.get(record["path"])) is None:
+            raise NoResultFound(f"{record['path']} is not stored.")
+        links.extend(
+            {"file_id": file_id, "hash_id": hash_ids[key]}
+            for key in record["hashes"].items() if key[1] is not None
+        )
+    for chunk in chunks(links):
+        await session.execute(insert(association_table).on_conflict_do_nothing(), chunk)
+
+    await index_hashes(session, indexed)
+
+async def add_all(buffer: list[dict], checkpoint: Optional[tuple[int, list[str]]] = None):
+    """Saves `buffer` of file records, as described in `upsert`, and in the same
+    transaction the directories of `checkpoint` (`(scan_id, paths)`) they
+    completed, see `src.models.scans`."""
+    from src.models.scans import add_directories
+
+    if not buffer and not (checkpoint and checkpoint[1]):
+        return
     async with Session.begin() as session:
         if buffer:
-            session.add_all(buffer)
\ No newline at end of file
+            await upsert(session, buffer)
+        if checkpoint and checkpoint[1]:
+            await add_directories(session, *checkpoint)
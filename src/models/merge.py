@@ -0,0 +1,104 @@
+"""
+Bulk merge of databases written by `run --shard`, or by any other scan.
+
+A shard is attached to the target database and copied with a few
+`INSERT ... SELECT` statements, in one transaction. Rows are matched by
+value, not by id: files by `path`, hashes by `(hashtype, hashvalue)`, so a
+hash shared by several shards is stored once and the association rows point
+to it. The multi-index hashing bands are copied along, not recomputed.
+
+A file present on both sides is taken from the shard, as `upsert` would: if
+its stat changed it loses the hashes it had, otherwise only those of the
+hashtypes the shard has are replaced.
+
+Sources:
+- [ATTACH DATABASE](https://www.sqlite.org/lang_attach.html)
+- [UPSERT](https://www.sqlite.org/lang_upsert.html):
+    On the `WHERE true` an `INSERT ... SELECT ... ON CONFLICT` needs.
+"""
+from typing import Any
+
+from src.models.mih import BANDS
+
+SHARD = "shard"
+
+STATEMENTS = [
+    # Files whose stat changed lose every hash
+    f"""
+    DELETE FROM main.association_table WHERE file_id IN (
+        SELECT f.id FROM main.files f JOIN {SHARD}.files s ON s.path = f.path
+        WHERE (f.size, f.mtime_ns, f.inode, f.device)
+            IS NOT (s.size, s.mtime_ns, s.inode, s.device)
+    )
+    """,
+    # Others only lose the hashtypes the shard has
+    f"""
+    DELETE FROM main.association_table WHERE (file_id, hash_id) IN (
+        SELECT a.file_id, a.hash_id FROM main.association_table a
+        JOIN main.files f ON f.id = a.file_id
+        JOIN main.hashes h ON h.id = a.hash_id
+        JOIN {SHARD}.files sf ON sf.path = f.path
+        JOIN {SHARD}.association_table sa ON sa.file_id = sf.id
+        JOIN {SHARD}.hashes sh ON sh.id = sa.hash_id AND sh.hashtype = h.hashtype
+    )
+    """,
+    f"""
+    INSERT INTO main.files (path, filetype, size, mtime_ns, inode, device)
+    SELECT path, filetype, size, mtime_ns, inode, device FROM {SHARD}.files WHERE true
+    ON CONFLICT (path) DO UPDATE SET
+        filetype = excluded.filetype, size = excluded.size, mtime_ns = excluded.mtime_ns,
+        inode = excluded.inode, device = excluded.device
+    """,
+    f"""
+    INSERT INTO main.hashes (hashtype, hashvalue)
+    SELECT hashtype, hashvalue FROM {SHARD}.hashes WHERE true
+    ON CONFLICT (hashtype, hashvalue) DO NOTHING
+    """,
+    f"""
+    INSERT OR IGNORE INTO main.association_table (file_id, hash_id)
+    SELECT f.id, h.id FROM {SHARD}.association_table sa
+    JOIN {SHARD}.files sf ON sf.id = sa.file_id
+    JOIN {SHARD}.hashes sh ON sh.id = sa.hash_id
+    JOIN main.files f ON f.path = sf.path
+    JOIN main.hashes h ON h.hashtype = sh.hashtype AND h.hashvalue = sh.hashvalue
+    """,
+    *(
+        f"""
+        INSERT OR IGNORE INTO main.mih_band_{k} (hash_id, hashtype, value)
+        SELECT h.id, b.hashtype, b.value FROM {SHARD}.mih_band_{k} b
+        JOIN {SHARD}.hashes sh ON sh.id = b.hash_id
+        JOIN main.hashes h ON h.hashtype = sh.hashtype AND h.hashvalue = sh.hashvalue
+        """
+        for k in range(BANDS)
+    ),
+]
+
+
+async def merge(path: str) -> dict[str, Any]:
+    """
+    Merges the database file `path` into the current one, see `use_database`.
+
+    Returns
+    -------
+        the number of files, hashes and links of the shard.
+    """
+    from src import models  # Its `engine` is the one `use_database` picked
+
+    async with models.engine.connect() as connection:
+        # Outside of a transaction, SQLite refuses to ATTACH in one
+        await connection.exec_driver_sql(f"ATTACH DATABASE ? AS {SHARD}", (path,))
+        await connection.commit()
+        try:
+            counts = {
+                table: (await connection.exec_driver_sql(
+                    f"SELECT count(*) FROM {SHARD}.{table}")).scalar()
+                for table in ("files", "hashes", "association_table")
+            }
+            for statement in STATEMENTS:
+                await connection.exec_driver_sql(statement)
+            await connection.commit()
+        finally:
+            await connection.rollback()
+            await connection.exec_driver_sql(f"DETACH DATABASE {SHARD}")
+            await connection.commit()
+    return counts
@@ -0,0 +1,77 @@
+"""
+Multi-index hashing (MIH) tables for near-duplicate lookups.
+
+Each perceptual hash is cut into `BAND_BITS` wide bands, band `k` is stored in
+table `mih_band_{k}` indexed by `(hashtype, value)`. A hash within `r` bits of
+a query differs by at most `r // m` bits in at least one of its `m` bands, so a
+lookup only probes the few band values around the query's.
+
+Sources:
+- [Fast Search in Hamming Space with Multi-Index Hashing](https://www.cs.toronto.edu/~norouzi/research/papers/multi_index_hashing.pdf)
+"""
+from collections import defaultdict
+from itertools import combinations
+from typing import Any, Iterable, Iterator, Optional
+
+from sqlalchemy import Column, ForeignKey, Index, Integer, String, Table, insert
+
+from src.models import Base
+
+BAND_BITS = 16
+BANDS = 8  # Hashes up to 128 bits are indexed
+
+mih_bands = [
+    Table(
+        f"mih_band_{k}",
+        Base.metadata,
+        Column("hash_id", ForeignKey("hashes.id"), primary_key=True),
+        Column("hashtype", String, nullable=False),
+        Column("value", Integer, nullable=False),
+        Index(f"ix_mih_band_{k}_hashtype_value", "hashtype", "value"),
+    )
+    for k in range(BANDS)
+]
+
+
+def bands(hashtype: str, hashvalue: bytes) -> Optional[list[tuple[int, int]]]:
+    '''Splits a raw hash into `(value, width)` bands, most significant first.
+
+    Returns
+    -------
+        None if `hashtype` is not indexed or the hash does not fit in `BANDS`.
+    '''
+    if not hashtype.startswith(('dhash.', 'perception.')):
+        return None
+    nbits = len(hashvalue) * 8
+    if not 0 < nbits <= BANDS * BAND_BITS:
+        return None
+
+    value = int.from_bytes(hashvalue, 'big')
+    result = []
+    for start in range(0, nbits, BAND_BITS):
+        width = min(BAND_BITS, nbits - start)
+        result.append(((value >> (nbits - start - width)) & ((1 << width) - 1), width))
+    return result
+
+
+def neighbours(value: int, width: int, radius: int) -> Iterator[int]:
+    '''Every `width` bits value at most `radius` bits away from `value`.'''
+    for distance in range(min(radius, width) + 1):
+        for bits in combinations(range(width), distance):
+            flip = 0
+            for bit in bits:
+                flip |= 1 << bit
+            yield value ^ flip
+
+
+async def index_hashes(session: Any, hashes: Iterable[Any]) -> None:
+    '''Adds band rows for `hashes`, which must already have an `id`. Hashes
+    already indexed are skipped.'''
+    rows = defaultdict(list)
+    for item in hashes:
+        for k, (value, _) in enumerate(bands(item.hashtype, item.hashvalue) or ()):
+            rows[k].append(
+                {"hash_id": item.id, "hashtype": item.hashtype, "value": value}
+            )
+    for k, params in rows.items():
+        await session.execute(insert(mih_bands[k]).prefix_with('OR IGNORE'), params)
@@ -0,0 +1,78 @@
+"""
+Checkpoints of `run`, so that an interrupted scan resumes where it stopped.
+
+A scan stores the settings it was started with and every directory whose
+subtree is done: each file in it was committed, skipped as cached or reported.
+Directories are written in the same transaction as the last records they were
+waiting for, see `add_all`, so a directory is never stored before its files.
+"""
+from typing import Any, Iterable, Optional
+
+from sqlalchemy import Column, ForeignKey, String, Table, delete, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Mapped, mapped_column
+
+from src.models import Base, Session
+from src.models.files import chunks
+
+scan_directories = Table(
+    "scan_directories",
+    Base.metadata,
+    Column("scan_id", ForeignKey("scans.id"), primary_key=True),
+    Column("path", String, primary_key=True),
+)
+
+class Scans(Base):
+    __tablename__ = "scans"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    # JSON of what a resumed scan must share: roots, hashes and preview
+    settings: Mapped[str]
+    finished: Mapped[bool] = mapped_column(default=False)
+
+    def __repr__(self) -> str:
+        return f"Scans(id={self.id!r}, finished={self.finished!r})"
+
+    @classmethod
+    async def start(cls, settings: str, resume: bool = False) -> tuple[int, set[str], bool]:
+        """
+        Returns the id of the scan to run, its done directories and whether it
+        is resumed. Unless resumed, a new scan supersedes unfinished ones.
+
+        Raises
+        ------
+        ValueError
+            when resuming a scan started with other `settings`.
+        """
+        async with Session.begin() as session:
+            query = select(cls).filter_by(finished=False).order_by(cls.id.desc()).limit(1)
+            latest: Optional[Scans] = (await session.execute(query)).scalar_one_or_none()
+            if resume and latest is not None:
+                if latest.settings != settings:
+                    raise ValueError(
+                        f"The interrupted scan was started with {latest.settings}, not {settings}."
+                    )
+                query = select(scan_directories.c.path)\
+                    .where(scan_directories.c.scan_id == latest.id)
+                result = await session.stream(query)
+                return latest.id, {row.path async for row in result}, True
+
+            await session.execute(delete(scan_directories))
+            await session.execute(delete(cls).filter_by(finished=False))
+            scan = cls(settings=settings)
+            session.add(scan)
+            await session.flush()
+            return scan.id, set(), False
+
+    @classmethod
+    async def finish(cls, scan_id: int) -> None:
+        """Marks a scan done, its directories are no longer needed."""
+        async with Session.begin() as session:
+            await session.execute(
+                delete(scan_directories).where(scan_directories.c.scan_id == scan_id))
+            await session.execute(update(cls).filter_by(id=scan_id).values(finished=True))
+
+async def add_directories(session: Any, scan_id: int, paths: Iterable[str]) -> None:
+    """Stores done directories of a scan."""
+    rows = [{"scan_id": scan_id, "path": path} for path in paths]
+    for chunk in chunks(rows):
+        await session.execute(insert(scan_directories).on_conflict_do_nothing(), chunk)
@@ -0,0 +1,81 @@
+"""
+Done directories of a walk, for `run --resume`.
+
+A directory is done once it was listed, each of its files was finished (its
+record committed, or nothing to do, or reported) and each subdirectory is
+done. `scantree` opens directories and adds files from the walker thread,
+`finish` is called from the event loop, a lock keeps the counts straight.
+Done directories are handed to the writer by `flush` and are skipped, with
+their whole subtree, by the `scantree` of a resumed scan.
+
+Directories are keyed by their normalized path, so a file's directory is
+`os.path.dirname` of its path whatever the form the root was given in (`.`
+for a file of the current directory).
+"""
+import os
+import threading
+from typing import Dict, Iterable, List, Optional
+
+
+class Checkpoint:
+    """
+    Parameters
+    ----------
+    scan : int
+        id of the scan in `src.models.scans`.
+    done : Iterable[str], optional
+        directories done by an earlier, interrupted run of the scan.
+    """
+
+    def __init__(self, scan: int, done: Iterable[str] = ()) -> None:
+        self.scan = scan
+        self.done = set(done)
+        self.pending: Dict[str, int] = {}
+        self.parents: Dict[str, Optional[str]] = {}
+        self.completed: List[str] = []
+        self.lock = threading.Lock()
+
+    def skip(self, directory: str) -> bool:
+        '''Whether `directory` is done, and not to be listed again.'''
+        return os.path.normpath(directory) in self.done
+
+    def open(self, directory: str, parent: Optional[str] = None) -> None:
+        '''Registers `directory`, found while listing `parent`. It is pending
+        until listed.'''
+        directory = os.path.normpath(directory)
+        with self.lock:
+            self.pending[directory] = 1
+            self.parents[directory] = parent = parent and os.path.normpath(parent)
+            if parent is not None:
+                self.pending[parent] += 1
+
+    def add(self, directory: str) -> None:
+        '''A file of `directory` was handed to the consumers.'''
+        with self.lock:
+            self.pending[os.path.normpath(directory)] += 1
+
+    def close(self, directory: str) -> None:
+        '''`directory` was listed to the end.'''
+        with self.lock:
+            self._release(os.path.normpath(directory))
+
+    def finish(self, path: str) -> None:
+        '''The file `path` needs nothing more.'''
+        with self.lock:
+            self._release(os.path.dirname(os.path.normpath(path)) or os.curdir)
+
+    def _release(self, directory: Optional[str]) -> None:
+        while directory is not None:
+            self.pending[directory] -= 1
+            if self.pending[directory]:
+                return
+            del self.pending[directory]
+            self.done.add(directory)
+            self.completed.append(directory)
+            directory = self.parents.pop(directory)
+
+    def flush(self) -> List[str]:
+        '''Directories done since the last flush.'''
+        with self.lock:
+            completed, self.completed = self.completed, []
+        return completed
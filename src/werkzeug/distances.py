@@ -1,12 +1,19 @@
 import numba as nb
+import numpy as np
 
-@nb.njit
+M1 = np.uint64(0x5555555555555555)
+M2 = np.uint64(0x3333333333333333)
+M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+H01 = np.uint64(0x0101010101010101)
+
+@nb.njit(cache=True)
 def hamming_distance(a: int, b: int) -> int:
-    '''The function calculates the Hamming distance between two integers using bitwise
-    operations.
+    '''The function calculates the Hamming distance between two 64 bits integers
+    using bitwise operations.
 
     Sources:
     - Hamming distance: [Fast way of counting non zero bits in positive integer](https://stackoverflow.com/a/64848298)
+    - Popcount: [Hamming weight](https://en.wikipedia.org/wiki/Hamming_weight#Efficient_implementation)
 
     Parameters
     ----------
@@ -25,4 +32,97 @@ def hamming_distance(a: int, b: int) -> int:
     representation of `a` and `b`.
 
     '''
-    return (~(a^(~b))).bit_count()
\ No newline at end of file
+    # int.bit_count() is not supported by numba, popcount done by hand (SWAR)
+    x = np.uint64(a) ^ np.uint64(b)
+    x = x - ((x >> np.uint64(1)) & M1)
+    x = (x & M2) + ((x >> np.uint64(2)) & M2)
+    x = (x + (x >> np.uint64(4))) & M4
+    return int((x * H01) >> np.uint64(56))
+
+
+@nb.njit(cache=True)
+def distance(a: np.ndarray, b: np.ndarray, i: int, j: int, threshold: int) -> int:
+    '''Hamming distance between row `i` of `a` and row `j` of `b`, stops
+    counting past `threshold`.'''
+    total = 0
+    for k in range(a.shape[1]):
+        total += hamming_distance(a[i, k], b[j, k])
+        if total > threshold:
+            break
+    return total
+
+
+@nb.njit(parallel=True, cache=True)
+def _count_pairs(a, b, threshold, block, upper):
+    blocks = -(-a.shape[0] // block)
+    counts = np.zeros(blocks, dtype=np.int64)
+    for bi in nb.prange(blocks):
+        count = 0
+        for bj in range(bi if upper else 0, -(-b.shape[0] // block)):
+            for i in range(bi * block, min((bi + 1) * block, a.shape[0])):
+                for j in range(max(bj * block, i + 1 if upper else 0),
+                               min((bj + 1) * block, b.shape[0])):
+                    if distance(a, b, i, j, threshold) <= threshold:
+                        count += 1
+        counts[bi] = count
+    return counts
+
+
+@nb.njit(parallel=True, cache=True)
+def _fill_pairs(a, b, threshold, block, upper, offsets, out):
+    for bi in nb.prange(offsets.shape[0] - 1):
+        n = offsets[bi]
+        for bj in range(bi if upper else 0, -(-b.shape[0] // block)):
+            for i in range(bi * block, min((bi + 1) * block, a.shape[0])):
+                for j in range(max(bj * block, i + 1 if upper else 0),
+                               min((bj + 1) * block, b.shape[0])):
+                    found = distance(a, b, i, j, threshold)
+                    if found <= threshold:
+                        out[n, 0], out[n, 1], out[n, 2] = i, j, found
+                        n += 1
+
+
+def hamming_pairs(
+    a: np.ndarray,
+    b: np.ndarray | None = None,
+    threshold: int = 4,
+    block: int = 256,
+) -> np.ndarray:
+    '''All pairs of rows of `a` and `b` within `threshold` bits.
+
+    Rows are hashes packed as `uint64` words (see `to_words`), several words
+    per row for longer hashes such as `perception.BlockMean`. Rows are compared
+    block against block, so a block of `b` stays in cache while a block of `a`
+    runs over it, and blocks of `a` are spread over threads with `prange`.
+    Results are counted first and written on a second pass, so no thread
+    shares a growing buffer.
+
+    Parameters
+    ----------
+    a : np.ndarray
+        `(n, words)` `uint64` matrix.
+    b : np.ndarray, optional
+        `(m, words)` `uint64` matrix. If None, `a` is compared with itself and
+    only pairs `i < j` are returned.
+    threshold : int, optional
+        maximum Hamming distance of a pair.
+    block : int, optional
+        rows per block.
+
+    Returns
+    -------
+        `(pairs, 3)` `int64` array of row in `a`, row in `b` and distance.
+    '''
+    upper = b is None
+    b = a if upper else b
+    a = np.ascontiguousarray(a, dtype=np.uint64)
+    b = np.ascontiguousarray(b, dtype=np.uint64)
+    if a.shape[1] != b.shape[1]:
+        raise ValueError(f"Hashes of {a.shape[1]} and {b.shape[1]} words can't be compared.")
+
+    counts = _count_pairs(a, b, threshold, block, upper)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    out = np.empty((offsets[-1], 3), dtype=np.int64)
+    _fill_pairs(a, b, threshold, block, upper, offsets, out)
+    return out
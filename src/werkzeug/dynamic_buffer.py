@@ -1,178 +1,143 @@
-import random
-from collections import defaultdict
-from time import process_time_ns
-
-import numba as nb
-
-
-class DynamicBuffer:
+"""
+Flush policies of the group-commit writer in `src.cmds.run`.
+
+A policy tells the writer how many results to commit at once (`next`) and for
+how long the oldest of them may wait for more (`interval`), and learns from
+every commit it is told about (`update`). Every decision is kept in `history`,
+so policies can be compared on the same scan with `summary`, and exported as
+the `writer.batch` and `writer.interval` gauges and the `writer.decisions`
+counter of `src.werkzeug.metrics`, to compare runs from their metrics files.
+
+Sources:
+- [Group commit](https://en.wikipedia.org/wiki/Group_commit)
+- [Exponential smoothing](https://en.wikipedia.org/wiki/Exponential_smoothing):
+    On the weighted moments behind the commit latency model.
+"""
+from typing import Any, Dict, List
+
+from src.werkzeug import metrics
+
+
+class Buffer:
+    """Commit bookkeeping shared by the flush policies."""
+
+    def __init__(self, size: int, max_latency: float = 2.0) -> None:
+        self.size = size
+        self.max_latency = max_latency
+        self.history: List[Dict[str, Any]] = []
+
+    def next(self) -> int:
+        return self.size
+
+    @property
+    def interval(self) -> float:
+        return self.max_latency
+
+    def update(self, size: int, latency: float, depth: int) -> None:
+        '''Records a commit of `size` results that took `latency` seconds, with
+        `depth` results already waiting when it started.'''
+        self.history.append({
+            "size": size,
+            "latency": latency,
+            "depth": depth,
+            "next_size": self.next(),
+            "interval": self.interval,
+        })
+        metrics.gauge("writer.batch", self.next())
+        metrics.gauge("writer.interval", self.interval)
+        metrics.count("writer.decisions")
+
+    def summary(self) -> Dict[str, Any]:
+        commits = len(self.history)
+        rows = sum(h["size"] for h in self.history)
+        seconds = sum(h["latency"] for h in self.history)
+        return {
+            "policy": type(self).__name__,
+            "commits": commits,
+            "rows": rows,
+            "commit_seconds": seconds,
+            "mean_size": rows / commits if commits else 0.0,
+            "max_latency": max((h["latency"] for h in self.history), default=0.0),
+            "rows_per_commit_second": rows / seconds if seconds else 0.0,
+            "final_size": self.next(),
+            "final_interval": self.interval,
+        }
+
+
+class StaticBuffer(Buffer):
+    """Fixed flush size, results wait at most `max_latency` for company."""
+
+
+class AdaptiveBuffer(Buffer):
     """
-    Sources:
-    - https://colab.research.google.com/drive/1nDO-XfgkAgABCe2jYNAFwmi4plr2xJoc#scrollTo=Jm812oPv46rq
+    Flush size fitted to the measured cost of a commit.
+
+    Commit latency is modelled as `fixed + per_row * size`, fitted by a
+    regression over exponentially weighted moments of the past commits. The
+    flush size is the smallest one that keeps the fixed cost (transaction,
+    fsync) under `overhead` of a commit, capped so a commit is predicted to
+    take at most half of `max_latency`. Until the fit has spread enough sizes
+    to work with, the size doubles after each commit. A writer falling behind
+    (more results waiting than the flush size) catches up with bigger groups,
+    up to `maximum`.
+
+    The interval leaves room for the predicted commit in `max_latency`, which
+    bounds the time between a result reaching the writer and being committed.
     """
-    def __init__(self: "DynamicBuffer",
-                 get_legal_actions: int,
-                 alpha: float = 0.5,
-                 epsilon: float = 0.25,
-                 discount: float = 0.99):
-        """
-        Q-Learning Agent
-        based on http://inst.eecs.berkeley.edu/~cs188/sp09/pacman.html
-        Instance variables you have access to
-          - self.epsilon (exploration prob)
-          - self.alpha (learning rate)
-          - self.discount (discount rate aka gamma)
-
-        Functions you should use
-          - self.get_legal_actions(state) {state, hashable -> list of actions, each is hashable}
-            which returns legal actions for a state
-          - self.get_qvalue(state,action)
-            which returns Q(state,action)
-          - self.set_qvalue(state,action,value)
-            which sets Q(state,action) := value
-
-        !!!Important!!!
-        Note: please avoid using self._qValues directly.
-            There's a special self.get_qvalue/set_qvalue for that.
-        """
-
-        self.last_action = None
-        self.get_legal_actions = lambda: range(get_legal_actions)
-        self._qvalues = defaultdict(lambda: 0)
-        self.alpha = alpha
-        self.epsilon = epsilon
-        self.discount = discount
-        self.latest_get_value = process_time_ns()
-
-    @nb.jit(forceobj=True)
-    def get_qvalue(self, action):
-        """ Returns Q(action) """
-        return self._qvalues[action]
-
-    @nb.jit(forceobj=True)
-    def set_qvalue(self, action, value):
-        """ Sets the Qvalue for [state,action] to the given value """
-        self._qvalues[action] = value
-
-    @nb.jit(forceobj=True)
-    def get_value(self):
-        """
-        Compute your agent's estimate of V(s) using current q-values
-        V(s) = max_over_action Q(state,action) over possible actions.
-        Note: please take into account that q-values can be negative.
-        """
-        possible_actions = self.get_legal_actions()
-
-        #If there are no legal actions, return 0.0
-        if len(possible_actions) == 0:
-            return 0.0
-
-        q = [self.get_qvalue(a) for a in possible_actions]
-        value = max(q)
-
-        return value
-
-    @nb.jit(forceobj=True)
-    def update(self, action, reward):
-        """
-        You should do your Q-Value update here:
-           Q(s,a) := (1 - alpha) * Q(s,a) + alpha * (r + gamma * V(s'))
-        """
-
-        #agent parameters
-        gamma = self.discount
-        learning_rate = self.alpha
-
-        Q = (1 - learning_rate) * self.get_qvalue(action) + learning_rate * (reward + gamma * self.get_value())
-
-        self.set_qvalue(action, Q)
-
-        return self.get_action()
-
-    @nb.jit(forceobj=True)
-    def get_and_update(self, action):
-    # def update(self, state, action, reward, next_state):
-        """
-        You should do your Q-Value update here:
-           Q(s,a) := (1 - alpha) * Q(s,a) + alpha * (r + gamma * V(s'))
-        """
-
-        #agent parameters
-        gamma = self.discount
-        learning_rate = self.alpha
-
-        reward = process_time_ns() - self.latest_get_value
-
-        Q = (1 - learning_rate) * self.get_qvalue(action) + learning_rate * (reward + gamma * self.get_value())
-
-        self.set_qvalue(action, Q)
-
-        return self.get_action()
-
-    @nb.jit(forceobj=True)
-    def get_best_action(self):
-        """
-        Compute the best action to take in a state (using current q-values).
-        """
-        possible_actions = self.get_legal_actions()
-
-        #If there are no legal actions, return None
-        if len(possible_actions) == 0:
-            return None
-
-        q = [self.get_qvalue(a) for a in possible_actions]
-        maxQ = max(q)
-        i = q.index(maxQ)
-        best_action = possible_actions[i]
-
-        return best_action
-
-    @nb.jit(forceobj=True)
-    def get_action(self):
-        """
-        Compute the action to take in the current state, including exploration.
-        With probability self.epsilon, we should take a random action.
-            otherwise - the best policy action (self.getPolicy).
-
-        Note: To pick randomly from a list, use random.choice(list).
-              To pick True or False with a given probablity, generate uniform number in [0, 1]
-              and compare it with your probability
-        """
-
-        # Pick Action
-        possible_actions = self.get_legal_actions()
-        action = None
-
-        #If there are no legal actions, return None
-        if len(possible_actions) == 0:
-            return None
-
-        #agent parameters:
-        epsilon = self.epsilon
 
-        if random.random() < epsilon:
-            action = random.choice(possible_actions)
+    def __init__(
+        self,
+        minimum: int = 16,
+        maximum: int = 4096,
+        max_latency: float = 2.0,
+        overhead: float = 0.1,
+        smoothing: float = 0.2,
+    ) -> None:
+        super().__init__(minimum, max_latency)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.overhead = overhead
+        self.smoothing = smoothing
+        self.fixed = 0.0
+        self.per_row = 0.0
+        # Weighted moments: size, latency, size², size * latency
+        self._moments = None
+
+    def predict(self, size: int) -> float:
+        return self.fixed + self.per_row * size
+
+    @property
+    def interval(self) -> float:
+        return max(self.max_latency - self.predict(self.size), 0.0)
+
+    def fit(self, size: int, latency: float) -> bool:
+        '''Updates the latency model, returns whether the fit is usable.'''
+        sample = (size, latency, size * size, size * latency)
+        if self._moments is None:
+            self._moments = sample
         else:
-            action = self.get_best_action()
-        chosen_action = action
-
-        self.latest_get_value = process_time_ns()
-
-        return chosen_action
-
-    @nb.jit(forceobj=True)
-    def next(self):
-        next_action = self.get_and_update(self.last_action)\
-            if self.last_action\
-            else self.get_action()
-        self.last_action = next_action
-        return next_action+1
-
-class StaticBuffer:
-    @nb.jit(forceobj=True)
-    def __init__(self, buffer):
-        self.buffer = buffer
-
-    @nb.jit(forceobj=True)
-    def next(self):
-        return self.buffer
\ No newline at end of file
+            self._moments = tuple(
+                (1 - self.smoothing) * m + self.smoothing * s
+                for m, s in zip(self._moments, sample)
+            )
+        n, t, nn, nt = self._moments
+        variance = nn - n * n
+        if variance <= (0.1 * n) ** 2:  # Sizes too alike to tell costs apart
+            self.per_row = latency / max(size, 1)
+            self.fixed = 0.0
+            return False
+        self.per_row = max((nt - n * t) / variance, 1e-9)
+        self.fixed = max(t - self.per_row * n, 0.0)
+        return True
+
+    def update(self, size: int, latency: float, depth: int) -> None:
+        if size:
+            if self.fit(size, latency):
+                target = self.fixed * (1 - self.overhead) / (self.overhead * self.per_row)
+                ceiling = (self.max_latency / 2 - self.fixed) / self.per_row
+                target = min(target, ceiling)
+            else:
+                target = 2 * self.size
+            target = max(target, depth)
+            self.size = int(min(max(target, self.minimum), self.maximum))
+        super().update(size, latency, depth)
@@ -1,30 +1,129 @@
-import asyncio
+"""
+File type sniffing from a single read of the file header.
+
+The header is read once and every identifier works on those bytes. Common
+extensions are checked against their magic numbers first, the identifier
+libraries are only asked when that fails. `filetype.read` goes on reading the
+image from the same open file, so hashers get its bytes without opening it
+again, or hands the open file to a `stream` (e.g. the digests) that reads it
+on.
+
+The content is read into a single immutable `bytes`, which every digest and
+the decoder share without copies (`io.BytesIO` does not copy a `bytes`). The
+kernel is told the file is read sequentially and, once read, that its pages
+are not needed anymore, so a big scan does not evict the rest of the page
+cache.
+
+Sources:
+- [posix_fadvise(2)](https://man7.org/linux/man-pages/man2/posix_fadvise.2.html)
+"""
+import io
+import os
 import pathlib
-from typing import Any
+from time import perf_counter
+from typing import Any, BinaryIO, Callable, Optional, Tuple
 
-import aiofiles
-import aiofiles.os
 import filetype as filetype_lib
 import PIL
 import whatimage
 from loguru import logger
 from PIL import UnidentifiedImageError
 
+from src.werkzeug import metrics
+from src.werkzeug.async2sync import async_, await_
+
+HEADER_SIZE = 2048
+# Bigger images are handed to hashers by path, they read it themselves
+IN_MEMORY = 256 * 1024 * 1024
+# Page cache hints, not available everywhere (e.g. Windows)
+SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', None)
+DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', None)
+
+# Extension: (mime, magic numbers at offset 0)
+MAGIC = {
+    '.jpg': ('image/jpeg', (b'\xff\xd8\xff',)),
+    '.jpeg': ('image/jpeg', (b'\xff\xd8\xff',)),
+    '.png': ('image/png', (b'\x89PNG\r\n\x1a\n',)),
+    '.gif': ('image/gif', (b'GIF87a', b'GIF89a')),
+    '.bmp': ('image/bmp', (b'BM',)),
+    '.tif': ('image/tiff', (b'II*\x00', b'MM\x00*')),
+    '.tiff': ('image/tiff', (b'II*\x00', b'MM\x00*')),
+    '.mkv': ('video/x-matroska', (b'\x1a\x45\xdf\xa3',)),
+    '.webm': ('video/webm', (b'\x1a\x45\xdf\xa3',)),
+}
+# ISO base media files (HEIF, MP4, QuickTime), brand of the leading `ftyp` box
+FTYP = {
+    '.heic': ('image/heic', (b'heic', b'heix', b'heim', b'heis', b'mif1', b'msf1')),
+    '.heif': ('image/heif', (b'mif1', b'msf1', b'heic', b'heix')),
+    '.avif': ('image/avif', (b'avif', b'avis')),
+    '.mp4': ('video/mp4', (b'isom', b'iso2', b'iso4', b'iso5', b'iso6', b'mp41', b'mp42',
+                           b'avc1', b'dash')),
+    '.m4v': ('video/x-m4v', (b'M4V ', b'M4VH', b'M4VP', b'isom', b'mp42')),
+    '.mov': ('video/quicktime', (b'qt  ',)),
+    '.3gp': ('video/3gpp', (b'3gp4', b'3gp5', b'3gp6', b'3ge6', b'3gg6')),
+}
+
+
+def advise(file: Any, advice: Optional[int]) -> None:
+    '''`posix_fadvise` hint about the whole of the open `file`, if supported.'''
+    if advice is None:
+        return
+    try:
+        os.posix_fadvise(file.fileno(), 0, 0, advice)
+    except OSError:
+        pass  # Only a hint, e.g. not supported by the filesystem
+
 
 class filetype:
     @classmethod
     def __call__(cls, *args, **kwargs) -> str:
-        return async2sync(cls.async_, *args, **kwargs)
+        return await_(cls.async_(*args, **kwargs))
 
     @classmethod
     def is_image(cls, mime: str):
         return (mime.split('/')[0] == 'image') if mime else False
 
+    @classmethod
+    def is_video(cls, mime: str):
+        return (mime.split('/')[0] == 'video') if mime else False
+
+    @staticmethod
+    def _magic(header: bytes, file: str | pathlib.Path | Any) -> str:
+        """Fast path: the magic number expected for the extension of `file`.
+
+        Args:
+            header (bytes): first bytes of the file
+            file (str | pathlib.Path | Any): file path
+
+        Raises:
+            UnidentifiedImageError: If the extension is unknown or its magic number is not there
+
+        Returns:
+            str: mimetype of file
+        """
+        extension = os.path.splitext(str(file))[1].lower()
+        if extension in MAGIC:
+            mime, magics = MAGIC[extension]
+            if header.startswith(magics):
+                return mime
+        elif extension in FTYP:
+            mime, brands = FTYP[extension]
+            if header[4:8] == b'ftyp' and header[8:12] in brands:
+                return mime
+        elif extension == '.webp':
+            if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+                return 'image/webp'
+        elif extension == '.avi':
+            if header[:4] == b'RIFF' and header[8:12] == b'AVI ':
+                return 'video/x-msvideo'
+        raise UnidentifiedImageError(f'{file} magic number does not match its extension')
+
     @staticmethod
-    def _whatimage(file: str | pathlib.Path | Any) -> str:
+    def _whatimage(header: bytes, file: str | pathlib.Path | Any) -> str:
         """Minimal wrapper for whatimmage library => github.com/david-poirier-csn/whatimage
 
         Args:
+            header (bytes): first bytes of the file
             file (str | pathlib.Path | Any): file path
 
         Raises:
@@ -33,7 +132,7 @@ class filetype:
         Returns:
             str: mimetype of file
         """
-        fmt = whatimage.identify_image(file)
+        fmt = whatimage.identify_image(header)
         if not fmt:
             logger.exception('{file} format not identified')
             raise UnidentifiedImageError(f'{file} format not identified')
@@ -41,10 +140,11 @@ class filetype:
         return f'image/{fmt}'.lower()
 
     @staticmethod
-    async def _filetype(file: str | pathlib.Path | Any) -> str:
+    def _filetype(header: bytes, file: str | pathlib.Path | Any) -> str:
         """Minimal wrapper for filetype library => github.com/h2non/filetype.py
 
         Args:
+            header (bytes): first bytes of the file
             file (str | pathlib.Path | Any): file path
 
         Raises:
@@ -53,21 +153,19 @@ class filetype:
         Returns:
             str: mimetype of file
         """
-        async with aiofiles.open(file, 'rb') as openned_file:
-            logger.debug(f"{file} file openned.")
-            header = await openned_file.read(2048)
-            fmt = filetype_lib.guess(header)
-            if not fmt:
-                logger.exception('{file} format not identified')
-                raise UnidentifiedImageError(f'{file} format not identified')
+        fmt = filetype_lib.guess(header)
+        if not fmt:
+            logger.exception('{file} format not identified')
+            raise UnidentifiedImageError(f'{file} format not identified')
         logger.debug(f"{file} format is {fmt.mime.lower()}.")
         return fmt.mime.lower()
 
     @staticmethod
-    def _pillow(file: str | pathlib.Path | Any) -> str:
+    def _pillow(header: bytes, file: str | pathlib.Path | Any) -> str:
         """Minimal wrapper for pillow library => github.com/python-pillow/Pillow
 
         Args:
+            header (bytes): first bytes of the file
             file (str | pathlib.Path | Any): file path
 
         Raises:
@@ -77,9 +175,7 @@ class filetype:
             str: mimetype of file
         """
         try:
-            openned_file = PIL.Image.open(file)
-            logger.debug(f"{file} file openned.")
-            fmt = openned_file.format
+            fmt = PIL.Image.open(io.BytesIO(header)).format
         except UnidentifiedImageError as exc:
             raise UnidentifiedImageError(
                 f'{file} format not identified.'
@@ -88,36 +184,109 @@ class filetype:
         return f"image/{fmt.lower()}"
 
     @classmethod
-    async def async_(cls, file: str | pathlib.Path | Any) -> str:
-        """Async guess filetype.
+    def sniff(cls, header: bytes, file: str | pathlib.Path | Any = '') -> Optional[str]:
+        """Guess filetype from the header of a file.
 
         Args:
-            file (str | pathlib.Path | Any): file path
+            header (bytes): first bytes of the file, `HEADER_SIZE` are enough
+            file (str | pathlib.Path | Any): file path, its extension picks the magic number checked first
 
         Returns:
-            str: guessed file, if any.
+            str: guessed mimetype, if any.
         """
-        # logger.debug(f"file variable is of type {type(file)}")
-
         fmt = None
-        if isinstance(file, (str, pathlib.Path)):
-            # Test multiple file_identifiers
-            fmt = None
-            for func in cls._file_identifiers:
-                try:
-                    logger.debug(f"Trying {func.__name__} type identifier.")
-                    temp = func(file)
-                    if asyncio.iscoroutine(temp):
-                        fmt = await temp
-                    else:
-                        fmt = temp
-                except UnidentifiedImageError:
-                    continue
-                break
+        for func in cls._file_identifiers:
+            try:
+                logger.debug(f"Trying {func.__name__} type identifier.")
+                fmt = func(header, file)
+            except UnidentifiedImageError:
+                continue
+            break
         if fmt:
             logger.debug(f"{file} is of type {fmt}.")
         else:
             logger.warning(f"Failed to identify type of {file}.")
         return fmt
 
-    _file_identifiers = [_filetype, _whatimage]
+    @classmethod
+    def read(
+        cls,
+        file: str | pathlib.Path,
+        size: int,
+        fmt: Optional[str] = None,
+        whole: bool = True,
+        head: int = 0,
+        stream: Optional[Callable[[BinaryIO], Any]] = None,
+    ) -> Tuple[Optional[str], Any]:
+        """Opens `file` once, sniffs its header and, if it is an image, reads the
+        rest of it from the same open file, or has `stream` read it.
+
+        Args:
+            file (str | pathlib.Path): file path
+            size (int): file size, as known from `stat`
+            fmt (str, optional): mimetype already known (e.g. cached), sniffing is skipped
+            whole (bool): whether the image content is needed at all
+            head (int): bytes read at most from a JPEG, where its EXIF thumbnail is (0 = all)
+            stream (Callable, optional): called with the open file, rewound, if
+                it is an image or a video not read in memory
+
+        Returns:
+            tuple: mimetype, if any, and the file content or what `stream`
+                returned, None if not read
+        """
+        whole = whole and size <= IN_MEMORY
+
+        def streamed(fmt: str) -> bool:
+            return stream is not None and not whole and (cls.is_image(fmt) or cls.is_video(fmt))
+
+        if fmt is not None and not (whole and cls.is_image(fmt)) and not streamed(fmt):
+            return fmt, None  # Nothing to read
+        start = perf_counter()
+        with open(file, 'rb', buffering=0) as openned_file:
+            if fmt is None:
+                header = openned_file.read(HEADER_SIZE)
+                elapsed = perf_counter() - start
+                with metrics.timed("sniff"):
+                    fmt = cls.sniff(header, file)
+            else:
+                header, elapsed = b'', perf_counter() - start
+            if not (whole and cls.is_image(fmt)):
+                metrics.observe("read", elapsed)
+                metrics.count("read.bytes", len(header))
+                if not (fmt and streamed(fmt)):
+                    return fmt, None
+                # Read again from the start, the header is in the page cache still
+                openned_file.seek(0)
+                advise(openned_file, SEQUENTIAL)
+                result = stream(openned_file)
+                advise(openned_file, DONTNEED)
+                return fmt, result
+            start = perf_counter()
+            # Read again from the start, the header is in the page cache still
+            openned_file.seek(0)
+            advise(openned_file, SEQUENTIAL)
+            if head and fmt == 'image/jpeg':
+                data = openned_file.read(max(head, len(header)))
+            else:
+                data = openned_file.readall()  # Up to the current end of file
+            advise(openned_file, DONTNEED)
+        metrics.observe("read", elapsed + perf_counter() - start)
+        metrics.count("read.bytes", len(data))
+        return fmt, data
+
+    @classmethod
+    async def async_(cls, file: str | pathlib.Path | Any) -> Optional[str]:
+        """Async guess filetype.
+
+        Args:
+            file (str | pathlib.Path | Any): file path
+
+        Returns:
+            str: guessed file, if any.
+        """
+        if not isinstance(file, (str, pathlib.Path)):
+            return None
+        fmt, _ = await async_(cls.read, file, 0, whole=False)
+        return fmt
+
+    _file_identifiers = [_magic, _filetype, _whatimage]
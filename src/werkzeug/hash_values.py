@@ -0,0 +1,83 @@
+"""
+Conversion between the hash strings returned by hashers, the raw bytes stored
+in `Hashes.hashvalue` and packed `uint64` words.
+
+`perception.*` hashers return base64, `dhash` and `hashlib` return hex, and so
+do the frame hash sequences of videos (`video.*`). Tier keys of
+`hashlib.resolved` and the `fmt`, `preview` and `video` pseudo hashes are
+plain text, and are stored as UTF-8.
+
+`popcount` counts the set bits of packed hashes, for the Hamming distances
+computed with numpy (snapshots, video sequences), `src.werkzeug.distances`
+has the numba ones.
+"""
+from base64 import b64decode, b64encode
+from typing import Iterable, Tuple
+
+import numpy as np
+
+TIER_KEYS = ('size:', 'partial:')
+
+
+def _is_text(hashtype: str, hashvalue: str | bytes) -> bool:
+    if hashtype.startswith(('dhash.', 'perception.', 'video.')):
+        return False
+    if hashtype.startswith('hashlib.'):
+        prefixes = TIER_KEYS if isinstance(hashvalue, str) else \
+            tuple(prefix.encode() for prefix in TIER_KEYS)
+        return hashvalue.startswith(prefixes)
+    return True
+
+
+def to_bytes(hashtype: str, hashvalue: str) -> bytes:
+    '''Raw bytes of a hash string, as stored in `Hashes.hashvalue`.'''
+    if _is_text(hashtype, hashvalue):
+        return hashvalue.encode('utf-8')
+    if hashtype.startswith('perception.'):
+        return b64decode(hashvalue)
+    return bytes.fromhex(hashvalue)
+
+
+def to_text(hashtype: str, hashvalue: bytes) -> str:
+    '''Inverse of `to_bytes`.'''
+    if _is_text(hashtype, hashvalue):
+        return hashvalue.decode('utf-8')
+    if hashtype.startswith('perception.'):
+        return b64encode(hashvalue).decode('ascii')
+    return hashvalue.hex()
+
+
+def to_words(hashvalues: Iterable[bytes]) -> Tuple[np.ndarray, int]:
+    '''Packs `hashvalues` into an `(n, words)` `uint64` matrix.
+
+    Each hash is read as a big-endian number, left padded with zeros up to a
+    multiple of 64 bits, so bit 0 of the hash is the most significant bit of the
+    first word that holds data.
+
+    Parameters
+    ----------
+    hashvalues : Iterable[bytes]
+        raw hashes as stored in `Hashes.hashvalue`.
+
+    Returns
+    -------
+        the matrix and the number of bits of the (longest) hash.
+    '''
+    raw = list(hashvalues)
+    nbytes = max(map(len, raw), default=0)
+    words = -(-nbytes // 8)
+    buffer = b''.join(value.rjust(words * 8, b'\0') for value in raw)
+    matrix = np.frombuffer(buffer, dtype='>u8').astype(np.uint64)
+    return matrix.reshape(len(raw), words), nbytes * 8
+
+
+if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+    popcount = np.bitwise_count
+else:
+    _BYTE_COUNTS = np.array([bin(i).count("1") for i in range(256)], np.uint8)
+
+    def popcount(values: np.ndarray) -> np.ndarray:
+        '''Set bits of each element of an unsigned integer array.'''
+        values = np.ascontiguousarray(values)
+        counts = _BYTE_COUNTS[values.view(np.uint8)]
+        return counts.reshape(*values.shape, values.itemsize).sum(axis=-1, dtype=np.uint8)
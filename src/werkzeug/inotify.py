@@ -0,0 +1,140 @@
+"""
+Minimal inotify binding through libc, for `watch` (Linux only).
+
+A watch covers one directory, not its subdirectories, so `watch_tree` adds one
+per directory of a tree. Events are read from a non-blocking file descriptor,
+meant for `loop.add_reader`.
+
+Sources:
+- [inotify(7)](https://man7.org/linux/man-pages/man7/inotify.7.html)
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+from typing import Dict, List, NamedTuple, Optional
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+# A file is ready once written and closed, or moved in (sync tools write to a
+# temporary name and rename it). New directories are watched in turn.
+MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+        | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class Event(NamedTuple):
+    path: str
+    mask: int
+    cookie: int
+
+    @property
+    def is_dir(self) -> bool:
+        return bool(self.mask & IN_ISDIR)
+
+
+class Inotify:
+    """
+    An inotify instance and the directory of each of its watches.
+
+    Raises
+    ------
+    OSError
+        when inotify is not available, e.g. not on Linux.
+    """
+
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux") from None
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+        self.watches: Dict[int, str] = {}
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def add(self, directory: str, mask: int = MASK) -> int:
+        '''Watches `directory`. Watching it again (e.g. once moved) returns the
+        same descriptor, filed under its new path.'''
+        wd = self._add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            self._raise(directory)
+        self.watches[wd] = directory
+        return wd
+
+    def remove(self, directory: str) -> None:
+        '''Stops watching `directory` and the directories under it.'''
+        prefix = os.path.join(directory, "")
+        for wd, path in list(self.watches.items()):
+            if path == directory or path.startswith(prefix):
+                self._rm_watch(self.fd, wd)  # Fails if already gone, as wanted
+                del self.watches[wd]
+
+    def read(self, size: int = 1 << 16) -> List[Event]:
+        '''Events waiting to be read, maybe none. The path of an event is that
+        of the file or directory it is about, or of the watch for
+        `IN_DELETE_SELF` and `IN_Q_OVERFLOW` (empty then).'''
+        try:
+            data = os.read(self.fd, size)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, cookie, length = HEADER.unpack_from(data, offset)
+            offset += HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if (directory := self.watches.get(wd)) is None:
+                if not mask & IN_Q_OVERFLOW:
+                    continue  # Queued before its watch was removed
+                directory = ""
+            events.append(Event(os.path.join(directory, name) if name else directory, mask, cookie))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    @staticmethod
+    def _raise(path: Optional[str] = None):
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code), path)
+
+
+def watch_tree(inotify: Inotify, root: str) -> List[str]:
+    '''Watches every directory under `root`, and returns the files found there.
+    A directory is watched before it is listed, so a file created meanwhile is
+    either listed or reported.'''
+    files, stack = [], [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            inotify.add(directory)
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        files.append(entry.path)
+        except OSError:
+            continue  # Vanished or unreadable
+    return files
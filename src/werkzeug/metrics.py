@@ -0,0 +1,195 @@
+"""
+Pipeline metrics: per-stage latency histograms, counters and gauges.
+
+Recording is meant to stay on: an observation is a lock, a bisect over fixed
+buckets and two additions. Stages are named `stat`, `sniff`, `read`, `decode`,
+`hash:<hashtype>` and `commit`. Pool workers record in their own registry and
+ship a `snapshot` back with each chunk, which is `merge`d into the main one.
+
+Sources:
+- [Prometheus histograms](https://prometheus.io/docs/practices/histograms/)
+- [Textfile collector](https://github.com/prometheus/node_exporter#textfile-collector):
+    On writing `.prom` files atomically.
+"""
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter, time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from orjson import OPT_INDENT_2, dumps
+
+# Upper bounds in seconds: 10µs, 20µs, ... about 84s
+BUCKETS = tuple(1e-5 * 2 ** k for k in range(24))
+PREFIX = "dup_photos"
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "max")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.max = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def quantile(self, q: float) -> float:
+        '''Upper bound of the bucket holding the `q` quantile.'''
+        rank, seen = q * self.count, 0
+        for bound, count in zip((*BUCKETS, self.max), self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.started = time()
+
+    def reset(self) -> None:
+        '''Starts over, e.g. in a forked worker holding a copy of its parent's.'''
+        self.__init__()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self.lock:
+            if (histogram := self.histograms.get(stage)) is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.counts[bisect_left(BUCKETS, seconds)] += 1
+            histogram.sum += seconds
+            if seconds > histogram.max:
+                histogram.max = seconds
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float) -> None:
+        '''Sets `name`, and keeps its highest value in `<name>.max`.'''
+        with self.lock:
+            self.gauges[name] = value
+            peak = f"{name}.max"
+            self.gauges[peak] = max(self.gauges.get(peak, value), value)
+
+    def timed_call(self, stage: str, func: Callable, *args: Any, **kwargs: Any) -> Any:
+        '''Calls `func`, timed as `stage`. Meant to run in worker threads.'''
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.observe(stage, perf_counter() - start)
+
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, perf_counter() - start)
+
+    def snapshot(self, reset: bool = False) -> Dict[str, Any]:
+        '''Picklable copy of the recorded values, see `merge`.'''
+        with self.lock:
+            data = {
+                "histograms": {
+                    k: (list(h.counts), h.sum, h.max) for k, h in self.histograms.items()
+                },
+                "counters": dict(self.counters),
+            }
+            if reset:
+                self.histograms.clear()
+                self.counters.clear()
+        return data
+
+    def merge(self, data: Dict[str, Any]) -> None:
+        with self.lock:
+            for stage, (counts, total, peak) in data["histograms"].items():
+                if (histogram := self.histograms.get(stage)) is None:
+                    histogram = self.histograms[stage] = Histogram()
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.max = max(histogram.max, peak)
+            for name, value in data["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            stages = {
+                stage: {
+                    "count": h.count,
+                    "seconds": h.sum,
+                    "mean": h.sum / h.count if h.count else 0.0,
+                    "p50": h.quantile(0.5),
+                    "p90": h.quantile(0.9),
+                    "p99": h.quantile(0.99),
+                    "max": h.max,
+                }
+                for stage, h in sorted(self.histograms.items())
+            }
+            return {
+                "elapsed": time() - self.started,
+                "stages": stages,
+                "counters": dict(sorted(self.counters.items())),
+                "gauges": dict(sorted(self.gauges.items())),
+            }
+
+    def prometheus(self) -> str:
+        '''Text exposition format, stages as `stage` (and `hasher`) labels.'''
+        lines: List[str] = [
+            f"# HELP {PREFIX}_stage_seconds Latency of each pipeline stage.",
+            f"# TYPE {PREFIX}_stage_seconds histogram",
+        ]
+        with self.lock:
+            for stage, h in sorted(self.histograms.items()):
+                name, _, hasher = stage.partition(":")
+                labels = f'stage="{name}"' + (f',hasher="{hasher}"' if hasher else "")
+                cumulative = 0
+                for bound, count in zip((*BUCKETS, float("inf")), h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else f"{bound:.6g}"
+                    lines.append(f'{PREFIX}_stage_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f"{PREFIX}_stage_seconds_sum{{{labels}}} {h.sum}")
+                lines.append(f"{PREFIX}_stage_seconds_count{{{labels}}} {cumulative}")
+            for name, value in sorted(self.counters.items()):
+                metric = _metric_name(name)
+                lines.append(f"# TYPE {metric}_total counter")
+                lines.append(f"{metric}_total {value}")
+            for name, value in sorted(self.gauges.items()):
+                metric = _metric_name(name)
+                lines.append(f"# TYPE {metric} gauge")
+                lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, json_path: Optional[str] = None, prom_path: Optional[str] = None) -> None:
+        if json_path:
+            _write_atomic(json_path, dumps(self.summary(), option=OPT_INDENT_2))
+        if prom_path:
+            _write_atomic(prom_path, self.prometheus().encode())
+
+
+def _metric_name(name: str) -> str:
+    return f"{PREFIX}_" + "".join(c if c.isalnum() else "_" for c in name)
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    # Readers (e.g. node_exporter) never see a half written file
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+
+REGISTRY = Registry()
+observe = REGISTRY.observe
+count = REGISTRY.count
+gauge = REGISTRY.gauge
+timed = REGISTRY.timed
+timed_call = REGISTRY.timed_call
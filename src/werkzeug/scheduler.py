@@ -0,0 +1,291 @@
+"""
+Concurrency limits of the hashing pipeline: reads per device, hashing per CPU.
+
+Reads are limited per device (`st_dev`), so a high-latency network mount can
+keep dozens of reads in flight while a local SSD keeps a few, and neither
+waits for the other's slots. Hashing is CPU bound and gets its own limit, by
+default the number of CPUs.
+
+A device limit is either fixed or tuned from the reads it lets through, after
+the gradient algorithm of Netflix's concurrency-limits. Reads are timed per
+MiB, so big and small files compare. Once every window of reads, the limit
+becomes `limit * gradient + sqrt(limit)`, where the gradient is `tolerance`
+times the fastest window seen (the device unloaded) over this window, kept
+within [0.5, 1]. The limit grows while more reads in flight don't make each
+one slower (latency bound, e.g. a cloud mount) and settles once reads queue in
+the device (throughput bound, e.g. a local disk). It only grows when the reads
+in flight came close to it.
+
+Sources:
+- [concurrency-limits](https://github.com/Netflix/concurrency-limits):
+    GradientLimit and Gradient2Limit.
+- [Little's law](https://en.wikipedia.org/wiki/Little%27s_law):
+    On the reads in flight a latency bound device needs.
+"""
+import asyncio
+import math
+import os
+from collections import deque
+from contextlib import asynccontextmanager
+from time import perf_counter
+from typing import Any, AsyncIterator, Deque, Dict, Iterable, List, Optional, Tuple
+
+from src.werkzeug import metrics
+
+AUTO = "auto"
+MIB = 1024 * 1024
+
+
+class Limiter:
+    """FIFO semaphore whose limit can change while it is held."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.inflight = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> None:
+        if self.inflight < self.limit and not self.waiters:
+            self.inflight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # Granted, then cancelled before it resumed
+            else:
+                self.waiters.remove(waiter)
+            raise
+
+    def release(self) -> None:
+        self.inflight -= 1
+        self.wake()
+
+    def wake(self) -> None:
+        while self.waiters and self.inflight < self.limit:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.inflight += 1
+                waiter.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, counter: str) -> AsyncIterator[None]:
+        '''Holds a slot, the time spent waiting for it is added to `counter`.'''
+        start = perf_counter()
+        await self.acquire()
+        metrics.count(counter, perf_counter() - start)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class Device(Limiter):
+    """
+    Read limiter of one device, tuned unless `fixed`.
+
+    Parameters
+    ----------
+    name : str
+        `major:minor` of the device, as in `/proc/self/mountinfo`.
+    limit : int
+        reads in flight, the starting point when tuned.
+    fixed : bool, optional
+        keep `limit` as it is.
+    minimum, maximum : int, optional
+        bounds of a tuned limit.
+    tolerance : float, optional
+        how much slower than the fastest window a window may read before the
+        limit shrinks.
+    smoothing : float, optional
+        weight of a new limit against the current one.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        fixed: bool = False,
+        minimum: int = 1,
+        maximum: int = 64,
+        tolerance: float = 2.0,
+        smoothing: float = 0.2,
+    ) -> None:
+        super().__init__(limit)
+        self.name = name
+        self.fixed = fixed
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.estimate = float(limit)
+        self.fastest: Optional[float] = None
+        self.window: List[float] = []
+        self.peak = 0
+        self.history: List[Dict[str, Any]] = []
+
+    @asynccontextmanager
+    async def read(self, size: int, timed: bool = True) -> AsyncIterator[None]:
+        '''Holds a slot for reading `size` bytes, timed to tune the limit unless
+        the slot is held for more than reading (e.g. decoding too).'''
+        async with self.slot("io.wait_seconds"):
+            self.peak = max(self.peak, self.inflight)
+            start = perf_counter()
+            try:
+                yield
+            finally:
+                if timed and not self.fixed:
+                    self.update((perf_counter() - start) / max(size / MIB, 1))
+
+    def update(self, seconds: float) -> None:
+        '''Records a read that took `seconds` per MiB.'''
+        self.window.append(seconds)
+        if len(self.window) < max(self.limit, 8):
+            return
+        median = sorted(self.window)[len(self.window) // 2]
+        self.fastest = median if self.fastest is None else min(self.fastest, median)
+        gradient = max(0.5, min(1.0, self.tolerance * self.fastest / median)) if median else 1.0
+        estimate = self.estimate * gradient
+        if self.peak >= self.limit / 2:  # Application limited otherwise
+            estimate += math.sqrt(self.estimate)
+        self.estimate = min(max(
+            (1 - self.smoothing) * self.estimate + self.smoothing * estimate,
+            self.minimum), self.maximum)
+        self.history.append({
+            "device": self.name,
+            "reads": len(self.window),
+            "median": median,
+            "fastest": self.fastest,
+            "peak": self.peak,
+            "limit": round(self.estimate),
+        })
+        self.limit = round(self.estimate)
+        self.window, self.peak = [], 0
+        metrics.gauge(f"io.limit.{self.name}", self.limit)
+        self.wake()
+
+
+def device_name(dev: int) -> str:
+    return f"{os.major(dev)}:{os.minor(dev)}"
+
+
+def parse(specs: Iterable[str]) -> Tuple[Optional[int], Dict[int, Optional[int]]]:
+    '''Parses `[PATH=]N|auto` specifications of read limits.
+
+    Parameters
+    ----------
+    specs : Iterable[str]
+        `N` or `auto` sets the limit of every device not named, `PATH=N` or
+    `PATH=auto` the limit of the device holding `PATH`.
+
+    Returns
+    -------
+        the default limit and the limits by `st_dev`, None meaning tuned.
+
+    Raises
+    ------
+    ValueError
+        on a malformed limit or a PATH that can't be stat'ed.
+    '''
+    default: Optional[int] = None
+    devices: Dict[int, Optional[int]] = {}
+    for spec in specs:
+        path, _, value = spec.rpartition("=")
+        if value.strip().lower() == AUTO:
+            limit = None
+        elif value.strip().isdigit() and int(value) > 0:
+            limit = int(value)
+        else:
+            raise ValueError(f"{spec!r}: expected [PATH=]N or [PATH=]auto, N > 0.")
+        if not path:
+            default = limit
+            continue
+        try:
+            devices[os.stat(path).st_dev] = limit
+        except OSError as exc:
+            raise ValueError(f"{spec!r}: {exc.strerror}.") from exc
+    return default, devices
+
+
+class Scheduler:
+    """
+    Read limits by device and the hashing limit.
+
+    Parameters
+    ----------
+    default : int, optional
+        reads in flight on a device not in `devices`, tuned if None.
+    devices : Dict[int, Optional[int]], optional
+        limits by `st_dev`, as returned by `parse`.
+    cpu : int, optional
+        hashes computed at once, the number of CPUs if None.
+    initial, maximum : int, optional
+        starting point and upper bound of tuned limits.
+    """
+
+    def __init__(
+        self,
+        default: Optional[int] = None,
+        devices: Optional[Dict[int, Optional[int]]] = None,
+        cpu: Optional[int] = None,
+        initial: int = 4,
+        maximum: int = 64,
+    ) -> None:
+        self.default = default
+        self.configured = devices or {}
+        self.initial = initial
+        self.maximum = maximum
+        self.devices: Dict[int, Device] = {}
+        self.cpu = Limiter(cpu or os.cpu_count() or 1)
+
+    def limit(self, dev: Optional[int] = None) -> Optional[int]:
+        '''Configured limit of `dev`, None if tuned.'''
+        return self.configured.get(dev, self.default)
+
+    def reads(self, dev: Optional[int] = None) -> int:
+        '''Most reads that may ever be in flight on `dev`.'''
+        return self.limit(dev) or self.maximum
+
+    def device(self, dev: int) -> Device:
+        if (device := self.devices.get(dev)) is None:
+            limit = self.limit(dev)
+            device = self.devices[dev] = Device(
+                device_name(dev), limit or min(self.initial, self.maximum),
+                fixed=limit is not None, maximum=max(self.maximum, limit or 1),
+            )
+            metrics.gauge(f"io.limit.{device.name}", device.limit)
+        return device
+
+    def read(self, dev: int, size: int, timed: bool = True):
+        '''Context manager holding a read slot on `dev`, see `Device.read`.'''
+        return self.device(dev).read(size, timed)
+
+    def hashing(self):
+        '''Context manager holding a hashing slot.'''
+        return self.cpu.slot("cpu.wait_seconds")
+
+    def split(self, workers: int) -> "Scheduler":
+        '''The share of one of `workers` processes, each running its own.'''
+        share = lambda limit: limit and -(-limit // workers)  # noqa: E731
+        return Scheduler(
+            share(self.default),
+            {dev: share(limit) for dev, limit in self.configured.items()},
+            max(self.cpu.limit // workers, 1),
+            self.initial,
+            share(self.maximum),
+        )
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "cpu": self.cpu.limit,
+            "devices": {
+                device.name: {
+                    "limit": device.limit,
+                    "tuned": not device.fixed,
+                    "decisions": len(device.history),
+                }
+                for device in self.devices.values()
+            },
+        }
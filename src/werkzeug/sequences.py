@@ -0,0 +1,88 @@
+"""
+Near-duplicate grouping of videos, from the frame hash sequences of
+`src.hashers.video`.
+
+Videos are first matched on what is cheap to compare: sorted by duration, a
+video is only compared with the next ones until their duration differs by
+more than `tolerance` (relative) and `slack` (seconds), and only if their
+frames have about the same aspect ratio. Those candidates are then compared
+frame by frame, and are duplicates when their frames are at most `radius` bits
+apart on average, which a frame or two changed (e.g. a trimmed end) does not
+break.
+"""
+from typing import List, Tuple
+
+import numpy as np
+
+from src.werkzeug.hash_values import popcount
+
+
+def parse(video: bytes) -> Tuple[float, float, int]:
+    '''Duration, aspect ratio and number of frames from the `video` pseudo
+    hash, `duration:WIDTHxHEIGHT:frames`.'''
+    duration, shape, frames = video.decode().split(":")
+    width, height = shape.split("x")
+    return float(duration), int(width) / max(int(height), 1), int(frames)
+
+
+def cluster_sequences(
+    values: List[bytes],
+    durations: np.ndarray,
+    aspects: np.ndarray,
+    frames: int,
+    radius: int,
+    tolerance: float = 0.02,
+    slack: float = 0.5,
+) -> np.ndarray:
+    '''Groups videos whose frame hashes are within `radius` bits on average.
+
+    Parameters
+    ----------
+    values : List[bytes]
+        raw frame hash sequences of one hashtype, all `frames` frames long.
+    durations, aspects : np.ndarray
+        duration in seconds and aspect ratio of each video.
+    frames : int
+        number of frames per sequence.
+    radius : int
+        maximum mean Hamming distance between the frames of two duplicates.
+    tolerance, slack : float, optional
+        relative and absolute difference of durations, and relative difference
+    of aspect ratio, tolerated between duplicates.
+
+    Returns
+    -------
+        The union-find `parent` array, fully compressed, as `cluster` returns.
+    '''
+    n = len(values)
+    width = len(values[0]) if n else 0
+    if any(len(value) != width for value in values) or width % max(frames, 1):
+        raise ValueError("Frame hash sequences of different lengths can't be compared.")
+    sequences = np.frombuffer(b"".join(values), np.uint8).reshape(n, frames, -1) \
+        if n else np.empty((0, frames, 0), np.uint8)
+
+    parent = np.arange(n)
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    order = np.argsort(durations, kind="stable")
+    ordered = durations[order]
+    for a, i in enumerate(order):
+        stop = np.searchsorted(ordered, ordered[a] + max(slack, tolerance * ordered[a]), "right")
+        candidates = order[a + 1:stop]
+        candidates = candidates[np.abs(aspects[candidates] - aspects[i]) <= tolerance * aspects[i]]
+        if not len(candidates):
+            continue
+        distances = popcount(sequences[candidates] ^ sequences[i]).sum(axis=2, dtype=np.int64)
+        for j in candidates[distances.mean(axis=1) <= radius]:
+            ri, rj = find(i), find(j)
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+
+    for i in range(n):
+        parent[i] = find(i)
+    return parent
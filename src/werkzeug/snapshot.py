@@ -0,0 +1,214 @@
+"""
+Memory-mapped snapshots of the stored hashes, one file per hashtype.
+
+`cluster` and `query` read hashes from a snapshot instead of the database: the
+file is mapped, not loaded, so they start in milliseconds and only the pages
+they touch are resident. `export-index` writes snapshots, `run` and `merge`
+refresh the existing ones, see `src.cmds.export_index`.
+
+A snapshot holds one row per stored `(file, hash)` link of its hashtype, sorted
+by hash value. The file is little-endian:
+
+    MAGIC | header length (uint64) | JSON header, padded to `ALIGN` bytes
+    words  : (count, words) uint64, hashes packed as by `to_words`
+    files  : (count,) int64, `Files.id` of each row
+    hashes : (count,) int64, `Hashes.id` of each row
+
+Sources:
+- [numpy.memmap](https://numpy.org/doc/stable/reference/generated/numpy.memmap.html)
+"""
+import os
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+from orjson import dumps, loads
+
+from src.werkzeug.hash_values import popcount, to_words
+
+MAGIC = b"DUPSNAP1"
+VERSION = 1
+ALIGN = 64
+ID_BITS = 32  # Links are keyed by file and hash ids, both below 2**32
+
+
+class Snapshot:
+    """
+    Parameters
+    ----------
+    hashtype : str
+        hasher of every row.
+    words : np.ndarray
+        `(count, words)` `uint64` matrix, sorted rows.
+    files, hashes : np.ndarray
+        `(count,)` `int64` ids of the file and hash of each row.
+    nbits : int
+        number of meaningful (right-aligned) bits per row.
+    """
+
+    def __init__(
+        self,
+        hashtype: str,
+        words: np.ndarray,
+        files: np.ndarray,
+        hashes: np.ndarray,
+        nbits: int,
+    ) -> None:
+        self.hashtype = hashtype
+        self.words = words
+        self.files = files
+        self.hashes = hashes
+        self.nbits = nbits
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    @property
+    def header(self) -> Dict[str, Any]:
+        return {
+            "version": VERSION,
+            "hashtype": self.hashtype,
+            "nbits": self.nbits,
+            "words": self.words.shape[1],
+            "count": len(self),
+        }
+
+    @classmethod
+    def empty(cls, hashtype: str) -> "Snapshot":
+        return cls(hashtype, np.empty((0, 0), np.uint64),
+                   np.empty(0, np.int64), np.empty(0, np.int64), 0)
+
+    @classmethod
+    def open(cls, path: str) -> "Snapshot":
+        '''Maps the snapshot file `path`, read-only.
+
+        Raises
+        ------
+        ValueError
+            when `path` is not a snapshot of this version.
+        '''
+        with open(path, "rb") as file:
+            magic, length = file.read(len(MAGIC)), file.read(8)
+            if magic != MAGIC or len(length) < 8:
+                raise ValueError(f"{path} is not a hash snapshot.")
+            header = loads(file.read(int.from_bytes(length, "little")))
+        if header["version"] != VERSION:
+            raise ValueError(f"{path} is a version {header['version']} snapshot.")
+
+        count, words = header["count"], header["words"]
+        offset = _aligned(len(MAGIC) + 8 + int.from_bytes(length, "little"))
+        arrays = []
+        for dtype, shape in (("<u8", (count, words)), ("<i8", (count,)), ("<i8", (count,))):
+            size = int(np.prod(shape)) * 8
+            arrays.append(
+                np.memmap(path, dtype, "r", offset, shape) if size
+                else np.empty(shape, dtype)  # mmap refuses empty maps
+            )
+            offset += size
+        return cls(header["hashtype"], *arrays, header["nbits"])
+
+    def write(self, path: str) -> None:
+        '''Writes the snapshot to `path`, atomically: readers mapping the
+        previous file keep it until they close it.'''
+        header = dumps(self.header)
+        start = len(MAGIC) + 8 + len(header)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(MAGIC + len(header).to_bytes(8, "little") + header)
+            file.write(b"\0" * (_aligned(start) - start))
+            for array, dtype in ((self.words, "<u8"), (self.files, "<i8"), (self.hashes, "<i8")):
+                np.ascontiguousarray(array, dtype).tofile(file)
+        os.replace(temporary, path)
+
+    def update(
+        self,
+        files: np.ndarray,
+        hashes: np.ndarray,
+        values: Dict[int, bytes],
+    ) -> "Snapshot":
+        '''The snapshot of the current links of the hashtype.
+
+        Rows of links no longer stored are dropped, rows of new links are
+        packed and merged in, the others are kept as they are: only the values
+        of new links are needed.
+
+        Parameters
+        ----------
+        files, hashes : np.ndarray
+            file and hash ids of every stored link of the hashtype.
+        values : Dict[int, bytes]
+            raw value of the hashes in `missing(files, hashes)`.
+        '''
+        kept = np.isin(_keys(self.files, self.hashes), _keys(files, hashes))
+        added = self.missing(files, hashes)
+        new, nbits = to_words(values[i] for i in hashes[added])
+        old = np.asarray(self.words)[kept]
+        # Hashes of one hashtype usually share a length, pad the narrower side
+        width = max(old.shape[1], new.shape[1])
+        old = np.pad(old, ((0, 0), (width - old.shape[1], 0)))
+        new = np.pad(new, ((0, 0), (width - new.shape[1], 0)))
+
+        words = np.concatenate([old, new])
+        ids = np.concatenate([self.files[kept], files[added]])
+        order = np.lexsort((ids, *words.T[::-1])) if width else np.argsort(ids)
+        return Snapshot(
+            self.hashtype,
+            words[order],
+            ids[order],
+            np.concatenate([self.hashes[kept], hashes[added]])[order],
+            max(self.nbits, nbits),
+        )
+
+    def missing(self, files: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+        '''Mask of the links `(files, hashes)` the snapshot has no row for.'''
+        return ~np.isin(_keys(files, hashes), _keys(self.files, self.hashes))
+
+    def within(self, hashvalue: bytes, radius: int, chunk: int = 1 << 20) -> Tuple[np.ndarray, np.ndarray]:
+        '''Rows whose hash is within `radius` bits of the raw `hashvalue`, and
+        their distances. Rows are scanned `chunk` at a time, so memory stays
+        bound whatever the snapshot size.'''
+        query, _ = to_words([hashvalue])
+        width = self.words.shape[1]
+        if query.shape[1] > width:
+            raise ValueError(f"{len(hashvalue) * 8} bits hashes can't be compared with "
+                             f"{self.hashtype} hashes of {self.nbits} bits.")
+        query = np.pad(query, ((0, 0), (width - query.shape[1], 0)))
+
+        rows, distances = [], []
+        for start in range(0, len(self), chunk):
+            block = np.asarray(self.words[start:start + chunk])
+            distance = popcount(block ^ query).sum(axis=1)
+            found = np.flatnonzero(distance <= radius)
+            rows.append(found + start)
+            distances.append(distance[found])
+        if not rows:
+            return np.empty(0, np.int64), np.empty(0, np.int64)
+        return np.concatenate(rows), np.concatenate(distances).astype(np.int64)
+
+
+def path(directory: str, hashtype: str) -> str:
+    return os.path.join(directory, f"{hashtype}.snap")
+
+
+def stored(directory: str) -> Iterable[str]:
+    '''Hashtypes of the snapshots in `directory`.'''
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        name[:-len(".snap")] for name in os.listdir(directory) if name.endswith(".snap")
+    )
+
+
+def load(directory: str, hashtype: str) -> Optional[Snapshot]:
+    '''The mapped snapshot of `hashtype`, None if there is none.'''
+    try:
+        return Snapshot.open(path(directory, hashtype))
+    except FileNotFoundError:
+        return None
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // ALIGN) * ALIGN
+
+
+def _keys(files: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    return (np.asarray(files, np.uint64) << np.uint64(ID_BITS)) | np.asarray(hashes, np.uint64)
@@ -0,0 +1,132 @@
+"""
+Near-duplicate grouping of packed hashes with a union-find structure.
+
+Pairs are not compared all against all. With a radius `r` the hash bits are
+split into `r + 1` bands and, by the pigeonhole principle, two hashes at most
+`r` bits apart are equal on at least one band. Each band is sorted and only
+hashes sharing its value are compared.
+
+Copies share their whole hash, and would share every band bucket too: rows
+with the same hash are grouped first, by one sort of the hashes, and only one
+row of each distinct hash goes through the bands. A bucket of `k` copies costs
+`k` steps instead of `k²` comparisons.
+
+Sources:
+- [Union-find](https://en.wikipedia.org/wiki/Disjoint-set_data_structure)
+- [Detecting Near-Duplicates for Web Crawling](https://research.google/pubs/pub33026/):
+    On splitting hashes in bands to find all pairs within a Hamming radius.
+"""
+import numba as nb
+import numpy as np
+
+from src.werkzeug.distances import distance
+
+ONE = np.uint64(1)
+SIGN = np.uint64(63)
+
+
+@nb.njit(cache=True)
+def find(parent: np.ndarray, i: int) -> int:
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:  # Path compression
+        parent[i], i = root, parent[i]
+    return root
+
+
+@nb.njit(cache=True)
+def union(parent: np.ndarray, i: int, j: int) -> None:
+    i, j = find(parent, i), find(parent, j)
+    if i != j:
+        parent[max(i, j)] = min(i, j)
+
+
+@nb.njit(cache=True)
+def band_keys(words: np.ndarray, rows: np.ndarray, start: int, stop: int) -> np.ndarray:
+    '''Bits `[start, stop)` of each of `rows`, folded into one `uint64` by
+    rotation when the band is wider than 64 bits (collisions only add
+    candidates).'''
+    keys = np.zeros(rows.shape[0], dtype=np.uint64)
+    for r in range(rows.shape[0]):
+        key = np.uint64(0)
+        for bit in range(start, stop):
+            value = (words[rows[r], bit // 64] >> np.uint64(63 - bit % 64)) & ONE
+            key = ((key << ONE) | (key >> SIGN)) ^ value
+        keys[r] = key
+    return keys
+
+
+@nb.njit(cache=True)
+def distinct(words: np.ndarray, parent: np.ndarray) -> np.ndarray:
+    '''Unions the rows of `words` holding the same hash with the first of them,
+    and returns those first rows, one per distinct hash.'''
+    n, w = words.shape
+    order = np.arange(n)
+    for column in range(w - 1, -1, -1):  # Lexicographic, by stable sorts
+        order = order[np.argsort(words[order, column], kind='mergesort')]
+    rows = np.empty(n, dtype=order.dtype)
+    m = 0
+    for a in range(n):
+        i = order[a]
+        same = a > 0
+        for column in range(w):
+            if not same:
+                break
+            same = words[i, column] == words[rows[m - 1], column]
+        if same:
+            union(parent, rows[m - 1], i)
+        else:
+            rows[m] = i
+            m += 1
+    return rows[:m]
+
+
+@nb.njit(cache=True)
+def cluster(words: np.ndarray, nbits: int, radius: int) -> np.ndarray:
+    '''Groups rows of `words` whose hashes are within `radius` bits.
+
+    Parameters
+    ----------
+    words : np.ndarray
+        `(n, w)` `uint64` matrix, as returned by `to_words`.
+    nbits : int
+        number of meaningful (right-aligned) bits per row.
+    radius : int
+        maximum Hamming distance between two members of a pair.
+
+    Returns
+    -------
+        The union-find `parent` array, fully compressed: rows with the same
+    value belong to the same group, which is labelled by its smallest row.
+    '''
+    n = words.shape[0]
+    parent = np.arange(n)
+    offset = words.shape[1] * 64 - nbits
+    bands = min(radius + 1, max(nbits, 1))
+    width = -(-nbits // bands)
+    rows = distinct(words, parent)
+    m = rows.shape[0]
+
+    for band in range(bands):
+        start = offset + band * width
+        stop = min(offset + nbits, start + width)
+        keys = band_keys(words, rows, start, stop)
+        order = np.argsort(keys)
+
+        lo = 0
+        while lo < m:
+            hi = lo + 1
+            while hi < m and keys[order[hi]] == keys[order[lo]]:
+                hi += 1
+            for a in range(lo, hi):
+                for b in range(a + 1, hi):
+                    i, j = rows[order[a]], rows[order[b]]
+                    if find(parent, i) != find(parent, j) \
+                            and distance(words, words, i, j, radius) <= radius:
+                        union(parent, i, j)
+            lo = hi
+
+    for i in range(n):
+        parent[i] = find(parent, i)
+    return parent
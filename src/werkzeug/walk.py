@@ -0,0 +1,161 @@
+"""
+Streaming recursive directory walker.
+
+Sources:
+- https://docs.python.org/3/library/os.html#os.scandir
+"""
+import asyncio
+import os
+import threading
+import zlib
+from typing import (AsyncIterator, Awaitable, Callable, Iterable, Iterator, List,
+                    Optional, Tuple)
+
+from loguru import logger
+
+from src.werkzeug.checkpoint import Checkpoint
+
+
+def in_shard(path: str, root: str, shard: Tuple[int, int]) -> bool:
+    '''Whether the file `path` under `root` belongs to shard `i` of `n`.
+
+    Files are assigned by the CRC-32 of their path relative to `root`, with
+    `/` separators, so every machine given the same tree (wherever it is
+    mounted) picks the same files, and the shards are disjoint and complete.
+    '''
+    relative = os.path.relpath(path, root).replace(os.sep, "/")
+    return zlib.crc32(relative.encode("utf-8", "surrogateescape")) % shard[1] == shard[0] - 1
+
+
+def scantree(
+    path: str,
+    checkpoint: Optional[Checkpoint] = None,
+    shard: Optional[Tuple[int, int]] = None,
+) -> Iterator[os.DirEntry]:
+    '''Recursively yields every non-directory entry under `path`.
+
+    Directories are listed one at a time with `os.scandir`, so memory is bound
+    by the directory stack and not by the size of the tree. `DirEntry` objects
+    keep the type (and, once asked, the stat) information gathered while
+    listing, sparing later `isfile`/`stat` calls.
+
+    Parameters
+    ----------
+    path : str
+        root directory.
+    checkpoint : Checkpoint, optional
+        tells which directories are done, and is told of every directory
+    listed and file yielded.
+    shard : Tuple[int, int], optional
+        `(i, n)`, only yield the files of shard `i` of `n`, see `in_shard`.
+
+    Returns
+    -------
+        An iterator of `os.DirEntry`. Unreadable directories are logged and
+    skipped, they are never done.
+    '''
+    if checkpoint is not None:
+        if checkpoint.skip(path):
+            return
+        checkpoint.open(path)
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if checkpoint is None:
+                            stack.append(entry.path)
+                        elif not checkpoint.skip(entry.path):
+                            checkpoint.open(entry.path, directory)
+                            stack.append(entry.path)
+                    elif shard is None or in_shard(entry.path, path, shard):
+                        if checkpoint is not None:
+                            checkpoint.add(directory)
+                        yield entry
+        except OSError as exc:
+            logger.warning(f"Error listing directory. {str(exc)}")
+            continue
+        # Not in a `finally`: a walk given up halfway did not list it all
+        if checkpoint is not None:
+            checkpoint.close(directory)
+
+
+async def walk(
+    entries: Iterable[os.DirEntry],
+    queue: asyncio.Queue,
+    sentinels: int = 1,
+    stop: Optional[threading.Event] = None,
+    prepare: Optional[Callable[[List[os.DirEntry]], Awaitable[None]]] = None,
+    chunksize: int = 256,
+) -> None:
+    '''Feeds `entries` into a bounded `queue` from a worker thread.
+
+    Iteration (i.e. the blocking `scandir` calls of `scantree`) happens off the
+    event loop, and a full `queue` blocks the thread, so listing never runs
+    further ahead of the consumers than the queue size (and `chunksize`).
+
+    Parameters
+    ----------
+    entries : Iterable[os.DirEntry]
+        usually a `scantree` generator.
+    queue : asyncio.Queue
+        bounded queue read by the consumers.
+    sentinels : int, optional
+        number of `None` put at the end, one per consumer.
+    stop : threading.Event, optional
+        once set, no more entries are put and the sentinels are.
+    prepare : Callable, optional
+        awaited on the loop with every `chunksize` entries before they are put,
+    e.g. to look them up in the database at once.
+    chunksize : int, optional
+        entries per `prepare` call.
+    '''
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+    put = None
+
+    def chunked():
+        chunk = []
+        for entry in entries:
+            chunk.append(entry)
+            if len(chunk) == chunksize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def produce():
+        nonlocal put
+        for chunk in chunked() if prepare else ([entry] for entry in entries):
+            if prepare:
+                put = asyncio.run_coroutine_threadsafe(prepare(chunk), loop)
+                put.result()
+            for entry in chunk:
+                if cancelled.is_set() or (stop is not None and stop.is_set()):
+                    return
+                put = asyncio.run_coroutine_threadsafe(queue.put(entry), loop)
+                put.result()
+
+    try:
+        await asyncio.to_thread(produce)
+    finally:
+        if asyncio.current_task().cancelling():
+            # Nobody reads the queue anymore, release the thread instead
+            cancelled.set()
+            if put:
+                put.cancel()
+        else:
+            for _ in range(sentinels):
+                await queue.put(None)
+
+
+async def drain(queue: asyncio.Queue, producers: int) -> AsyncIterator:
+    '''Yields items from `queue` until each of the `producers` put its `None`.'''
+    while producers:
+        item = await queue.get()
+        if item is None:
+            producers -= 1
+        else:
+            yield item
@@ -0,0 +1,68 @@
+"""
+Perceptual hashes from reduced-resolution decoding (`draft`/`reduce`, see
+`src.hashers.decode`) and from embedded previews must match the hashes of the
+full image, within a fraction of their bits. Timings are left to
+`benchmarks/decode.py`.
+"""
+import pytest
+from PIL import Image
+
+from benchmarks.corpus import EXIF_THUMBNAIL, HEIF_THUMBNAIL, heif_available
+from benchmarks.decode import distance, encoded
+from src.hashers import decoded_hashers, enabled_hashers
+from src.hashers.decode import Decoded, decode, decode_preview, hash_decoded, resolution
+
+PICTURES = 2
+SIZE = (4032, 3024)  # Camera sized, as `benchmarks/decode.py`
+TOLERANCE = 0.05  # Fraction of differing bits
+PREVIEW_TOLERANCE = 0.15  # Previews are encoded again by the camera
+ALONG_SIZE = (1024, 768)  # Hashers come to different scales, as in the corpus
+
+
+def available(hashtype):
+    try:  # OpenCV hashers need opencv-contrib
+        enabled_hashers[hashtype](Decoded(Image.new("RGB", (64, 64))))
+    except Exception:
+        return False
+    return True
+
+
+@pytest.fixture(scope="module", params=["JPEG", "HEIF"])
+def images(request):
+    if request.param == "HEIF" and not heif_available():
+        pytest.skip("pillow-heif is not installed")
+    pictures = encoded(PICTURES, SIZE, [request.param])[request.param]
+    return [(data, decode(data)) for data in pictures]  # Full decodes, shared by every hasher
+
+
+@pytest.fixture(params=sorted(decoded_hashers))
+def hashtype(request):
+    if not available(request.param):
+        pytest.skip(f"{request.param} is not available")
+    return request.param
+
+
+def test_reduced_decode(images, hashtype):
+    func, side = enabled_hashers[hashtype], resolution([hashtype])
+    for data, full in images:
+        assert distance(hashtype, func(full)[1], func(decode(data, side))[1]) <= TOLERANCE
+
+
+def test_preview(images, hashtype):
+    func, side = enabled_hashers[hashtype], resolution([hashtype], margin=1)
+    if side is None or side > min(EXIF_THUMBNAIL, HEIF_THUMBNAIL):
+        pytest.skip(f"{hashtype} needs more than the embedded previews have")
+    for data, full in images:
+        preview = decode_preview(data, side)
+        assert preview is not None, "the embedded preview was not found"
+        assert distance(hashtype, func(full)[1], func(preview)[1]) <= PREVIEW_TOLERANCE
+
+
+@pytest.mark.parametrize("preview", [False, True], ids=["decoded", "preview"])
+def test_independent_of_other_hashers(hashtype, preview):
+    data = encoded(1, ALONG_SIZE, ["JPEG"])["JPEG"][0]
+    functions = [(algo, enabled_hashers[algo]) for algo in sorted(decoded_hashers)
+                 if available(algo)]
+    alone = hash_decoded(data, [(hashtype, enabled_hashers[hashtype])], preview=preview)
+    along = hash_decoded(data, functions, preview=preview)
+    assert alone[hashtype] == along[hashtype]
@@ -0,0 +1,69 @@
+"""
+`alembic upgrade head` from a database written by the first versions: JSON
+quoted `hashlib.*` and `perception.*` hashtypes, text hash values, one hash
+row per file.
+"""
+import sqlite3
+from base64 import b64encode
+from pathlib import Path
+
+import pytest
+from alembic import command
+from alembic.config import Config
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINE = "6bd5b529ea78"
+MD5 = "d41d8cd98f00b204e9800998ecf8427e"
+PHASH = bytes(range(1, 9))
+DHASH = "0123456789abcdef0123456789abcdef"
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = tmp_path / "database.db"
+    with sqlite3.connect(path) as connection:
+        connection.executescript(f"""
+            CREATE TABLE files (id INTEGER PRIMARY KEY, path VARCHAR NOT NULL, filetype VARCHAR);
+            CREATE TABLE hashes (id INTEGER PRIMARY KEY, hashtype VARCHAR,
+                                 hashvalue VARCHAR NOT NULL);
+            CREATE TABLE association_table (
+                file_id INTEGER NOT NULL REFERENCES files (id),
+                hash_id INTEGER NOT NULL REFERENCES hashes (id),
+                PRIMARY KEY (file_id, hash_id));
+            INSERT INTO files VALUES (1, '/photos/a.jpg', 'image/jpeg'),
+                                     (2, '/photos/b.jpg', 'image/jpeg');
+            INSERT INTO hashes VALUES (1, '"hashlib.md5"', '{MD5}'),
+                                      (2, '"perception.PHash"', '{b64encode(PHASH).decode()}'),
+                                      (3, 'dhash.dhash', '{DHASH}'),
+                                      (4, '"hashlib.md5"', '{MD5}');
+            INSERT INTO association_table VALUES (1, 1), (1, 2), (1, 3), (2, 4);
+        """)
+    config = Config(str(ROOT / "alembic.ini"))
+    config.set_main_option("script_location", str(ROOT / "alembic"))
+    config.set_main_option("sqlalchemy.url", f"sqlite:///{path}")
+    command.stamp(config, BASELINE)
+    command.upgrade(config, "head")
+    with sqlite3.connect(path) as connection:
+        yield connection
+
+
+def test_hashtypes_unquoted(database):
+    hashes = database.execute("SELECT hashtype, hashvalue FROM hashes ORDER BY id").fetchall()
+    assert hashes == [
+        ("hashlib.md5", bytes.fromhex(MD5)),
+        ("perception.PHash", PHASH),
+        ("dhash.dhash", bytes.fromhex(DHASH)),
+    ]
+
+
+def test_copies_share_a_row(database):
+    assert database.execute(
+        "SELECT f.path FROM files f JOIN association_table a ON a.file_id = f.id"
+        " JOIN hashes h ON h.id = a.hash_id WHERE h.hashtype = 'hashlib.md5' ORDER BY f.path"
+    ).fetchall() == [("/photos/a.jpg",), ("/photos/b.jpg",)]
+
+
+def test_perceptual_hashes_banded(database):
+    assert database.execute(
+        "SELECT hashtype, value FROM mih_band_0 ORDER BY hash_id"
+    ).fetchall() == [("perception.PHash", 0x0102), ("dhash.dhash", 0x0123)]
@@ -0,0 +1,26 @@
+"""
+Startup budget of the CLI, see `benchmarks/startup.py`: short invocations in
+fresh interpreters, checked against their budgets (scaled by the
+`STARTUP_BUDGET_SCALE` environment variable on slower machines).
+"""
+import os
+import statistics
+import sys
+
+import pytest
+
+from benchmarks.pipeline import MAIN
+from benchmarks.startup import BUDGETS, HEAVY, imported, timed
+
+SCALE = float(os.environ.get("STARTUP_BUDGET_SCALE", "1.0"))
+REPEAT = 3
+
+
+@pytest.mark.parametrize("invocation", list(BUDGETS), ids=" ".join)
+def test_budget(invocation, tmp_path):
+    times = [timed([sys.executable, MAIN, *invocation], str(tmp_path)) for _ in range(REPEAT)]
+    assert statistics.median(times) <= BUDGETS[invocation] * SCALE
+
+
+def test_help_imports_nothing_heavy(tmp_path):
+    assert not imported(("--help",), str(tmp_path)).intersection(HEAVY)
@@ -0,0 +1,77 @@
+"""
+`run --tiered` stores a tier key instead of the digest of a file that has no
+exact duplicate. The key must not stand in for a digest once a copy of the
+file shows up, in the same directory or in one walked by another run, or once
+a run is not tiered.
+"""
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from benchmarks.pipeline import MAIN
+
+TIER_KEYS = (b"size:", b"partial:")
+
+
+def run(tmp_path, *args, directory="photos"):
+    subprocess.run(
+        [sys.executable, MAIN, "--database", str(tmp_path / "database.db"), "run",
+         "-d", str(tmp_path / directory), "-h", "hashlib.md5", *args],
+        cwd=tmp_path, check=True, capture_output=True,
+    )
+
+
+def digests(tmp_path):
+    with sqlite3.connect(tmp_path / "database.db") as connection:
+        return dict(connection.execute(
+            "SELECT f.path, h.hashvalue FROM files f"
+            " JOIN association_table a ON a.file_id = f.id"
+            " JOIN hashes h ON h.id = a.hash_id WHERE h.hashtype = 'hashlib.md5'"
+        ))
+
+
+def photos(tmp_path, name="photos"):
+    directory = tmp_path / name
+    directory.mkdir()
+    pixels = np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(directory / "x.jpg")
+    return directory
+
+
+def test_copy_found_by_a_later_run(tmp_path):
+    directory = photos(tmp_path)
+    run(tmp_path, "--tiered")
+    assert digests(tmp_path)[str(directory / "x.jpg")].startswith(TIER_KEYS)
+
+    shutil.copyfile(directory / "x.jpg", directory / "y.jpg")
+    run(tmp_path, "--tiered")
+    stored = digests(tmp_path)
+    assert not stored[str(directory / "x.jpg")].startswith(TIER_KEYS)
+    assert stored[str(directory / "x.jpg")] == stored[str(directory / "y.jpg")]
+
+
+def test_untiered_run_replaces_tier_keys(tmp_path):
+    directory = photos(tmp_path)
+    run(tmp_path, "--tiered")
+    run(tmp_path, "--tiered")  # Still unique, the key is kept
+    assert digests(tmp_path)[str(directory / "x.jpg")].startswith(TIER_KEYS)
+
+    run(tmp_path)
+    assert not digests(tmp_path)[str(directory / "x.jpg")].startswith(TIER_KEYS)
+
+
+@pytest.mark.parametrize("first", [["--tiered"], []], ids=["tiered", "untiered"])
+def test_copy_in_another_directory(tmp_path, first):
+    a, b = photos(tmp_path, "a"), tmp_path / "b"
+    b.mkdir()
+    shutil.copyfile(a / "x.jpg", b / "x.jpg")
+    run(tmp_path, *first, directory="a")
+    run(tmp_path, "--tiered", directory="b")
+    stored = digests(tmp_path)
+    assert not stored[str(b / "x.jpg")].startswith(TIER_KEYS)
+    assert stored[str(a / "x.jpg")] == stored[str(b / "x.jpg")]